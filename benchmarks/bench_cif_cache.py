@@ -0,0 +1,56 @@
+"""Ingestion time of cif_read against library size.
+
+Writes N synthetic powder cifs into a temporary directory and times reading all of them with
+cif_read twice: a cold pass that parses every cif and fills the cache, and a warm pass that is
+served from the cache.  With a constant-time cache lookup, the time per cif stays flat as N grows.
+
+    python benchmarks/bench_cif_cache.py 250 500 1000 2000
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from pydatarecognition.cif_io import cif_read
+
+CIF_TEMPLATE = """data_{name}
+_diffrn_radiation_wavelength            1.5482
+loop_
+_pd_proc_2theta_corrected
+_pd_proc_intensity_total
+{loop}
+"""
+
+
+def write_cifs(cif_dir, n, npoints=200):
+    twotheta = np.linspace(5., 120., npoints)
+    loop = "\n".join(f"{tt:.4f} {1000. + 100. * np.sin(tt):.1f}(10)" for tt in twotheta)
+    for i in range(n):
+        name = f"bm{i:06d}"
+        (cif_dir / f"{name}.cif").write_text(CIF_TEMPLATE.format(name=name, loop=loop))
+
+
+def time_pass(ciffiles):
+    start = time.perf_counter()
+    for ciffile in ciffiles:
+        cif_read(ciffile)
+    return time.perf_counter() - start
+
+
+def main(sizes):
+    print(f"{'n cifs':>8} {'cold [s]':>10} {'cold/cif [ms]':>14} {'warm [s]':>10} {'warm/cif [ms]':>14}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as d:
+            cif_dir = Path(d) / "cifs"
+            cif_dir.mkdir()
+            write_cifs(cif_dir, n)
+            ciffiles = sorted(cif_dir.glob("*.cif"))
+            cold = time_pass(ciffiles)
+            warm = time_pass(ciffiles)
+        print(f"{n:>8} {cold:>10.3f} {1e3 * cold / n:>14.3f} {warm:>10.3f} {1e3 * warm / n:>14.3f}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [250, 500, 1000, 2000])
@@ -0,0 +1,60 @@
+"""Conversion time of cif numeric tokens on large powder patterns.
+
+Times parse_cif_numbers against the per-token conversion that cif_read used before, i.e.,
+np.char.split on '(', float() on every token and np.delete for every placeholder, on synthetic
+loop columns with standard uncertainties and a sprinkling of '?' and '.' placeholders.
+
+    python benchmarks/bench_cif_numbers.py 100000
+"""
+import sys
+import time
+
+import numpy as np
+
+from pydatarecognition.utils import parse_cif_numbers
+
+
+def make_tokens(npoints, placeholder_every=1000, seed=42):
+    rng = np.random.default_rng(seed)
+    values = 1000. + 1000. * rng.random(npoints)
+    sus = rng.integers(1, 99, npoints)
+    tokens = [f"{v:.2f}({s})" for v, s in zip(values, sus)]
+    for i in range(0, npoints, placeholder_every):
+        tokens[i] = "?" if i % 2 else "."
+    return tokens
+
+
+def per_token(tokens):
+    split = np.char.split(tokens, '(')
+    values = np.array([e[0] for e in split])
+    for i in range(len(values) - 1, -1, -1):
+        if values[i] in [',', '.', '?', '-']:
+            values = np.delete(values, i)
+    return np.array([float(e) for e in values])
+
+
+def vectorized(tokens):
+    values, su, valid = parse_cif_numbers(tokens)
+    return values[valid]
+
+
+def best_of(function, tokens, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(tokens)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(sizes):
+    print(f"{'points':>8} {'per token [ms]':>15} {'vectorized [ms]':>16} {'speedup':>8}")
+    for npoints in sizes:
+        tokens = make_tokens(npoints)
+        assert np.array_equal(per_token(tokens), vectorized(tokens))
+        old, new = best_of(per_token, tokens), best_of(vectorized, tokens)
+        print(f"{npoints:>8} {1e3 * old:>15.1f} {1e3 * new:>16.1f} {old / new:>8.1f}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,80 @@
+"""Filtered query time on a cif collection with and without the indexes of mongo_utils.ensure_indexes.
+
+Fills a scratch collection on a local mongod with N synthetic metadata-only cif documents and times
+the filtered queries the app and the ingestion make, i.e., by paper, by cif file name and by
+wavelength, first on a bare collection and then after ensure_indexes.  Also reports
+the documents each query examines.  The scratch database is dropped at the end.
+
+    python benchmarks/bench_mongo_indexes.py 100000 [mongodb://localhost:27017]
+"""
+import sys
+import time
+
+import numpy as np
+from pymongo import MongoClient, errors
+
+from pydatarecognition.mongo_utils import ensure_indexes
+
+DATABASE = "pydatarecognition_bench"
+
+
+def make_documents(n, seed=42):
+    rng = np.random.default_rng(seed)
+    qmin = rng.uniform(1., 30., n)
+    qmax = qmin + rng.uniform(10., 80., n)
+    wavelengths = [0.0709, 0.15406, 0.15418, 0.0559]
+    return [dict(_id=f"{i:024x}", iucrid=f"bm{i // 5:04d}", cif_file_name=f"bm{i // 5:04d}sup{i % 5}",
+                 qmin=float(qmin[i]), qmax=float(qmax[i]), npoints=int(rng.integers(500, 5000)),
+                 wavelength=wavelengths[i % len(wavelengths)])
+            for i in range(n)]
+
+
+def queries(n):
+    return {
+        "iucrid": {"iucrid": f"bm{n // 10:04d}"},
+        "cif_file_name": {"cif_file_name": f"bm{n // 10:04d}sup2"},
+        "wavelength": {"wavelength": 0.0559, "npoints": {"$gt": 4900}},
+    }
+
+
+def time_query(col, query, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        found = len(list(col.find(query, {"_id": 1})))
+        times.append(time.perf_counter() - start)
+    examined = col.find(query).explain()["executionStats"]["totalDocsExamined"]
+    return min(times), found, examined
+
+
+def main(n, uri):
+    client = MongoClient(uri, serverSelectionTimeoutMS=2000)
+    try:
+        client.server_info()
+    except errors.ServerSelectionTimeoutError:
+        print(f"No mongod at {uri}, start one with mongod --dbpath <dir>")
+        return
+    client.drop_database(DATABASE)
+    col = client[DATABASE]["cif"]
+    try:
+        documents = make_documents(n)
+        for i in range(0, n, 10000):
+            col.insert_many(documents[i:i + 10000], ordered=False)
+        bare = {name: time_query(col, query) for name, query in queries(n).items()}
+        ensure_indexes(col)
+        # a second bootstrap is a no-op
+        start = time.perf_counter()
+        ensure_indexes(col)
+        print(f"{n} documents, repeated index bootstrap {1e3 * (time.perf_counter() - start):.1f} ms")
+        print(f"{'query':>16} {'found':>7} {'bare [ms]':>10} {'examined':>9} {'indexed [ms]':>13} {'examined':>9}")
+        for name, query in queries(n).items():
+            indexed = time_query(col, query)
+            print(f"{name:>16} {bare[name][1]:>7} {1e3 * bare[name][0]:>10.1f} {bare[name][2]:>9} "
+                  f"{1e3 * indexed[0]:>13.1f} {indexed[2]:>9}")
+    finally:
+        client.drop_database(DATABASE)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+         sys.argv[2] if len(sys.argv) > 2 else "mongodb://localhost:27017")
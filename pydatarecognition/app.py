@@ -1,25 +1,31 @@
 import os
 from pathlib import Path
 import yaml
-import tempfile
-import shutil
-import uuid
 
-from fastapi import FastAPI, Body, HTTPException, status, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Body, HTTPException, status, File, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from typing import List, Optional, Literal
 import motor.motor_asyncio
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from pydatarecognition.powdercif import PydanticPowderCif
-from pydatarecognition.utils import xy_resample
-from pydatarecognition.cif_io import user_input_read
-from skbeam.core.utils import twotheta_to_q
-import scipy.stats
+from pydatarecognition.library import PatternLibrary
+from pydatarecognition.rank_pool import RankPool, PoolSaturated
+from pydatarecognition.mongo_utils import ensure_indexes
+from pydatarecognition.app_utils import (RankedLibrary, STEPSIZE_REGULAR_QGRID, page_query, rank_user_input,
+                                         rank_user_inputs, check_batch_size, stream_ranking, pool_saturated)
 import numpy as np
 
-STEPSIZE_REGULAR_QGRID = 10**-3
+# the collection of the cifs, see PYDATAREC_COLLECTION
+COLLECTION = os.environ.get("PYDATAREC_COLLECTION", "cif")
 
-COLLECTION = "cif"
+# the fields that are read to score a cif, everything else stays in the database
+SCORING_FIELDS = {"_id": 1, "iucrid": 1, "cif_file_name": 1, "q": 1, "intensity": 1}
+# the number of documents fetched per round trip when the whole collection is read, see PYDATAREC_CURSOR_BATCH_SIZE
+CURSOR_BATCH_SIZE = int(os.environ.get("PYDATAREC_CURSOR_BATCH_SIZE", 1000))
+MAX_PAGE_SIZE = 1000
+# the number of cifs that are scored between two snapshots of a streamed ranking
+STREAM_CHUNK_SIZE = 2000
 
 app = FastAPI()
 
@@ -40,22 +46,70 @@ doi_dict = {}
 for i in range(len(dois)):
     doi_dict[dois[i][0]] = dois[i][1]
 
+# The patterns of every cif in the database on one regular q-grid, keyed by the mongo id of the cif.
+# It is loaded once at startup and kept in step with the database by the endpoints that change it,
+# so that queries never have to go through the database or fetch arrays from the bucket.  Changes
+# make a new one that then replaces it, as queries that are running keep reading the old one.
+# The new one shares the arrays of the unchanged rows, so a change costs the gridding of one pattern.
+ranked = RankedLibrary(PatternLibrary.from_patterns([], STEPSIZE_REGULAR_QGRID), {}, doi_dict)
 
+# Ranking runs on worker threads, sized by PYDATAREC_RANK_WORKERS and PYDATAREC_RANK_QUEUE
+rank_pool = RankPool.from_env()
+
+
+def library_update(powdercif: PydanticPowderCif):
+    global ranked
+    ranked = ranked.updated(powdercif)
+
+
+def library_remove(key: str):
+    global ranked
+    ranked = ranked.removed(key)
+
+
+@app.on_event("startup")
+async def create_indexes():
+    try:
+        await ensure_indexes(db[COLLECTION])
+    except OperationFailure as e:
+        # the app still serves a collection from before cif_file_name was unique, without the indexes
+        print(f"The indexes of {COLLECTION} could not be created, run mongo_utils.migrate_indexes on it: {e}")
+
+
+@app.on_event("startup")
+async def load_library():
+    global ranked
+    # only the arrays that are scored are fetched, the scattering angles are not
+    cifs = db[COLLECTION].find({}, SCORING_FIELDS).batch_size(CURSOR_BATCH_SIZE)
+    ranked = RankedLibrary.from_cifs([PydanticPowderCif(**cif) async for cif in cifs], doi_dict)
+
+
+@app.on_event("shutdown")
+def stop_rank_pool():
+    rank_pool.shutdown()
 
 
 @app.post("/", response_description="Add new CIF", response_model=PydanticPowderCif)
 async def create_cif(powdercif: PydanticPowderCif = Body(...)):
-    powdercif = jsonable_encoder(powdercif)
-    new_cif = await db[COLLECTION].insert_one(powdercif)
+    try:
+        new_cif = await db[COLLECTION].insert_one(jsonable_encoder(powdercif))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"CIF {powdercif.id} or {powdercif.cif_file_name} already exists")
+    # the cif is only ranked once it is in the database
+    library_update(powdercif)
     created_cif = await db[COLLECTION].find_one({"_id": new_cif.inserted_id})
     return JSONResponse(status_code=status.HTTP_201_CREATED, content=created_cif)
 
 
 @app.get(
-    "/", response_description="List all cifs", response_model=List[PydanticPowderCif]
+    "/", response_description="List a page of cifs", response_model=List[PydanticPowderCif]
 )
-async def list_cifs():
-    cifs = await db[COLLECTION].find().to_list(5)
+async def list_cifs(limit: int = Query(5, ge=1, le=MAX_PAGE_SIZE), after: Optional[str] = None,
+                    arrays: bool = False):
+    # keyset pagination, pass the _id of the last cif of a page as after to get the next page
+    query, projection = page_query(after, arrays)
+    cifs = await db[COLLECTION].find(query, projection).sort("_id", 1).limit(limit).to_list(limit)
     return cifs
 
 
@@ -74,12 +128,17 @@ async def update_cif(id: str, cif: PydanticPowderCif = Body(...)):
     cif = {k: v for k, v in cif.dict().items() if v is not None}
 
     if len(cif) >= 1:
-        update_result = await db[COLLECTION].update_one({"_id": id}, {"$set": cif})
+        try:
+            update_result = await db[COLLECTION].update_one({"_id": id}, {"$set": cif})
+        except DuplicateKeyError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=f"CIF {cif.get('cif_file_name')} already exists")
 
         if update_result.modified_count == 1:
             if (
                 updated_cif := await db[COLLECTION].find_one({"_id": id})
             ) is not None:
+                library_update(PydanticPowderCif(**updated_cif))
                 return updated_cif
 
     if (existing_cif := await db[COLLECTION].find_one({"_id": id})) is not None:
@@ -93,49 +152,62 @@ async def delete_cif(id: str):
     delete_result = await db[COLLECTION].delete_one({"_id": id})
 
     if delete_result.deleted_count == 1:
+        library_remove(id)
         return JSONResponse(status_code=status.HTTP_204_NO_CONTENT)
 
     raise HTTPException(status_code=404, detail=f"CIF {id} not found")
 
+
 @app.put(
     "/query/", response_description="Rank matches to User Input Data"
 )
-async def rank_cif(xtype: Literal["twotheta", "q"], wavelength: float, user_input: bytes = File(...), paper_filter_iucrid: Optional[str] = None):
-    cifname_ranks = []
-    r_pearson_ranks = []
-    doi_ranks = []
-    tempdir = tempfile.mkdtemp()
-    temp_filename = os.path.join(tempdir, f'temp_{uuid.uuid4()}.txt')
-    with open(temp_filename, 'wb') as w:
-        w.write(user_input)
-    userdata = user_input_read(temp_filename)
-    user_x_data, user_intensity = userdata[0, :], userdata[1:, ][0]
-    if xtype == 'twotheta':
-        user_q = twotheta_to_q(np.radians(user_x_data), wavelength)
-    if paper_filter_iucrid:
-        cif_list = db[COLLECTION].find({"iucrid": paper_filter_iucrid})
-    else:
-        cif_list = db[COLLECTION].find({})
-    async for cif in cif_list:
-        mongo_cif = PydanticPowderCif(**cif)
-        try:
-            data_resampled = xy_resample(user_q, user_q, mongo_cif.q, mongo_cif.intensity, STEPSIZE_REGULAR_QGRID)
-            pearson = scipy.stats.pearsonr(data_resampled[0][:, 1], data_resampled[1][:, 1])
-            r_pearson = pearson[0]
-            p_pearson = pearson[1]
-            cifname_ranks.append(mongo_cif.cif_file_name)
-            r_pearson_ranks.append(r_pearson)
-            doi = doi_dict[mongo_cif.iucrid]
-            doi_ranks.append(doi)
-        except AttributeError:
-            print(f"{mongo_cif.cif_file_name} was skipped.")
-
-    cif_rank_pearson = sorted(list(zip(cifname_ranks, r_pearson_ranks, doi_ranks)), key=lambda x: x[1], reverse=True)
-    ranks = [{'IUCrCIF': cif_rank_pearson[i][0],
-              'score': cif_rank_pearson[i][1],
-              'doi': cif_rank_pearson[i][2]} for i in range(len(cif_rank_pearson))]
-    shutil.rmtree(tempdir)
-    return ranks
+async def rank_cif(xtype: Literal["twotheta", "q"], wavelength: float, user_input: bytes = File(...), paper_filter_iucrid: Optional[str] = None,
+                   top_k: Optional[int] = Query(None, ge=1), min_score: Optional[float] = Query(None, ge=-1, le=1),
+                   metric: Literal["pearson", "spearman", "kendall"] = "pearson"):
+    # the top_k matches with a score of at least min_score are returned, every match if top_k is not
+    # given.  The library is read once here, so the whole query sees the same one
+    try:
+        return await rank_pool.run(rank_user_input, ranked, user_input, xtype, wavelength, paper_filter_iucrid,
+                                   top_k, min_score, metric)
+    except PoolSaturated:
+        raise pool_saturated()
+
+
+@app.put(
+    "/query/batch", response_description="Rank matches to each of many User Input Data"
+)
+async def rank_cif_batch(xtype: Literal["twotheta", "q"], wavelength: float, user_inputs: List[bytes] = File(...),
+                         paper_filter_iucrid: Optional[str] = None, top_k: Optional[int] = Query(None, ge=1),
+                         min_score: Optional[float] = Query(None, ge=-1, le=1)):
+    # one ranking per uploaded file, in the order of the upload, as /query/ returns it.  All patterns are
+    # scored by the Pearson coefficient in one pass over the library
+    check_batch_size(user_inputs)
+    try:
+        return await rank_pool.run(rank_user_inputs, ranked, user_inputs, xtype, wavelength, paper_filter_iucrid,
+                                   top_k, min_score)
+    except PoolSaturated:
+        raise pool_saturated()
+
+
+@app.put(
+    "/query/stream", response_description="Stream the top matches to User Input Data while they are ranked"
+)
+async def stream_rank_cif(xtype: Literal["twotheta", "q"], wavelength: float, user_input: bytes = File(...),
+                          paper_filter_iucrid: Optional[str] = None, top_k: int = Query(10, ge=1),
+                          min_score: Optional[float] = Query(None, ge=-1, le=1),
+                          metric: Literal["pearson", "spearman", "kendall"] = "pearson",
+                          chunk_size: int = Query(STREAM_CHUNK_SIZE, ge=1),
+                          format: Literal["ndjson", "sse"] = "ndjson"):
+    # a snapshot of the top_k matches is sent every time chunk_size more cifs have been scored, and the
+    # final top_k matches, as /query/ returns them, at the end.  Events are lines of json with an "event"
+    # key, or server-sent events
+    try:
+        stream = stream_ranking(rank_pool, ranked, user_input, xtype, wavelength, paper_filter_iucrid, top_k,
+                                min_score, metric, chunk_size, format)
+    except PoolSaturated:
+        raise pool_saturated()
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream, media_type=media_type)
 
 
 if __name__ == "__main__":
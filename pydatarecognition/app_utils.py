@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+from fastapi import HTTPException, status
+from skbeam.core.utils import twotheta_to_q
+
+from pydatarecognition.cif_io import user_input_read
+from pydatarecognition.library import PatternLibrary
+from pydatarecognition.utils import top_k_indices
+
+STEPSIZE_REGULAR_QGRID = 10**-3
+
+# the fields that are left out when cifs are listed without their arrays
+ARRAY_FIELDS = {"q": 0, "ttheta": 0, "intensity": 0}
+# the most user patterns in one batch query, which keeps their scores against the whole library in memory
+MAX_BATCH_SIZE = 100
+
+
+class RankedLibrary:
+    '''
+    The patterns that the web app ranks, with the cif file name of every pattern and the DOI of
+    every paper that the rankings report.  It is never changed once made: updated and removed
+    return a new one that shares the unchanged rows of this one, so queries that are running keep
+    reading the one they started with while the app swaps in the new one.
+
+    Attributes
+    ----------
+    library : PatternLibrary
+        The patterns on one regular q-grid, keyed by the mongo id of their cif
+    cif_file_names : dict of str
+        The cif file name of every pattern, keyed by the mongo id of its cif
+    dois : dict of str
+        The DOI of every paper, keyed by iucrid
+    '''
+
+    def __init__(self, library, cif_file_names, dois):
+        self.library, self.cif_file_names, self.dois = library, cif_file_names, dois
+
+    @classmethod
+    def from_cifs(cls, powdercifs, dois, q_step=STEPSIZE_REGULAR_QGRID):
+        '''
+        returns the RankedLibrary of the PydanticPowderCifs that have a pattern
+        '''
+        patterns, cif_file_names = [], {}
+        for powdercif in powdercifs:
+            if len(powdercif.q) == 0:
+                print(f"{powdercif.cif_file_name} was skipped.")
+                continue
+            patterns.append((str(powdercif.id), powdercif.iucrid, powdercif.q, powdercif.intensity))
+            cif_file_names[str(powdercif.id)] = powdercif.cif_file_name
+        return cls(PatternLibrary.from_patterns(patterns, q_step), cif_file_names, dois)
+
+    def updated(self, powdercif):
+        '''
+        returns the RankedLibrary with the pattern of powdercif in place of its previous one.  A cif
+        without a pattern is removed, as it cannot be ranked
+        '''
+        key = str(powdercif.id)
+        if len(powdercif.q) == 0:
+            print(f"{powdercif.cif_file_name} was skipped.")
+            return self.removed(key)
+        library, cif_file_names = self.library.copy(), dict(self.cif_file_names)
+        library.upsert(key, powdercif.iucrid, powdercif.q, powdercif.intensity)
+        cif_file_names[key] = powdercif.cif_file_name
+        return RankedLibrary(library, cif_file_names, self.dois)
+
+    def removed(self, key):
+        '''
+        returns the RankedLibrary without the pattern of the cif with the mongo id key
+        '''
+        if key not in self.cif_file_names:
+            return self
+        library, cif_file_names = self.library.copy(), dict(self.cif_file_names)
+        library.remove(key)
+        del cif_file_names[key]
+        return RankedLibrary(library, cif_file_names, self.dois)
+
+
+def page_query(after=None, arrays=False):
+    # keyset pagination, the _id of the last cif of a page as after gives the next page
+    query = {"_id": {"$gt": after}} if after is not None else {}
+    projection = None if arrays else ARRAY_FIELDS
+    return query, projection
+
+
+def read_user_patterns(user_inputs, xtype, wavelength):
+    # the patterns of a batch share one temporary directory
+    tempdir = tempfile.mkdtemp()
+    patterns = []
+    try:
+        for user_input in user_inputs:
+            temp_filename = os.path.join(tempdir, f'temp_{uuid.uuid4()}.txt')
+            with open(temp_filename, 'wb') as w:
+                w.write(user_input)
+            userdata = user_input_read(temp_filename)
+            user_x_data, user_intensity = userdata[0, :], userdata[1:, ][0]
+            if xtype == 'twotheta':
+                user_q = twotheta_to_q(np.radians(user_x_data), wavelength)
+            else:
+                user_q = user_x_data
+            patterns.append((user_q, user_intensity))
+    finally:
+        shutil.rmtree(tempdir)
+    return patterns
+
+
+def read_user_pattern(user_input, xtype, wavelength):
+    return read_user_patterns([user_input], xtype, wavelength)[0]
+
+
+def paper_filter(library, scores, paper_filter_iucrid, start=0):
+    # scores of cifs from other papers are dropped, scores holds the rows from start on
+    if paper_filter_iucrid:
+        iucrids = library.iucrids[start:start + len(scores)]
+        scores[[iucrid != paper_filter_iucrid for iucrid in iucrids]] = np.nan
+    return scores
+
+
+def score_filter(scores, min_score):
+    # scores below min_score are dropped, so that they are never selected
+    if min_score is not None:
+        with np.errstate(invalid='ignore'):
+            scores[scores < min_score] = np.nan
+    return scores
+
+
+def ranked_entries(ranked, scores, rows):
+    library = ranked.library
+    return [{'IUCrCIF': ranked.cif_file_names[library.names[i]],
+             'score': float(scores[i]),
+             'doi': ranked.dois[library.iucrids[i]]} for i in rows]
+
+
+def rank_user_input(ranked, user_input, xtype, wavelength, paper_filter_iucrid, top_k=None, min_score=None,
+                    metric='pearson'):
+    user_q, user_intensity = read_user_pattern(user_input, xtype, wavelength)
+    scores = ranked.library.correlate(user_q, user_intensity, metric=metric)
+    scores = score_filter(paper_filter(ranked.library, scores, paper_filter_iucrid), min_score)
+    # only the top_k winners are sorted and encoded
+    return ranked_entries(ranked, scores, top_k_indices(scores, top_k or len(scores)))
+
+
+def check_batch_size(user_inputs):
+    if len(user_inputs) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_BATCH_SIZE} patterns can be ranked in one batch")
+
+
+def rank_user_inputs(ranked, user_inputs, xtype, wavelength, paper_filter_iucrid, top_k=None, min_score=None):
+    patterns = read_user_patterns(user_inputs, xtype, wavelength)
+    rankings = []
+    for scores in ranked.library.correlate_many(patterns):
+        scores = score_filter(paper_filter(ranked.library, scores, paper_filter_iucrid), min_score)
+        rankings.append(ranked_entries(ranked, scores, top_k_indices(scores, top_k or len(scores))))
+    return rankings
+
+
+def stream_user_input(ranked, user_input, xtype, wavelength, paper_filter_iucrid, top_k, min_score, metric,
+                      chunk_size, emit, stopped):
+    library = ranked.library
+    user_q, user_intensity = read_user_pattern(user_input, xtype, wavelength)
+    scores = np.full(len(library), np.nan)
+    for start, chunk in library.correlate_chunks(user_q, user_intensity, chunk_size, metric=metric):
+        if stopped.is_set():
+            return
+        stop = start + len(chunk)
+        scores[start:stop] = score_filter(paper_filter(library, chunk, paper_filter_iucrid, start), min_score)
+        emit("snapshot", {'scored': stop, 'total': len(library),
+                          'ranks': ranked_entries(ranked, scores, top_k_indices(scores[:stop], top_k))})
+    emit("final", {'scored': len(library), 'total': len(library),
+                   'ranks': ranked_entries(ranked, scores, top_k_indices(scores, top_k))})
+
+
+def encode_event(format, event, data):
+    # a line of json with an "event" key, or a server-sent event
+    if format == "sse":
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({'event': event, **data}) + "\n"
+
+
+def stream_ranking(rank_pool, ranked, user_input, xtype, wavelength, paper_filter_iucrid, top_k, min_score, metric,
+                   chunk_size, format):
+    # starts stream_user_input on the rank pool, raising PoolSaturated if it is full, and returns the
+    # async iterator of its encoded events.  Must be called from the event loop
+    loop = asyncio.get_running_loop()
+    events, stopped = asyncio.Queue(), threading.Event()
+
+    def emit(event, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    job = rank_pool.submit(stream_user_input, ranked, user_input, xtype, wavelength, paper_filter_iucrid, top_k,
+                           min_score, metric, chunk_size, emit, stopped)
+    job.add_done_callback(lambda job: events.put_nowait(None))
+
+    async def stream():
+        try:
+            while (item := await events.get()) is not None:
+                yield encode_event(format, *item)
+            if job.exception() is not None:
+                yield encode_event(format, "error", {'detail': f"{type(job.exception()).__name__}: {job.exception()}"})
+        finally:
+            # a client that goes away stops the scoring
+            stopped.set()
+
+    return stream()
+
+
+def pool_saturated():
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="Too many queries are being ranked, please try again later",
+                         headers={"Retry-After": "1"})
@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+
+# environment variables that configure the cache of the arrays held in the remote store
+CACHE_DIR_ENV = "PYDATAREC_ARRAY_CACHE"
+CACHE_BYTES_ENV = "PYDATAREC_ARRAY_CACHE_BYTES"
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "pydatarecognition" / "arrays"
+DEFAULT_CACHE_BYTES = 512 * 2**20
+
+
+class ArrayCache:
+    '''
+    A tiered read-through cache of the numpy arrays held in a remote store.  A lookup is served from
+    an in-memory LRU that is bounded by the bytes of the arrays it holds, then from .npy files in a
+    local directory that expire after a time to live, and only then fetched from the remote store.
+    Fetched arrays are written to both tiers.  The disk tier is written atomically, so processes on
+    the same machine can share it and a restarted process starts warm.
+
+    Attributes
+    ----------
+    fetch : callable
+        Returns the .npy bytes of the array with the given id from the remote store
+    max_bytes : int
+        The largest total size of the arrays in the memory tier
+    cache_dir : pathlib.Path or None
+        The directory of the disk tier.  There is no disk tier if None
+    ttl : float
+        The time in seconds after which a file in the disk tier is fetched again
+    stats : dict
+        The number of memory_hits, disk_hits, misses and evictions from the memory tier
+    '''
+
+    def __init__(self, fetch, max_bytes=DEFAULT_CACHE_BYTES, cache_dir=None, ttl=None):
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.ttl = ttl
+        self.stats = dict(memory_hits=0, disk_hits=0, misses=0, evictions=0)
+        self.nbytes = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._memory)
+
+    def get(self, uid):
+        '''
+        returns the array with the id uid.  The array is shared with the cache and must not be
+        changed in place
+        '''
+        with self._lock:
+            array = self._memory.get(uid)
+            if array is not None:
+                self._memory.move_to_end(uid)
+                self.stats["memory_hits"] += 1
+                return array
+        array = self._read(uid)
+        if array is not None:
+            self._count("disk_hits")
+        else:
+            self._count("misses")
+            data = self.fetch(uid)
+            self._write(uid, data)
+            array = np.load(BytesIO(data))
+        self._remember(uid, array)
+        return array
+
+    def clear(self):
+        '''
+        empties the memory tier.  The disk tier and the counters are kept
+        '''
+        with self._lock:
+            self._memory.clear()
+            self.nbytes = 0
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _remember(self, uid, array):
+        if array.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if uid in self._memory:
+                return
+            self._memory[uid] = array
+            self.nbytes += array.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+
+    def _path(self, uid):
+        return self.cache_dir / f"{uid}.npy"
+
+    def _read(self, uid):
+        if self.cache_dir is None:
+            return None
+        path = self._path(uid)
+        try:
+            if self.ttl is not None and time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            return np.load(path)
+        except (OSError, ValueError):
+            # missing, or being replaced by another process
+            return None
+
+    def _write(self, uid, data):
+        if self.cache_dir is None:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        temp = self.cache_dir / f".{uid}.{uuid.uuid4().hex}.tmp"
+        with open(temp, "wb") as o:
+            o.write(data)
+        os.replace(temp, self._path(uid))
+
+
+def array_cache_from_env(fetch, ttl=None, disk=True):
+    '''
+    returns an ArrayCache of fetch with the directory and the memory budget given by the
+    PYDATAREC_ARRAY_CACHE and PYDATAREC_ARRAY_CACHE_BYTES environment variables.  The disk tier is
+    in ~/.cache/pydatarecognition/arrays unless PYDATAREC_ARRAY_CACHE is set, and is turned off
+    when it is set to an empty string or when disk is False
+    '''
+    cache_dir = (os.environ.get(CACHE_DIR_ENV, str(DEFAULT_CACHE_DIR)) or None) if disk else None
+    max_bytes = os.environ.get(CACHE_BYTES_ENV)
+    return ArrayCache(fetch, int(max_bytes) if max_bytes else DEFAULT_CACHE_BYTES, cache_dir, ttl)
@@ -0,0 +1,188 @@
+import base64
+import binascii
+import hashlib
+import os
+import uuid
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+
+# environment variables that select the store the arrays of serialized cifs are kept in
+ARRAY_STORE_ENV = "PYDATAREC_ARRAY_STORE"
+ARRAY_STORE_DIR_ENV = "PYDATAREC_ARRAY_STORE_DIR"
+DEFAULT_ARRAY_STORE_DIR = Path.home() / ".local" / "share" / "pydatarecognition" / "arrays"
+# inline arrays are base64 encoded .npy files, which always start with this encoding of the magic string
+INLINE_PREFIX = base64.b64encode(b"\x93NUMPY").decode("ascii")
+
+
+def array_to_npy(array):
+    '''
+    returns array as the bytes of a .npy file
+    '''
+    out = BytesIO()
+    np.save(out, np.asarray(array), allow_pickle=False)
+    return out.getvalue()
+
+
+def npy_to_array(data):
+    '''
+    returns the array in the bytes of a .npy file
+    '''
+    return np.load(BytesIO(data), allow_pickle=False)
+
+
+def content_id(data):
+    '''
+    returns the 32 hex digit blake2b digest of data, which identifies an array by its contents
+    '''
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def is_inline(token):
+    '''
+    returns True if token holds an array written by an InlineArrayStore
+    '''
+    return token.startswith(INLINE_PREFIX)
+
+
+def inline_to_array(token):
+    '''
+    returns the array held in a token written by an InlineArrayStore
+    '''
+    try:
+        return npy_to_array(base64.b64decode(token, validate=True))
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"Invalid inline array: {e}")
+
+
+class GCSArrayStore:
+    '''
+    Keeps every array as a blob in a Google Cloud Storage bucket, named by the digest of its
+    contents.  An array that is already in the bucket is not uploaded again, so serializing the same
+    cif twice costs one metadata request per array and the bucket does not grow.  One storage client
+    is created the first time the bucket is used and shared afterwards.
+
+    Attributes
+    ----------
+    bucket_name : str
+        The name of the bucket
+    remote : bool
+        Always True, reads are worth caching on local disk
+    '''
+    remote = True
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            from google.cloud import storage
+            self._bucket = storage.Client().bucket(self.bucket_name)
+        return self._bucket
+
+    def put(self, data):
+        '''
+        uploads the .npy bytes in data unless they are in the bucket already and returns the id of
+        the blob
+        '''
+        uid = content_id(data)
+        blob = self.bucket.blob(uid)
+        # the bucket is asked every time rather than a local record of past uploads, which would go
+        # stale when blobs are deleted behind its back
+        if not blob.exists():
+            blob.upload_from_file(BytesIO(data))
+        return uid
+
+    def fetch(self, uid):
+        '''
+        returns the .npy bytes of the blob with the id uid
+        '''
+        return self.bucket.blob(uid).download_as_bytes()
+
+
+class LocalArrayStore:
+    '''
+    Keeps every array as a .npy file in a local directory, named by the digest of its contents, so
+    that an array that is stored twice is only written once.  The files are spread over
+    subdirectories named by the first two hex digits of the digest.
+
+    Attributes
+    ----------
+    root : pathlib.Path
+        The directory the arrays are kept in
+    remote : bool
+        Always False, reads are served at local disk speed and are not cached on disk again
+    '''
+    remote = False
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, uid):
+        return self.root / uid[:2] / f"{uid}.npy"
+
+    def put(self, data):
+        '''
+        writes the .npy bytes in data unless they are stored already and returns their id
+        '''
+        uid = content_id(data)
+        path = self.path(uid)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp = path.with_name(f".{uid}.{uuid.uuid4().hex}.tmp")
+            with open(temp, "wb") as o:
+                o.write(data)
+            os.replace(temp, path)
+        return uid
+
+    def fetch(self, uid):
+        '''
+        returns the .npy bytes of the array with the id uid
+        '''
+        with open(self.path(uid), "rb") as f:
+            return f.read()
+
+
+class InlineArrayStore:
+    '''
+    Keeps every array inside the document itself, as a base64 encoded .npy file, so serializing
+    a cif needs no storage at all.  Documents are larger, but self-contained.
+
+    Attributes
+    ----------
+    remote : bool
+        Always False, there is nothing to fetch
+    '''
+    remote = False
+
+    def put(self, data):
+        '''
+        returns the .npy bytes in data as an inline token
+        '''
+        return base64.b64encode(data).decode("ascii")
+
+    def fetch(self, uid):
+        raise KeyError(f"Arrays are stored inline, {uid} cannot be fetched")
+
+
+ARRAY_STORES = ["gcs", "local", "inline"]
+
+
+def array_store_from_env(bucket_name):
+    '''
+    returns the array store selected by the PYDATAREC_ARRAY_STORE environment variable, one of
+    ARRAY_STORES.  The default is the Google Cloud Storage bucket called bucket_name.  The local
+    store is kept in PYDATAREC_ARRAY_STORE_DIR, or in ~/.local/share/pydatarecognition/arrays if
+    that is not set
+    '''
+    kind = os.environ.get(ARRAY_STORE_ENV, "gcs").lower()
+    if kind == "gcs":
+        return GCSArrayStore(bucket_name)
+    if kind == "local":
+        return LocalArrayStore(os.environ.get(ARRAY_STORE_DIR_ENV) or DEFAULT_ARRAY_STORE_DIR)
+    if kind == "inline":
+        return InlineArrayStore()
+    raise ValueError(f"Unknown array store {kind}, select from {*ARRAY_STORES,}")
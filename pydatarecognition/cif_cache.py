@@ -0,0 +1,327 @@
+import hashlib
+import json
+import os
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from pydatarecognition.utils import q_range_summary
+
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, where writers are not serialized
+    fcntl = None
+
+PACK_DATA = "patterns.bin"
+PACK_INDEX = "patterns_index.jsonl"
+PACK_LOCK = "patterns.lock"
+PACK_DTYPE = np.float64
+# the pack is rewritten without the superseded arrays once they take up more than this fraction of
+# it and more than this many bytes
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 64 * 2**20
+
+# CifCache objects opened in this process, keyed by cache directory
+_OPEN_CACHES = {}
+
+
+def open_cache(path):
+    '''
+    returns the CifCache for the cache directory at path.  The index of a cache is loaded the first
+    time it is opened in a process and only the records appended since then are read afterwards, so
+    looking up a cif does not scale with the size of the cache.
+
+    Parameters
+    ----------
+    path  pathlib.Path object
+      the cache directory
+
+    Returns
+    -------
+    the CifCache
+    '''
+    key = Path(path).resolve()
+    cache = _OPEN_CACHES.get(key)
+    if cache is None:
+        cache = _OPEN_CACHES[key] = CifCache(key)
+    return cache
+
+
+def file_signature(file_path):
+    '''
+    given a file path, returns the size, modification time and sha256 content hash of the file as a
+    dict that can be stored in a cache record
+    '''
+    stat = os.stat(file_path)
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return dict(size=stat.st_size, mtime=stat.st_mtime_ns, sha256=sha256.hexdigest())
+
+
+class CifCache:
+    '''
+    A pack of the parsed arrays of all the cifs in a directory.  The q and intensity arrays of every
+    cif are appended to one contiguous binary file of floats that is read through np.memmap, so all
+    processes share the page cache and opening the cache does not read any array data.  A compact
+    index with one json record per line holds the offset and lengths of each entry in the pack
+    together with its q-range (qmin, qmax and npoints) and its metadata, such as the size,
+    modification time and content hash of the source cif.  When a cif is cached again, the new
+    record supersedes the old one.  Writers hold an exclusive lock on the cache while they append,
+    so several processes can fill the same cache.  Once superseded arrays take up more than
+    COMPACT_RATIO of the pack, the live arrays are copied to a new pack and the index is replaced by
+    one that points into it.  Use open_cache to share one CifCache per directory within a process.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        The cache directory
+    index : dict
+        The index records keyed by cif file stem
+    pack_name : str
+        The file name of the pack the index points into
+    live : int
+        The number of floats in the pack that belong to the current records
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if not self.path.exists():
+            self.path.mkdir()
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self.index, self.pack_name, self.live = {}, PACK_DATA, 0
+        self._data, self._index_read, self._index_inode = None, 0, None
+
+    def refresh(self):
+        '''
+        reads the index records that were appended since the index was last read, e.g., by another
+        process.  The index is read from scratch if the cache was truncated, removed or compacted
+        '''
+        index_path = self.path / PACK_INDEX
+        try:
+            stat = index_path.stat()
+            size, inode = stat.st_size, stat.st_ino
+        except FileNotFoundError:
+            size, inode = 0, None
+        if size < self._index_read or (self._index_read and inode != self._index_inode):
+            self._reset()
+        if size == self._index_read:
+            return
+        with open(index_path, "rb") as f:
+            f.seek(self._index_read)
+            chunk = f.read(size - self._index_read)
+        # a record that is still being written is picked up by the next refresh
+        complete = chunk.rfind(b"\n") + 1
+        for line in chunk[:complete].splitlines():
+            if line.strip():
+                self._add(json.loads(line))
+        self._index_read += complete
+        self._index_inode = inode
+
+    def _add(self, record):
+        if "stem" not in record:
+            # the header of a compacted index names its pack
+            self.pack_name = record["pack"]
+            return
+        old = self.index.get(record["stem"])
+        if old is not None:
+            self.live -= old["q_length"] + old["intensity_length"]
+        self.live += record["q_length"] + record["intensity_length"]
+        self.index[record["stem"]] = record
+
+    @contextmanager
+    def _locked(self):
+        '''
+        holds an exclusive lock on the cache, and brings the index up to date, while writing
+        '''
+        with open(self.path / PACK_LOCK, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __contains__(self, stem):
+        return stem in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _pack(self, end):
+        '''
+        returns the memory-mapped pack, re-mapping it if it does not reach element end yet
+        '''
+        if self._data is None or len(self._data) < end:
+            self._data = np.memmap(self.path / self.pack_name, dtype=PACK_DTYPE, mode="r")
+        return self._data
+
+    def _arrays(self, record):
+        start, q_length, intensity_length = record["offset"], record["q_length"], record["intensity_length"]
+        end = start + q_length + intensity_length
+        if end == start:
+            return np.array([], dtype=PACK_DTYPE), np.array([], dtype=PACK_DTYPE)
+        data = self._pack(end)
+        return data[start:start + q_length], data[start + q_length:end]
+
+    def get(self, stem):
+        '''
+        given a cif file stem, returns its index record and its q and intensity arrays.  The arrays
+        are read-only views into the memory-mapped pack
+
+        Parameters
+        ----------
+        stem  str
+          the stem of the cif file
+
+        Returns
+        -------
+        record, q, intensity or None if the cif is not in the cache
+        '''
+        record = self.index.get(stem)
+        if record is None:
+            self.refresh()
+            record = self.index.get(stem)
+        if record is None:
+            return None
+        try:
+            return (record, *self._arrays(record))
+        except FileNotFoundError:
+            # the pack was compacted away by another process, the new index points into its successor
+            self.refresh()
+            record = self.index.get(stem)
+            return None if record is None else (record, *self._arrays(record))
+
+    def put(self, stem, q, intensity, **metadata):
+        '''
+        appends the arrays of a cif to the pack and its record to the index
+
+        Parameters
+        ----------
+        stem  str
+          the stem of the cif file
+        q  array_like
+          the q values of the cif
+        intensity  array_like
+          the intensity values of the cif
+        metadata
+          json serializable items that are stored in the index record
+
+        Returns
+        -------
+        the index record
+        '''
+        q = np.asarray(q, dtype=PACK_DTYPE)
+        intensity = np.asarray(intensity, dtype=PACK_DTYPE)
+        self.path.mkdir(exist_ok=True)
+        with self._locked():
+            with open(self.path / self.pack_name, "ab") as o:
+                o.seek(0, os.SEEK_END)
+                offset = o.tell() // PACK_DTYPE().itemsize
+                o.write(q.tobytes() + intensity.tobytes())
+            record = dict(stem=stem, offset=offset, q_length=len(q), intensity_length=len(intensity),
+                          **q_range_summary(q), **metadata)
+            self._append(record)
+            if self.dead_bytes() > max(COMPACT_MIN_BYTES, COMPACT_RATIO * self._pack_bytes()):
+                self._compact()
+        return record
+
+    def put_record(self, record):
+        '''
+        appends a record to the index, superseding any earlier record for the same stem
+        '''
+        with self._locked():
+            self._append(record)
+        return record
+
+    def _append(self, record):
+        with open(self.path / PACK_INDEX, "a") as o:
+            o.write(json.dumps(record) + "\n")
+        self._add(record)
+
+    def _pack_bytes(self):
+        try:
+            return os.path.getsize(self.path / self.pack_name)
+        except FileNotFoundError:
+            return 0
+
+    def dead_bytes(self):
+        '''
+        returns the number of bytes in the pack that no current record points to
+        '''
+        return self._pack_bytes() - self.live * PACK_DTYPE().itemsize
+
+    def compact(self):
+        '''
+        copies the arrays of the current records to a new pack, replaces the index by one that
+        points into it and removes the old pack.  Processes that still map the old pack keep
+        reading it until they refresh their index
+        '''
+        with self._locked():
+            self._compact()
+
+    def _compact(self):
+        name = f"patterns-{uuid.uuid4().hex}.bin"
+        records, offset = [], 0
+        with open(self.path / name, "wb") as o:
+            for record in self.index.values():
+                q, intensity = self._arrays(record)
+                o.write(q.tobytes() + intensity.tobytes())
+                records.append(dict(record, offset=offset))
+                offset += len(q) + len(intensity)
+        temp = self.path / f".{PACK_INDEX}.{uuid.uuid4().hex}.tmp"
+        with open(temp, "w") as o:
+            o.write(json.dumps(dict(pack=name)) + "\n")
+            for record in records:
+                o.write(json.dumps(record) + "\n")
+        old = self.path / self.pack_name
+        os.replace(temp, self.path / PACK_INDEX)
+        self._data = None
+        try:
+            old.unlink()
+        except OSError:
+            # still mapped by a process on windows, or already gone
+            pass
+        self.refresh()
+
+    def is_fresh(self, record, file_path, parser_version):
+        '''
+        checks whether a cache record is still valid for the cif at file_path.  A record is stale when
+        it was written by another parser version or when the content of the cif has changed.  The
+        content hash is only computed when the size matches but the modification time does not, and
+        a record whose cif was merely touched is re-stamped with the new modification time.
+
+        Parameters
+        ----------
+        record  dict
+          the cache record of the cif
+        file_path  pathlib.Path object
+          the path to the cif
+        parser_version  int
+          the current parser version
+
+        Returns
+        -------
+        True if the record can be used, False if the cif must be parsed again
+        '''
+        if record.get("parser_version") != parser_version:
+            return False
+        stat = os.stat(file_path)
+        if record.get("size") != stat.st_size:
+            return False
+        if record.get("mtime") == stat.st_mtime_ns:
+            return True
+        signature = file_signature(file_path)
+        if signature["sha256"] != record.get("sha256"):
+            return False
+        self.put_record(dict(record, **signature))
+        return True
@@ -1,17 +1,176 @@
 import os
+import re
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+from pathlib import Path
 import numpy as np
 import CifFile
+from skbeam.core.utils import q_to_twotheta
 from diffpy.utils.parsers.loaddata import loadData
 from pydatarecognition.powdercif import PydanticPowderCif
+from pydatarecognition.cif_cache import open_cache, file_signature
+from pydatarecognition.utils import parse_cif_numbers
 import json
 
 DEG = "deg"
+# bump whenever the parsing rules change, so that cached cifs are parsed again
+PARSER_VERSION = 1
+SKIP_REPORTS = ["no_twotheta.txt", "no_intensity.txt", "no_wavelength.txt", "failed.txt"]
+TWOTHETA_KEYS = ['_pd_meas_2theta_corrected',
+                 '_pd_meas_2theta_scan',
+                 '_pd_meas_2theta_range',
+                 '_pd_proc_2theta_corrected',
+                 '_pd_proc_2theta_range_',
+                 ]
+TWOTHETA_MIN_KEYS = ['_pd_meas_2theta_range_min',
+                     '_pd_proc_2theta_range_min',
+                     ]
+TWOTHETA_MAX_KEYS = ['_pd_meas_2theta_range_max',
+                     '_pd_proc_2theta_range_max',
+                     ]
+TWOTHETA_INC_KEYS = ['_pd_meas_2theta_range_inc',
+                     '_pd_proc_2theta_range_inc',
+                     ]
+INTENSITY_KEYS = ['_pd_meas_counts_total',
+                  '_pd_meas_intensity_total',
+                  '_pd_meas_intensity_net',
+                  '_pd_meas_intensity_total_su',
+                  '_pd_proc_intensity_total',
+                  '_pd_proc_intensity_net',
+                  '_pd_proc_intensity_total_su',
+                  '_pd_proc_intensity_net_su',
+                  '_pd_proc_intensity_bkg_calc',
+                  '_pd_proc_intensity_bkg_fix',
+                  '_pd_calc_intensity_total',
+                  '_pd_calc_intensity_net',
+                  ]
+WAVELENGTH_KEY = '_diffrn_radiation_wavelength'
+CIF_READ_TAGS = set(TWOTHETA_KEYS + TWOTHETA_MIN_KEYS + TWOTHETA_MAX_KEYS + TWOTHETA_INC_KEYS
+                    + INTENSITY_KEYS + [WAVELENGTH_KEY])
+
+# one cif token: a semicolon text field, a quoted string, a comment or a bare word
+_CIF_TOKEN = re.compile(r"""(?s:^;(.*?)\n;)|'(.*?)'(?=\s|\Z)|"(.*?)"(?=\s|\Z)|\#[^\n]*|(\S+)""", re.M)
+_TEXT_FIELD, _BARE_WORD = 1, 4
+
+
+class _FastReadError(Exception):
+    pass
+
+
+def _fast_cif_read(cif_file_path, tags):
+    '''
+    given a cif file-path, scans the cif once and returns only the items with the given tags.  This
+    avoids building the full data model that PyCIFRW creates for every data block.  Values are
+    returned as PyCIFRW returns them: strings for single items and lists of strings for looped
+    items.
 
+    Parameters
+    ----------
+    cif_file_path  pathlib.Path object
+      the path to a valid cif file
+    tags  set of str
+      the lower case tags to extract
 
-def cif_read(cif_file_path, verbose=None):
+    Returns
+    -------
+    dict of the data blocks in file order, each a dict of the wanted items it contains keyed by lower
+    case tag, or None if the file uses a construct this reader does not handle, e.g. save frames,
+    global blocks, CIF2 syntax or malformed loops.  Use PyCIFRW for those.
     '''
-    given a cif file-path, reads the cif and returns the cif data
-    
+    with open(cif_file_path, "r") as fs:
+        text = fs.read()
+    if text.startswith("#\\#CIF_2.0"):
+        return None
+    try:
+        return _scan_cif(text, tags)
+    except _FastReadError:
+        return None
+
+
+def _scan_cif(text, tags):
+    blocks, block = {}, None
+    # state is None between items, "value" after a single item tag, "tags" while reading the tags of
+    # a loop and "loop" while reading loop values
+    state, item_tag, loop_tags, loop_values, keep = None, None, [], [], False
+
+    def end_loop():
+        if not loop_tags or len(loop_values) % len(loop_tags):
+            raise _FastReadError("malformed loop")
+        if keep:
+            for i, tag in enumerate(loop_tags):
+                if tag in tags:
+                    if tag in block:
+                        raise _FastReadError(f"duplicate item {tag}")
+                    block[tag] = loop_values[i::len(loop_tags)]
+
+    for token in _CIF_TOKEN.finditer(text):
+        kind = token.lastindex
+        if kind is None:
+            continue
+        value = token.group(kind)
+        if kind == _BARE_WORD:
+            first = value[0]
+            if first == "_":
+                tag = value.lower()
+                if state == "tags":
+                    loop_tags.append(tag)
+                    keep = keep or tag in tags
+                    continue
+                if state == "value" or block is None:
+                    raise _FastReadError(f"unexpected tag {tag}")
+                if state == "loop":
+                    end_loop()
+                state, item_tag = "value", tag
+                continue
+            if first in "dDlLsSgG":
+                keyword = value.lower()
+                if keyword.startswith("data_") or keyword == "loop_":
+                    if state == "value" or state == "tags":
+                        raise _FastReadError(f"unexpected {keyword}")
+                    if state == "loop":
+                        end_loop()
+                    if keyword == "loop_":
+                        if block is None:
+                            raise _FastReadError("loop outside of a data block")
+                        state, loop_tags, loop_values, keep = "tags", [], [], False
+                    else:
+                        name = keyword[5:]
+                        if name in blocks:
+                            raise _FastReadError(f"duplicate data block {name}")
+                        state, block = None, {}
+                        blocks[name] = block
+                    continue
+                if keyword.startswith("save_") or keyword in ("global_", "stop_"):
+                    raise _FastReadError(f"unsupported {keyword}")
+        if state == "loop":
+            if keep:
+                loop_values.append(value)
+            else:
+                loop_values.append(None)
+        elif state == "tags":
+            state = "loop"
+            loop_values.append(value if keep else None)
+        elif state == "value":
+            if item_tag in tags:
+                if item_tag in block:
+                    raise _FastReadError(f"duplicate item {item_tag}")
+                block[item_tag] = value
+            state = None
+        else:
+            raise _FastReadError("value without a tag")
+    if state == "loop":
+        end_loop()
+    elif state is not None:
+        raise _FastReadError("unexpected end of file")
+    return blocks
+
+
+def _cif_parse(cif_file_path):
+    '''
+    given a cif file-path, parses the powder pattern and wavelength from the cif.  Nothing is
+    written, so it is safe to run in worker processes.
+
     Parameters
     ----------
     cif_file_path  pathlib.Path object
@@ -19,193 +178,394 @@ def cif_read(cif_file_path, verbose=None):
 
     Returns
     -------
-    the cif data as a pydatarecognition.powdercif.PowderCif object
+    po  pydatarecognition.powdercif.PydanticPowderCif object
+      the cif data
+    reports  tuple of str
+      the entries for the no_twotheta, no_intensity and no_wavelength skip reports
     '''
-    if not verbose:
-        verbose = False
-    outputdir = cif_file_path.parent.parent / "_output"
-    if not outputdir.exists():
-        outputdir.mkdir()
-    cache = cif_file_path.parent / "_cache"
-    if not cache.exists():
-        cache.mkdir()
-        with open(outputdir / "no_twotheta.txt", mode="w") as o:
-            o.write('')
-        with open(outputdir / "no_intensity.txt", mode="w") as o:
-            o.write('')
-        with open(outputdir / "no_wavelength.txt", mode="w") as o:
-            o.write('')
-    acache = cache / f"{cif_file_path.stem}.npy"
-    mcache = cache / f"{cif_file_path.stem}.json"
-    cachegen = cache.glob("*.npy")
-    index = list(set([file.stem for file in cachegen]))
     no_twotheta, no_intensity, no_wavelength = '', '', ''
-    if cif_file_path.stem in index:
-        if verbose:
-            print("Getting from Cache")
-        qi = np.load(acache, allow_pickle=True)
-        q = qi[0]
-        intensity = qi[1]
-        po = PydanticPowderCif.parse_file(mcache)
-        po.q, po.intensity, po.cif_file_name = q, intensity, cif_file_path.stem
-    else:
-        if verbose:
-            print("Getting from Cif File")
+    cifdata = _fast_cif_read(cif_file_path, CIF_READ_TAGS)
+    if cifdata is None:
         with open(cif_file_path, "r") as fs:
             cifdata = CifFile.ReadCif(fs)
-        cifdata_keys = cifdata.keys()
-        twotheta_keys = ['_pd_meas_2theta_corrected',
-                         '_pd_meas_2theta_scan',
-                         '_pd_meas_2theta_range',
-                         '_pd_proc_2theta_corrected',
-                         '_pd_proc_2theta_range_',
-                         ]
-        twotheta_min_keys = ['_pd_meas_2theta_range_min',
-                             '_pd_proc_2theta_range_min',
-                             ]
-        twotheta_max_keys = ['_pd_meas_2theta_range_max',
-                             '_pd_proc_2theta_range_max',
-                             ]
-        twotheta_inc_keys = ['_pd_meas_2theta_range_inc',
-                             '_pd_proc_2theta_range_inc',
-                             ]
-        intensity_keys = ['_pd_meas_counts_total',
-                          '_pd_meas_intensity_total',
-                          '_pd_meas_intensity_net',
-                          '_pd_meas_intensity_total_su',
-                          '_pd_proc_intensity_total',
-                          '_pd_proc_intensity_net',
-                          '_pd_proc_intensity_total_su',
-                          '_pd_proc_intensity_net_su',
-                          '_pd_proc_intensity_bkg_calc',
-                          '_pd_proc_intensity_bkg_fix',
-                          '_pd_calc_intensity_total',
-                          '_pd_calc_intensity_net',
-                          ]
-        cif_twotheta, cif_intensity, cif_twotheta_min, cif_twotheta_max, twotheta_inc = None, None, None, None, None
+    cifdata_keys = cifdata.keys()
+    cif_twotheta, cif_intensity, cif_twotheta_min, cif_twotheta_max, twotheta_inc = None, None, None, None, None
+    for k in cifdata_keys:
+        for ttkey in TWOTHETA_KEYS:
+            try:
+                cif_twotheta = parse_cif_numbers(cifdata[k][ttkey])[0]
+            except KeyError:
+                pass
+            if cif_twotheta is not None:
+                break
+        for intkey in INTENSITY_KEYS:
+            try:
+                cif_intensity, _, valid = parse_cif_numbers(cifdata[k][intkey])
+                # drop the points that the cif leaves undetermined
+                if cif_twotheta is not None and len(cif_twotheta) == len(valid):
+                    valid &= ~np.isnan(cif_twotheta)
+                    cif_twotheta = cif_twotheta[valid]
+                cif_intensity = cif_intensity[valid]
+            except KeyError:
+                pass
+            if not isinstance(cif_intensity, type(None)):
+                break
+    if isinstance(cif_twotheta, type(None)) and not isinstance(cif_intensity, type(None)):
         for k in cifdata_keys:
-            for ttkey in twotheta_keys:
+            for ttminkey in TWOTHETA_MIN_KEYS:
                 try:
-                    cif_twotheta = np.char.split(cifdata[k][ttkey], '(')
-                    cif_twotheta = np.array([float(e[0]) for e in cif_twotheta])
+                    cif_twotheta_min = cifdata[k][ttminkey].split("(")[0]
+                    try:
+                        cif_twotheta_min = float(cif_twotheta_min)
+                        break
+                    except ValueError:
+                        cif_twotheta_min = None
+                        pass
                 except KeyError:
                     pass
-                if cif_twotheta is not None:
-                    break
-            for intkey in intensity_keys:
+            for ttmaxkey in TWOTHETA_MAX_KEYS:
                 try:
-                    cif_intensity = np.char.split(cifdata[k][intkey], '(')
-                    cif_intensity = np.array([e[0] for e in cif_intensity])
-                    for e in [',', '.', '?', '-']:
-                        while cif_intensity[-1] == e:
-                            cif_intensity = np.delete(cif_intensity, -1)
-                            if cif_twotheta is not None:
-                                cif_twotheta = np.delete(cif_twotheta, -1)
-                    for i in range(len(cif_intensity)-1, -1, -1):
-                        for e in [',', '.', '?', '-']:
-                            if cif_intensity[i] == e:
-                                cif_intensity = np.delete(cif_intensity, i)
-                                if cif_twotheta is not None:
-                                    cif_twotheta = np.delete(cif_twotheta, i)
-                except KeyError:
-                    pass
-                if not isinstance(cif_intensity, type(None)):
-                    break
-        if isinstance(cif_twotheta, type(None)) and not isinstance(cif_intensity, type(None)):
-            for k in cifdata_keys:
-                for ttminkey in twotheta_min_keys:
-                    try:
-                        cif_twotheta_min = cifdata[k][ttminkey].split("(")[0]
-                        try:
-                            cif_twotheta_min = float(cif_twotheta_min)
-                            break
-                        except ValueError:
-                            cif_twotheta_min = None
-                            pass
-                    except KeyError:
-                        pass
-                for ttmaxkey in twotheta_max_keys:
+                    cif_twotheta_max = cifdata[k][ttmaxkey].split("(")[0]
                     try:
-                        cif_twotheta_max = cifdata[k][ttmaxkey].split("(")[0]
-                        try:
-                            cif_twotheta_max = float(cif_twotheta_max)
-                            break
-                        except ValueError:
-                            cif_twotheta_max = None
-                            pass
-                    except KeyError:
+                        cif_twotheta_max = float(cif_twotheta_max)
+                        break
+                    except ValueError:
+                        cif_twotheta_max = None
                         pass
-                for ttinckey in twotheta_inc_keys:
+                except KeyError:
+                    pass
+            for ttinckey in TWOTHETA_INC_KEYS:
+                try:
+                    cif_twotheta_inc = cifdata[k][ttinckey].split("(")[0]
                     try:
-                        cif_twotheta_inc = cifdata[k][ttinckey].split("(")[0]
-                        try:
-                            cif_twotheta_inc = float(cif_twotheta_inc)
-                            break
-                        except ValueError:
-                            cif_twotheta_inc = None
-                            pass
-                    except KeyError:
+                        cif_twotheta_inc = float(cif_twotheta_inc)
+                        break
+                    except ValueError:
+                        cif_twotheta_inc = None
                         pass
-                # if not isinstance(cif_twotheta_min, type(None)) and not isinstance(cif_twotheta_max, type(None)):
-                    # print(f"{cif_file_path.name}".upper())
-                    # cif_twotheta = np.linspace(cif_twotheta_min, cif_twotheta_max, len(cif_intensity),
-                    #                            endpoint=True)
-                if cif_twotheta_min and cif_twotheta_max and cif_twotheta_inc:
-                    cif_twotheta = np.arange(cif_twotheta_min, cif_twotheta_max, cif_twotheta_inc)
-                    if len(cif_intensity) - len(cif_twotheta) == 0:
-                        pass
-                    elif len(cif_intensity) - len(cif_twotheta) == 1:
-                        cif_intensity = cif_intensity[0:-1]
-                    elif len(cif_intensity) - len(cif_twotheta) == 2:
-                        cif_intensity = cif_intensity[1:-1]
-                    else:
-                        cif_twotheta = None
-        if isinstance(cif_twotheta, type(None)):
-            no_twotheta += f"{cif_file_path.name}\n"
-        if isinstance(cif_intensity, type(None)):
-            no_intensity += f"{cif_file_path.name}\n"
-        for key in cifdata_keys:
-            wavelength_kwargs = {}
-            #ZT Question: why isn't this _pd_proc_wavelength rather than _diffrn_radiation_wavelength?
-            cif_wavelength = cifdata[key].get('_diffrn_radiation_wavelength')
-            if isinstance(cif_wavelength, list):
-                # FIXME Problem when wavelength is stated as an interval. (eg. '1.24-5.36' in fa3079Isup2.rtv.combined)
-                try:
-                    wavelength_kwargs['wavelength'] = float(cif_wavelength[0].split("(")[0]) # FIXME Handle lists
-                    wavelength_kwargs['wavel_units'] = "ang"
-                    break # FIXME Don't just go with first instance of wavelength.
-                except ValueError:
-                    wavelength_kwargs['wavelength'] = None
+                except KeyError:
+                    pass
+            # if not isinstance(cif_twotheta_min, type(None)) and not isinstance(cif_twotheta_max, type(None)):
+                # print(f"{cif_file_path.name}".upper())
+                # cif_twotheta = np.linspace(cif_twotheta_min, cif_twotheta_max, len(cif_intensity),
+                #                            endpoint=True)
+            if cif_twotheta_min and cif_twotheta_max and cif_twotheta_inc:
+                cif_twotheta = np.arange(cif_twotheta_min, cif_twotheta_max, cif_twotheta_inc)
+                if len(cif_intensity) - len(cif_twotheta) == 0:
+                    pass
+                elif len(cif_intensity) - len(cif_twotheta) == 1:
+                    cif_intensity = cif_intensity[0:-1]
+                elif len(cif_intensity) - len(cif_twotheta) == 2:
+                    cif_intensity = cif_intensity[1:-1]
+                else:
+                    cif_twotheta = None
+    if isinstance(cif_twotheta, type(None)):
+        no_twotheta += f"{cif_file_path.name}\n"
+    if isinstance(cif_intensity, type(None)):
+        no_intensity += f"{cif_file_path.name}\n"
+    for key in cifdata_keys:
+        wavelength_kwargs = {}
+        #ZT Question: why isn't this _pd_proc_wavelength rather than _diffrn_radiation_wavelength?
+        cif_wavelength = cifdata[key].get(WAVELENGTH_KEY)
+        if isinstance(cif_wavelength, list):
+            # FIXME Problem when wavelength is stated as an interval. (eg. '1.24-5.36' in fa3079Isup2.rtv.combined)
+            try:
+                wavelength_kwargs['wavelength'] = float(cif_wavelength[0].split("(")[0]) # FIXME Handle lists
+                wavelength_kwargs['wavel_units'] = "ang"
+                break # FIXME Don't just go with first instance of wavelength.
+            except ValueError:
+                wavelength_kwargs['wavelength'] = None
+                break
+        elif isinstance(cif_wavelength, str):
+            # FIXME Problem when wavelength is stated as an interval. (eg. '1.24-5.36' in fa3079Isup2.rtv.combined)
+            try:
+                wavelength_kwargs['wavelength'] = float(cif_wavelength.split("(")[0])
+                wavelength_kwargs['wavel_units'] = "ang"
+                break
+            except ValueError:
+                wavelength_kwargs['wavelength'] = None
+                break # FIXME Don't just go with first instance of wavelength.
+        else:
+            pass
+    if not cif_wavelength:
+        wavelength_kwargs['wavelength'] = None
+        no_wavelength += f"{cif_file_path.name}\n"
+    po = PydanticPowderCif(cif_file_path.stem[0:6],
+                   DEG, cif_twotheta, cif_intensity, cif_file_path=cif_file_path.stem,
+                   **wavelength_kwargs
+                   )
+
+    return po, (no_twotheta, no_intensity, no_wavelength)
+
+
+def _parse_for_cache(cif_file_path):
+    '''
+    parses a cif and returns what is needed to cache it as plain arrays and builtins, so that only
+    compact data travel back from worker processes
+    '''
+    po, reports = _cif_parse(cif_file_path)
+    metadata = dict(iucrid=po.iucrid, wavelength=po.wavelength, id=str(po.id))
+    return np.asarray(po.q, dtype=float), np.asarray(po.intensity, dtype=float), metadata, reports
+
+
+def _write_reports(outputdir, reports):
+    '''
+    appends the skip report entries returned by _cif_parse to the reports in outputdir
+    '''
+    for name, report in zip(SKIP_REPORTS, reports):
+        if report:
+            with open(outputdir / name, mode="a") as o:
+                o.write(report)
+
+
+def _cache_put(cif_cache, cif_file_path, q, intensity, metadata):
+    '''
+    stores the parsed arrays of a cif in the cache, stamped with the source file signature and the
+    parser version
+    '''
+    return cif_cache.put(cif_file_path.stem, q, intensity, parser_version=PARSER_VERSION,
+                         **metadata, **file_signature(cif_file_path))
+
+
+def _prepare_dirs(cif_dir):
+    '''
+    creates the _output directory next to cif_dir and the _cache directory inside it, starting
+    empty skip reports along with a new cache
+
+    Returns
+    -------
+    the output directory and the CifCache of cif_dir
+    '''
+    outputdir = cif_dir.parent / "_output"
+    if not outputdir.exists():
+        outputdir.mkdir()
+    cache = cif_dir / "_cache"
+    if not cache.exists():
+        cache.mkdir()
+        for name in SKIP_REPORTS:
+            with open(outputdir / name, mode="w") as o:
+                o.write('')
+    return outputdir, open_cache(cache)
+
+
+def _parse_worker(conn):
+    '''
+    the loop of a worker process: parses the cif paths received on conn until it receives None and
+    sends back ("ok", result of _parse_for_cache) or ("error", message) for each
+    '''
+    while True:
+        cif_file_path = conn.recv()
+        if cif_file_path is None:
+            break
+        try:
+            conn.send(("ok", _parse_for_cache(cif_file_path)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def _parse_in_pool(cif_file_paths, jobs, timeout=None):
+    '''
+    parses cifs in a pool of worker processes and yields the results in the order of
+    cif_file_paths.  A worker that exceeds the timeout on a cif is killed and replaced, as is a
+    worker that dies, so a pathological cif only fails itself.
+
+    Parameters
+    ----------
+    cif_file_paths  list of pathlib.Path objects
+      the cifs to parse
+    jobs  int
+      the number of worker processes
+    timeout  float (optional)
+      the time in seconds a worker may spend on one cif.  No limit if None
+
+    Yields
+    ------
+    the cif path, ("ok", result of _parse_for_cache) or ("error", message)
+    '''
+    idle, busy, results = [], {}, {}
+    todo = iter(enumerate(cif_file_paths))
+    next_result = 0
+
+    def start_worker():
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_parse_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def stop_worker(process, conn):
+        process.kill()
+        process.join()
+        conn.close()
+
+    try:
+        while next_result < len(cif_file_paths):
+            while len(busy) < jobs:
+                task = next(todo, None)
+                if task is None:
                     break
-            elif isinstance(cif_wavelength, str):
-                # FIXME Problem when wavelength is stated as an interval. (eg. '1.24-5.36' in fa3079Isup2.rtv.combined)
+                process, conn = idle.pop() if idle else start_worker()
+                conn.send(task[1])
+                deadline = None if timeout is None else time.monotonic() + timeout
+                busy[conn] = (process, task[0], deadline)
+            deadlines = [deadline for _, _, deadline in busy.values() if deadline is not None]
+            wait_time = max(0., min(deadlines) - time.monotonic()) if deadlines else None
+            for conn in wait(list(busy), wait_time):
+                process, i, _ = busy.pop(conn)
                 try:
-                    wavelength_kwargs['wavelength'] = float(cif_wavelength.split("(")[0])
-                    wavelength_kwargs['wavel_units'] = "ang"
-                    break
-                except ValueError:
-                    wavelength_kwargs['wavelength'] = None
-                    break # FIXME Don't just go with first instance of wavelength.
-            else:
-                pass
-        if not cif_wavelength:
-            wavelength_kwargs['wavelength'] = None
-            no_wavelength += f"{cif_file_path.name}\n"
-        po = PydanticPowderCif(cif_file_path.stem[0:6],
-                       DEG, cif_twotheta, cif_intensity, cif_file_path=cif_file_path.stem,
-                       **wavelength_kwargs
-                       )
-        with open(outputdir / "no_twotheta.txt", mode="a") as o:
-            o.write(no_twotheta)
-        with open(outputdir / "no_intensity.txt", mode="a") as o:
-            o.write(no_intensity)
-        with open(outputdir / "no_wavelength.txt", mode="a") as o:
-            o.write(no_wavelength)
-    #TODO serialize all as json rather than npy save and see if how the cache speed compares
-    with open(acache, "wb") as o:
-        np.save(o, np.array([po.q, po.intensity]))
-    with open(mcache, "w") as o:
-        o.write(po.json(include={'iucrid', 'wavelength', 'id'}))
+                    results[i] = conn.recv()
+                    idle.append((process, conn))
+                except EOFError:
+                    stop_worker(process, conn)
+                    results[i] = ("error", f"worker process died with exit code {process.exitcode}")
+            now = time.monotonic()
+            for conn, (process, i, deadline) in list(busy.items()):
+                if deadline is not None and now >= deadline:
+                    del busy[conn]
+                    stop_worker(process, conn)
+                    results[i] = ("timeout", f"timed out after {timeout:g} s")
+            while next_result in results:
+                yield cif_file_paths[next_result], results.pop(next_result)
+                next_result += 1
+    finally:
+        for process, conn in idle:
+            conn.send(None)
+            conn.close()
+            process.join()
+        for conn, (process, _, _) in busy.items():
+            stop_worker(process, conn)
+
+
+def _parse_in_process(cif_file_paths):
+    '''
+    parses cifs one after the other in this process, yielding the same results as _parse_in_pool
+    '''
+    for cif_file_path in cif_file_paths:
+        try:
+            yield cif_file_path, ("ok", _parse_for_cache(cif_file_path))
+        except Exception as e:
+            yield cif_file_path, ("error", f"{type(e).__name__}: {e}")
+
+
+def refresh_cache(cif_dir, jobs=None, timeout=None):
+    '''
+    parses again only the cifs in cif_dir that are missing from the cache or whose cache entries
+    are stale because the cif was edited or the parser version changed.  The cifs are parsed in a
+    pool of worker processes and the results are written to the cache and the skip reports in
+    file name order, so the outcome does not depend on the number of workers.
+
+    A cif that raises, crashes its worker or exceeds the timeout is cached as a failure and listed
+    in the failed.txt skip report.  It is not parsed again until it changes, the parser version
+    changes or, for a timeout, a longer timeout is given.
+
+    Parameters
+    ----------
+    cif_dir  pathlib.Path object
+      the directory containing the cifs
+    jobs  int (optional)
+      the number of worker processes.  Defaults to the number of processors.  With 1 and no timeout
+      the cifs are parsed in this process
+    timeout  float (optional)
+      the time in seconds that parsing one cif may take.  No limit if None
+
+    Returns
+    -------
+    the list of paths of the cifs that were parsed and the list of (path, error message) of the
+    cifs that failed
+    '''
+    cif_dir = Path(cif_dir)
+    outputdir, cif_cache = _prepare_dirs(cif_dir)
+    stale = []
+    for ciffile in sorted(cif_dir.glob("*.cif")):
+        cached = cif_cache.get(ciffile.stem)
+        if (cached is None or not cif_cache.is_fresh(cached[0], ciffile, PARSER_VERSION)
+                or _retry_timeout(cached[0], timeout)):
+            stale.append(ciffile)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if timeout is None and (jobs == 1 or len(stale) < 2):
+        parsed = _parse_in_process(stale)
+    else:
+        parsed = _parse_in_pool(stale, min(jobs, len(stale)), timeout)
+    failed = []
+    for ciffile, (status, result) in parsed:
+        if status == "ok":
+            q, intensity, metadata, reports = result
+            _write_reports(outputdir, reports)
+            _cache_put(cif_cache, ciffile, q, intensity, metadata)
+        else:
+            failed.append((ciffile, result))
+            _write_reports(outputdir, ("", "", "", f"{ciffile.name}\n"))
+            metadata = dict(iucrid=ciffile.stem[0:6], error=result)
+            if status == "timeout":
+                metadata["timeout"] = timeout
+            _cache_put(cif_cache, ciffile, [], [], metadata)
+    return stale, failed
+
+
+def _retry_timeout(record, timeout):
+    '''
+    returns True if the cif of a record that timed out should be tried again with timeout
+    '''
+    if "timeout" not in record:
+        return False
+    return timeout is None or timeout > record["timeout"]
+
+
+def cache_signatures(cif_dir):
+    '''
+    returns the signature of the cache record of every cif in cif_dir, keyed by cif file stem.  The
+    signature of a cif changes whenever it is edited or parsed by another parser version, so data
+    derived from the cache can be checked against it cif by cif
+    '''
+    cif_dir = Path(cif_dir)
+    cif_cache = open_cache(cif_dir / "_cache")
+    signatures = {}
+    for ciffile in sorted(cif_dir.glob("*.cif")):
+        record = cif_cache.index.get(ciffile.stem, {})
+        signatures[ciffile.stem] = f"{record.get('sha256')} {record.get('parser_version')} {record.get('error')}"
+    return signatures
+
+
+def cif_read(cif_file_path, verbose=None):
+    '''
+    given a cif file-path, reads the cif and returns the cif data
+    
+    Parameters
+    ----------
+    cif_file_path  pathlib.Path object
+      the path to a valid cif file
+
+    Returns
+    -------
+    the cif data as a pydatarecognition.powdercif.PowderCif object
+
+    Raises
+    ------
+    RuntimeError
+      if refresh_cache found that the cif cannot be parsed
+    '''
+    if not verbose:
+        verbose = False
+    outputdir, cif_cache = _prepare_dirs(cif_file_path.parent)
+    cached = cif_cache.get(cif_file_path.stem)
+    if cached is not None and cif_cache.is_fresh(cached[0], cif_file_path, PARSER_VERSION):
+        if verbose:
+            print("Getting from Cache")
+        record, q, intensity = cached
+        if "error" in record:
+            raise RuntimeError(f"{cif_file_path.name} could not be parsed: {record['error']}")
+        po = PydanticPowderCif(iucrid=record['iucrid'], wavelength=record['wavelength'], id=record['id'],
+                               q=q, intensity=intensity, cif_file_name=cif_file_path.stem)
+        if po.wavelength and len(q) > 0:
+            po.ttheta = q_to_twotheta(po.q, po.wavelength)
+    else:
+        if verbose:
+            print("Getting from Cif File")
+        po, reports = _cif_parse(cif_file_path)
+        _write_reports(outputdir, reports)
+        _cache_put(cif_cache, cif_file_path, po.q, po.intensity,
+                   dict(iucrid=po.iucrid, wavelength=po.wavelength, id=str(po.id)))
 
     return po
 
@@ -0,0 +1,806 @@
+from pathlib import Path
+
+import numpy as np
+
+from pydatarecognition.cif_io import cif_read, refresh_cache, cache_signatures
+from pydatarecognition.utils import SIMILARITY_METRICS, correlate, pearson_from_sums
+
+# smallest overlapping q-range (inverse nm) that is scored, as in utils.xy_resample
+MIN_QRANGE_OVERLAP = 20
+# q-grid intervals (inverse nm) that are pre-gridded whenever the library is ingested
+QGRID_INTERVALS = [0.001, 0.002, 0.005, 0.01]
+# the most grid points in a slice of rows, which is scored against user patterns at once
+BLOCK_SIZE = 2**21
+# the smallest share of the grid points of a slice of rows that hold values, the rest is zero padding
+MIN_SLICE_FILL = 0.5
+# the most grid points of user patterns, and so of each of their three work arrays, that are scored at once
+USER_BLOCK_SIZE = 2**22
+
+
+def canonical_qgrid(qmin, qmax, q_step):
+    '''
+    given a q-range and a step size, returns the regular q-grid on integer multiples of the step
+    that covers the range. Every pattern that is put on a grid with the same step therefore shares
+    its grid points with every other pattern.
+
+    Parameters
+    ----------
+    qmin  float
+      the lower end of the q-range that must be covered
+    qmax  float
+      the upper end of the q-range that must be covered
+    q_step  float (non-zero and positive)
+      the step size of the regular q-grid
+
+    Returns
+    -------
+    the regular q-grid as a numpy array
+    '''
+    first = int(np.floor(qmin / q_step))
+    last = int(np.ceil(qmax / q_step))
+    return np.arange(first, last + 1) * q_step
+
+
+def grid_pattern(q, intensity, q_grid):
+    '''
+    given a pattern and a regular q-grid, linearly interpolates the pattern onto the grid points
+    that fall inside the q-range of the pattern
+
+    Parameters
+    ----------
+    q  array_like
+      the q values of the pattern
+    intensity  array_like
+      the intensity values of the pattern
+    q_grid  numpy array
+      the regular q-grid
+
+    Returns
+    -------
+    values  numpy array
+      the resampled intensities on the whole grid.  Grid points outside the q-range of the pattern
+      are zero
+    lo  int
+      index of the first grid point inside the q-range of the pattern
+    hi  int
+      index one past the last grid point inside the q-range of the pattern
+    '''
+    span, lo, hi = grid_span(q, intensity, q_grid)
+    values = np.zeros(len(q_grid))
+    values[lo:hi] = span
+    return values, lo, hi
+
+
+def grid_span(q, intensity, q_grid):
+    '''
+    given a pattern and a regular q-grid, linearly interpolates the pattern onto the grid points
+    that fall inside the q-range of the pattern, as grid_pattern does, but returns only those
+
+    Returns
+    -------
+    the resampled intensities on q_grid[lo:hi], and lo and hi
+    '''
+    q, intensity = np.asarray(q, dtype=float), np.asarray(intensity, dtype=float)
+    if np.any(np.diff(q) < 0):
+        order = np.argsort(q, kind='stable')
+        q, intensity = q[order], intensity[order]
+    lo = int(np.searchsorted(q_grid, q[0], side='left'))
+    hi = int(np.searchsorted(q_grid, q[-1], side='right'))
+    return np.interp(q_grid[lo:hi], q, intensity), lo, hi
+
+
+def _standardize(values, lo, hi):
+    '''
+    shifts and scales values[lo:hi] in place to zero mean and unit standard deviation.  Pearson
+    coefficients are invariant under this, and it keeps the moment sums used for scoring well
+    conditioned
+    '''
+    window = values[lo:hi]
+    if hi - lo > 0:
+        window -= window.mean()
+        std = window.std()
+        if std > 0:
+            window /= std
+    return values
+
+
+def _prefix_sums(values):
+    '''
+    returns the prefix sums along the last axis of values with a leading zero, so that the sum over
+    the window [lo, hi) is prefix[..., hi] - prefix[..., lo]
+    '''
+    prefix = np.zeros(values.shape[:-1] + (values.shape[-1] + 1,))
+    np.cumsum(values, axis=-1, out=prefix[..., 1:])
+    return prefix
+
+
+class _Slice:
+    '''
+    A run of consecutive rows of a PatternLibrary laid out on the grid columns they cover together.
+    Each row is zero outside the q-range of its pattern.  The prefix sums of every row and of its
+    squares are kept along with the values.  A slice is never changed once it is built, so copies
+    of a library share their slices.
+
+    Attributes
+    ----------
+    column : int
+        The grid index of the first column of the slice, counted from q = 0
+    values : numpy array
+        The standardized intensities of the rows, one row per pattern
+    cumsum : numpy array
+        The prefix sums of each row of values, with a leading zero column
+    cumsum_sq : numpy array
+        The prefix sums of each row of values squared, with a leading zero column
+    '''
+
+    def __init__(self, column, values, cumsum=None, cumsum_sq=None):
+        self.column = column
+        self.values = values
+        self.cumsum = _prefix_sums(values) if cumsum is None else cumsum
+        self.cumsum_sq = _prefix_sums(values * values) if cumsum_sq is None else cumsum_sq
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def width(self):
+        return self.values.shape[1]
+
+    @classmethod
+    def from_rows(cls, spans, lo, hi):
+        '''
+        builds a slice from the values of rows on the grid columns [lo, hi), counted from q = 0
+        '''
+        column = min(lo)
+        values = np.zeros((len(spans), max(hi) - column))
+        for k, span in enumerate(spans):
+            values[k, lo[k] - column:hi[k] - column] = span
+        return cls(column, values)
+
+
+def _pack(spans, lo, hi):
+    '''
+    lays consecutive rows out in slices.  A slice spans at most BLOCK_SIZE grid points, or is a
+    single row, and at least MIN_SLICE_FILL of its grid points hold values of its rows.  lo and hi
+    are lists of the grid columns of the rows, counted from q = 0
+    '''
+    slices, start = [], 0
+    while start < len(spans):
+        stop, a, b, filled = start + 1, lo[start], hi[start], hi[start] - lo[start]
+        while stop < len(spans) and _fits(stop + 1 - start, min(a, lo[stop]), max(b, hi[stop]),
+                                          filled + hi[stop] - lo[stop]):
+            a, b, filled = min(a, lo[stop]), max(b, hi[stop]), filled + hi[stop] - lo[stop]
+            stop += 1
+        slices.append(_Slice.from_rows(spans[start:stop], lo[start:stop], hi[start:stop]))
+        start = stop
+    return slices
+
+
+def _fits(rows, lo, hi, filled):
+    # whether rows that cover the columns [lo, hi) together and hold filled values make a slice
+    size = rows * (hi - lo)
+    return size <= BLOCK_SIZE and filled >= MIN_SLICE_FILL * size
+
+
+class PatternLibrary:
+    '''
+    A library of powder patterns resampled onto one shared regular q-grid, so that a user pattern
+    can be scored against every pattern at once.  Runs of consecutive rows are stored in slices
+    that only cover the grid columns of their own rows, along with the prefix sums of every row.
+    Scoring a slice then takes one matrix-vector product for the cross terms and lookups for every
+    other sum.  A library takes about the memory of its patterns on the grid, rather than that of a
+    full-width matrix.
+
+    Attributes
+    ----------
+    q_step : float
+        The step size of the regular q-grid in inverse nanometers
+    q_grid : numpy array
+        The regular q-grid in inverse nanometers
+    slices : list of _Slice
+        The slices of consecutive rows, in the order of the rows
+    lo : numpy array
+        For each row, the index of the first grid point inside the q-range of the pattern
+    hi : numpy array
+        For each row, the index one past the last grid point inside the q-range of the pattern
+    names : list of str
+        The names of the patterns, usually the cif file stems
+    iucrids : list of str
+        The unique identifiers of the papers the patterns are associated with
+    skipped : list of tuple
+        (cif file name, reason) for the patterns that could not be put in the library
+    sources : dict
+        The signatures of the cache records of the cifs the library was built from, keyed by cif
+        file stem, see cif_io.cache_signatures
+    '''
+
+    def __init__(self, q_step, q_grid, slices, lo, hi, names, iucrids, skipped=None, sources=None):
+        self.q_step = q_step
+        self.q_grid = q_grid
+        self.slices = list(slices)
+        self.lo = np.asarray(lo, dtype=np.int64)
+        self.hi = np.asarray(hi, dtype=np.int64)
+        self.names = list(names)
+        self.iucrids = list(iucrids)
+        self.skipped = list(skipped) if skipped else []
+        self.sources = dict(sources) if sources else {}
+        self._index()
+
+    def __len__(self):
+        return len(self.names)
+
+    def _index(self):
+        # the grid index of q_grid[0] counted from q = 0, and the first row of every slice followed
+        # by the number of rows
+        self._origin = int(np.rint(self.q_grid[0] / self.q_step)) if len(self.q_grid) else 0
+        self._starts = np.cumsum([0] + [len(piece) for piece in self.slices])
+
+    def copy(self):
+        '''
+        returns a copy of the library that shares its slices.  upsert and remove never change a
+        slice in place, so either library can be changed without affecting the other, at the cost
+        of copying the row index only
+        '''
+        return PatternLibrary(self.q_step, self.q_grid, self.slices, self.lo.copy(), self.hi.copy(), self.names,
+                              self.iucrids, self.skipped, self.sources)
+
+    @property
+    def nbytes(self):
+        '''
+        the number of bytes taken by the slices
+        '''
+        return sum(piece.values.nbytes + piece.cumsum.nbytes + piece.cumsum_sq.nbytes for piece in self.slices)
+
+    @classmethod
+    def from_patterns(cls, patterns, q_step):
+        '''
+        builds a library from patterns given on their own q-values
+
+        Parameters
+        ----------
+        patterns  iterable
+          (name, iucrid, q, intensity) tuples.  q is in inverse nanometers
+        q_step  float (non-zero and positive)
+          the step size of the shared regular q-grid
+
+        Returns
+        -------
+        the PatternLibrary
+        '''
+        patterns = [(name, iucrid, np.asarray(q, dtype=float), np.asarray(intensity, dtype=float))
+                    for name, iucrid, q, intensity in patterns]
+        if patterns:
+            qmin = min(np.amin(p[2]) for p in patterns)
+            qmax = max(np.amax(p[2]) for p in patterns)
+            q_grid = canonical_qgrid(qmin, qmax, q_step)
+        else:
+            q_grid = np.array([])
+        spans = []
+        lo, hi = np.zeros(len(patterns), dtype=np.int64), np.zeros(len(patterns), dtype=np.int64)
+        for i, (name, iucrid, q, intensity) in enumerate(patterns):
+            span, lo[i], hi[i] = grid_span(q, intensity, q_grid)
+            spans.append(_standardize(span, 0, len(span)))
+        origin = int(np.rint(q_grid[0] / q_step)) if len(q_grid) else 0
+        return cls(q_step, q_grid, _pack(spans, (lo + origin).tolist(), (hi + origin).tolist()), lo, hi,
+                   [p[0] for p in patterns], [p[1] for p in patterns])
+
+    def _cover(self, qmin, qmax):
+        '''
+        extends the q-grid so that it covers [qmin, qmax].  The grid stays on integer multiples of
+        q_step, so only the grid indices of the rows that are already in the library move
+        '''
+        first, last = int(np.floor(qmin / self.q_step)), int(np.ceil(qmax / self.q_step))
+        if len(self.q_grid):
+            first, last = min(first, self._origin), max(last, self._origin + len(self.q_grid) - 1)
+        left = self._origin - first if len(self.q_grid) else 0
+        if left == 0 and last + 1 - first == len(self.q_grid):
+            return
+        self.q_grid = np.arange(first, last + 1) * self.q_step
+        self.lo = self.lo + left
+        self.hi = self.hi + left
+        self._index()
+
+    def upsert(self, name, iucrid, q, intensity):
+        '''
+        puts a pattern in the library.  A pattern of the same name is taken out first, so a
+        replaced pattern moves to the end of the library.  The q-grid is extended when the pattern
+        reaches beyond it
+
+        Parameters
+        ----------
+        name  str
+          the name of the pattern
+        iucrid  str
+          the unique identifier of the paper the pattern is associated with
+        q  array_like
+          the q values of the pattern in inverse nanometers
+        intensity  array_like
+          the intensity values of the pattern
+        '''
+        q, intensity = np.asarray(q, dtype=float), np.asarray(intensity, dtype=float)
+        self.remove(name)
+        self._cover(np.amin(q), np.amax(q))
+        span, lo, hi = grid_span(q, intensity, self.q_grid)
+        span = _standardize(span, 0, len(span))
+        # the row joins the last slice when it fits there, which copies that slice only
+        start = self._starts[-2] if self.slices else len(self)
+        self.names.append(name)
+        self.iucrids.append(iucrid)
+        self.lo, self.hi = np.append(self.lo, lo), np.append(self.hi, hi)
+        rows = range(start, len(self))
+        columns_lo, columns_hi = (self.lo[start:] + self._origin).tolist(), (self.hi[start:] + self._origin).tolist()
+        filled = sum(columns_hi) - sum(columns_lo)
+        if start < len(self) - 1 and _fits(len(rows), min(columns_lo), max(columns_hi), filled):
+            spans = [self.window(row, self.lo[row], self.hi[row]) for row in rows[:-1]] + [span]
+            self.slices[-1] = _Slice.from_rows(spans, columns_lo, columns_hi)
+        else:
+            self.slices.append(_Slice.from_rows([span], columns_lo[-1:], columns_hi[-1:]))
+        self._index()
+
+    def remove(self, name):
+        '''
+        removes the pattern called name from the library.  Returns False if there is none
+        '''
+        if name not in self.names:
+            return False
+        i = self.names.index(name)
+        j = int(np.searchsorted(self._starts, i, side='right')) - 1
+        rows = [row for row in range(self._starts[j], self._starts[j + 1]) if row != i]
+        spans = [self.window(row, self.lo[row], self.hi[row]) for row in rows]
+        self.slices[j:j + 1] = _pack(spans, (self.lo[rows] + self._origin).tolist(),
+                                     (self.hi[rows] + self._origin).tolist())
+        del self.names[i], self.iucrids[i]
+        self.lo, self.hi = np.delete(self.lo, i), np.delete(self.hi, i)
+        self._index()
+        return True
+
+    def grid_user(self, user_q, user_intensity):
+        '''
+        puts a user pattern on the q-grid of the library
+
+        Parameters
+        ----------
+        user_q  array_like
+          the q values of the user pattern in inverse nanometers
+        user_intensity  array_like
+          the intensity values of the user pattern
+
+        Returns
+        -------
+        the standardized intensities on the grid (zero outside the user q-range), and the lo and
+        hi indices of the user q-range on the grid
+        '''
+        values, lo, hi = grid_pattern(user_q, user_intensity, self.q_grid)
+        return _standardize(values, lo, hi), lo, hi
+
+    def overlap(self, user_lo, user_hi, rows=slice(None)):
+        '''
+        returns, for every row or for the given rows, the lo and hi grid indices of the window where
+        the row and a user pattern covering [user_lo, user_hi) are both defined
+        '''
+        win_lo = np.maximum(self.lo[rows], user_lo)
+        win_hi = np.maximum(np.minimum(self.hi[rows], user_hi), win_lo)
+        return win_lo, win_hi
+
+    def window(self, row, win_lo, win_hi):
+        '''
+        returns the standardized intensities of row on q_grid[win_lo:win_hi], a window inside its
+        q-range
+        '''
+        j = int(np.searchsorted(self._starts, row, side='right')) - 1
+        piece = self.slices[j]
+        column = piece.column - self._origin
+        return piece.values[row - self._starts[j], win_lo - column:win_hi - column]
+
+    def row(self, i):
+        '''
+        returns the standardized intensities of row i on q_grid[lo[i]:hi[i]]
+        '''
+        return self.window(i, self.lo[i], self.hi[i])
+
+    def correlate(self, user_q, user_intensity, min_overlap=None, metric=None):
+        '''
+        scores a user pattern against every pattern in the library with a correlation coefficient
+        over the q-range where both are defined.
+
+        Parameters
+        ----------
+        user_q  array_like
+          the q values of the user pattern in inverse nanometers
+        user_intensity  array_like
+          the intensity values of the user pattern
+        min_overlap  float (optional)
+          the smallest overlapping q-range that is scored.  Defaults to MIN_QRANGE_OVERLAP
+        metric  str (optional)
+          the correlation coefficient, one of SIMILARITY_METRICS.  Defaults to 'pearson', which is
+          computed a whole slice of rows at a time.  The rank coefficients are computed row by row,
+          and only for the rows with a Pearson coefficient, so they are much slower
+
+        Returns
+        -------
+        numpy array with the coefficient for each row of the library.  Rows that do not overlap the
+        user pattern enough, or that are constant over the overlap, are nan
+        '''
+        if len(self) == 0:
+            return np.array([])
+        return next(self.correlate_chunks(user_q, user_intensity, len(self), min_overlap, metric))[1]
+
+    def correlate_chunks(self, user_q, user_intensity, chunk_size, min_overlap=None, metric=None):
+        '''
+        scores a user pattern against the library about chunk_size rows at a time, as correlate
+        does, so that results can be reported before the whole library has been scored
+
+        Parameters
+        ----------
+        user_q  array_like
+          the q values of the user pattern in inverse nanometers
+        user_intensity  array_like
+          the intensity values of the user pattern
+        chunk_size  int
+          the number of rows that are scored at a time, rounded up to whole slices
+        min_overlap  float (optional)
+          the smallest overlapping q-range that is scored.  Defaults to MIN_QRANGE_OVERLAP
+        metric  str (optional)
+          the correlation coefficient, one of SIMILARITY_METRICS.  Defaults to 'pearson'
+
+        Yields
+        ------
+        the index of the first row of a chunk and numpy array with the coefficients of the rows of
+        the chunk
+        '''
+        if min_overlap is None:
+            min_overlap = MIN_QRANGE_OVERLAP
+        metric = 'pearson' if metric is None else metric.lower()
+        if metric not in SIMILARITY_METRICS:
+            raise ValueError(f"metric {metric} not known.  Allowed values are {*SIMILARITY_METRICS,}")
+        if len(self) == 0:
+            return
+        u, user_lo, user_hi = self.grid_user(user_q, user_intensity)
+        u_cumsum, u_cumsum_sq = _prefix_sums(u), _prefix_sums(u * u)
+        first = 0
+        while first < len(self.slices):
+            last = int(np.searchsorted(self._starts, self._starts[first] + chunk_size, side='left'))
+            last = min(max(last, first + 1), len(self.slices))
+            r = np.concatenate([self._correlate_slice(j, u, user_lo, user_hi, u_cumsum, u_cumsum_sq, min_overlap)
+                                for j in range(first, last)])
+            if metric != 'pearson':
+                r = self._rank_correlate_rows(self._starts[first], r, u, user_lo, user_hi, metric)
+            yield int(self._starts[first]), r
+            first = last
+
+    def _correlate_slice(self, j, u, user_lo, user_hi, u_cumsum, u_cumsum_sq, min_overlap):
+        '''
+        returns the Pearson coefficients of the rows of slice j against the gridded user pattern u
+        '''
+        piece, start, stop = self.slices[j], self._starts[j], self._starts[j + 1]
+        r = np.full(stop - start, np.nan)
+        win_lo, win_hi = self.overlap(user_lo, user_hi, slice(start, stop))
+        # rows are ruled out by their q-range alone, and slices without a candidate are never read
+        candidates = np.flatnonzero((win_hi - win_lo - 1) * self.q_step >= min_overlap)
+        if len(candidates) == 0:
+            return r
+        win_lo, win_hi = win_lo[candidates], win_hi[candidates]
+        column = piece.column - self._origin
+        # every window sum but the cross term is a difference of two prefix sums, of the user
+        # pattern or of the row
+        sx = u_cumsum[win_hi] - u_cumsum[win_lo]
+        sxx = u_cumsum_sq[win_hi] - u_cumsum_sq[win_lo]
+        sy = piece.cumsum[candidates, win_hi - column] - piece.cumsum[candidates, win_lo - column]
+        syy = piece.cumsum_sq[candidates, win_hi - column] - piece.cumsum_sq[candidates, win_lo - column]
+        # rows are zero outside their own q-range and u is zero outside the user q-range, so one
+        # matrix-vector product gives the cross terms of every row of the slice over its window
+        sxy = (piece.values @ u[column:column + piece.width])[candidates]
+        r[candidates] = pearson_from_sums(win_hi - win_lo, sx, sy, sxx, syy, sxy)
+        return r
+
+    def correlate_many(self, user_patterns, min_overlap=None):
+        '''
+        scores many user patterns against every pattern in the library with the Pearson correlation
+        coefficient, as correlate does for one.  The user patterns are put on the grid in groups of
+        similar q-ranges, which span at most USER_BLOCK_SIZE grid points together.  The cross terms
+        of a slice of rows with all user patterns of a group are one matrix-matrix product, so every
+        slice is read once per group rather than once per user pattern.
+
+        Parameters
+        ----------
+        user_patterns  iterable of tuples of array_like
+          the q values in inverse nanometers and the intensity values of each user pattern
+        min_overlap  float (optional)
+          the smallest overlapping q-range that is scored.  Defaults to MIN_QRANGE_OVERLAP
+
+        Returns
+        -------
+        numpy array with one row per user pattern, holding the Pearson coefficient for each row of
+        the library.  Pairs that do not overlap enough, or that are constant over the overlap, are nan
+        '''
+        if min_overlap is None:
+            min_overlap = MIN_QRANGE_OVERLAP
+        gridded = []
+        for user_q, user_intensity in user_patterns:
+            span, lo, hi = grid_span(user_q, user_intensity, self.q_grid)
+            gridded.append((_standardize(span, 0, hi - lo), lo, hi))
+        r = np.full((len(gridded), len(self)), np.nan)
+        if len(gridded) == 0 or len(self) == 0:
+            return r
+        for group in self._user_groups(gridded):
+            self._correlate_group(r, group, [gridded[i] for i in group], min_overlap)
+        return r
+
+    def _user_groups(self, gridded):
+        '''
+        yields the indices of groups of gridded user patterns, ordered by q-range, that span at most
+        USER_BLOCK_SIZE grid points together, or of single patterns
+        '''
+        order = sorted(range(len(gridded)), key=lambda i: gridded[i][1:])
+        group, lo, hi = [], None, None
+        for i in order:
+            lo = gridded[i][1] if not group else min(lo, gridded[i][1])
+            hi = gridded[i][2] if not group else max(hi, gridded[i][2])
+            if group and (len(group) + 1) * (hi - lo) > USER_BLOCK_SIZE:
+                yield group
+                group, lo, hi = [], gridded[i][1], gridded[i][2]
+            group.append(i)
+        yield group
+
+    def _correlate_group(self, r, group, gridded, min_overlap):
+        '''
+        fills the rows group of r with the Pearson coefficients of the gridded user patterns of a
+        group against every row of the library
+        '''
+        user_lo = np.array([lo for span, lo, hi in gridded])[:, None]
+        user_hi = np.array([hi for span, lo, hi in gridded])[:, None]
+        # only the columns that some user pattern covers contribute, so the user patterns and their
+        # prefix sums are laid out on those alone
+        first, last = int(user_lo.min()), int(user_hi.max())
+        u = np.zeros((len(gridded), last - first))
+        for k, (span, lo, hi) in enumerate(gridded):
+            u[k, lo - first:hi - first] = span
+        u_cumsum, u_cumsum_sq = _prefix_sums(u), _prefix_sums(u * u)
+        patterns = np.arange(len(gridded))[:, None]
+        for j, piece in enumerate(self.slices):
+            start, stop = self._starts[j], self._starts[j + 1]
+            win_lo, win_hi = self.overlap(user_lo, user_hi, np.s_[None, start:stop])
+            scored = (win_hi - win_lo - 1) * self.q_step >= min_overlap
+            if not scored.any():
+                continue
+            column = piece.column - self._origin
+            slots = np.arange(stop - start)
+            # the windows of the pairs that are not scored may lie outside the columns of the group
+            # or of the slice
+            a, b = np.clip(win_lo - first, 0, last - first), np.clip(win_hi - first, 0, last - first)
+            sx = u_cumsum[patterns, b] - u_cumsum[patterns, a]
+            sxx = u_cumsum_sq[patterns, b] - u_cumsum_sq[patterns, a]
+            a, b = np.clip(win_lo - column, 0, piece.width), np.clip(win_hi - column, 0, piece.width)
+            sy = piece.cumsum[slots, b] - piece.cumsum[slots, a]
+            syy = piece.cumsum_sq[slots, b] - piece.cumsum_sq[slots, a]
+            # the cross terms only need the columns that the slice shares with the group
+            lo, hi = max(column, first), min(column + piece.width, last)
+            sxy = u[:, lo - first:hi - first] @ piece.values[:, lo - column:hi - column].T
+            r[group, start:stop] = np.where(scored, pearson_from_sums(win_hi - win_lo, sx, sy, sxx, syy, sxy),
+                                            np.nan)
+
+    def _rank_correlate_rows(self, start, pearson, u, user_lo, user_hi, metric):
+        '''
+        returns the rank coefficients of the rows from start on that have a Pearson coefficient.  The
+        rows are standardized, which does not change their ranks
+        '''
+        r = np.full(len(pearson), np.nan)
+        candidates = np.flatnonzero(~np.isnan(pearson))
+        rows = start + candidates
+        win_lo, win_hi = self.overlap(user_lo, user_hi, rows)
+        for i, row, lo, hi in zip(candidates, rows, win_lo, win_hi):
+            r[i] = correlate(u[lo:hi], self.window(row, lo, hi), metric)
+        return r
+
+    def save(self, path):
+        '''
+        writes the library to a .npz file at path.  The slices are stored back to back, along with
+        their prefix sums, so that they are not summed again when the library is read
+        '''
+        skipped = np.array(self.skipped, dtype=str).reshape(-1, 2)
+        values, cumsum, cumsum_sq = [np.concatenate([getattr(piece, name).ravel() for piece in self.slices])
+                                     if self.slices else np.array([]) for name in ("values", "cumsum", "cumsum_sq")]
+        with open(path, "wb") as o:
+            np.savez(o, q_step=self.q_step, grid_start=self._origin, grid_length=len(self.q_grid), values=values,
+                     cumsum=cumsum, cumsum_sq=cumsum_sq,
+                     slice_rows=np.array([len(piece) for piece in self.slices], dtype=np.int64),
+                     slice_columns=np.array([piece.column for piece in self.slices], dtype=np.int64),
+                     slice_widths=np.array([piece.width for piece in self.slices], dtype=np.int64),
+                     lo=self.lo, hi=self.hi,
+                     names=np.array(self.names, dtype=str), iucrids=np.array(self.iucrids, dtype=str),
+                     skipped=skipped, source_stems=np.array(list(self.sources), dtype=str),
+                     source_signatures=np.array(list(self.sources.values()), dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        reads a library that was written with PatternLibrary.save.  The slices and their prefix
+        sums are views into one array each
+        '''
+        with np.load(path, allow_pickle=False) as stored:
+            q_step = float(stored["q_step"])
+            lo, hi = stored["lo"], stored["hi"]
+            grid_start = int(stored["grid_start"])
+            if "slice_rows" in stored:
+                grid_length = int(stored["grid_length"])
+                slices = _stored_slices(stored)
+            else:
+                rows, grid_length = _stored_rows(stored, lo, hi)
+                slices = _pack(rows, (lo + grid_start).tolist(), (hi + grid_start).tolist())
+            q_grid = (grid_start + np.arange(grid_length)) * q_step
+            return cls(q_step, q_grid, slices, lo, hi,
+                       stored["names"].tolist(), stored["iucrids"].tolist(),
+                       [tuple(e) for e in stored["skipped"].tolist()],
+                       sources=_stored_sources(stored))
+
+
+def _stored_slices(stored):
+    # the slices are stored back to back, row by row.  The prefix sums are summed again for
+    # libraries saved without them
+    sizes = stored["slice_rows"] * stored["slice_widths"]
+    rows, widths = stored["slice_rows"].tolist(), stored["slice_widths"].tolist()
+    values = np.split(stored["values"], np.cumsum(sizes)[:-1])
+    if "cumsum" in stored:
+        bounds = np.cumsum(sizes + stored["slice_rows"])[:-1]
+        cumsum, cumsum_sq = np.split(stored["cumsum"], bounds), np.split(stored["cumsum_sq"], bounds)
+    else:
+        cumsum = cumsum_sq = [None] * len(rows)
+    return [_Slice(column, values[j].reshape(rows[j], widths[j]),
+                   None if cumsum[j] is None else cumsum[j].reshape(rows[j], widths[j] + 1),
+                   None if cumsum_sq[j] is None else cumsum_sq[j].reshape(rows[j], widths[j] + 1))
+            for j, column in enumerate(stored["slice_columns"].tolist())]
+
+
+def _stored_rows(stored, lo, hi):
+    # libraries saved before the rows were stored in slices held them on their own q-range back to
+    # back, or before that as a full-width matrix.  Returns the rows and the length of the grid
+    if "values" in stored:
+        rows = np.split(stored["values"], np.cumsum(hi - lo)[:-1]) if len(lo) else []
+        return rows, int(stored["grid_length"])
+    intensity = stored["intensity"]
+    return [intensity[i, lo[i]:hi[i]] for i in range(len(lo))], intensity.shape[1]
+
+
+def _stored_sources(stored):
+    # libraries saved before the sources were kept cif by cif are brought up to date from scratch
+    if "source_stems" not in stored:
+        return {}
+    return dict(zip(stored["source_stems"].tolist(), stored["source_signatures"].tolist()))
+
+
+def library_cache_path(cif_dir, q_step):
+    '''
+    returns the path of the pre-gridded library for the cifs in cif_dir and the q-grid interval q_step
+    '''
+    return Path(cif_dir) / "_cache" / f"library_{q_step:g}.npz"
+
+
+def ingest_library(cif_dir, q_steps=None, jobs=None, timeout=None):
+    '''
+    parses the new and changed cifs in cif_dir and resamples every pattern onto the canonical
+    q-grid of each interval in q_steps.  The libraries are saved in the _cache directory next to
+    the cifs, so that a query only has to put the user pattern on the grid.
+
+    Parameters
+    ----------
+    cif_dir  pathlib.Path object
+      the directory containing the cifs
+    q_steps  iterable of float (optional)
+      the q-grid intervals to ingest.  Defaults to QGRID_INTERVALS
+    jobs  int (optional)
+      the number of worker processes used to parse cifs, see cif_io.refresh_cache
+    timeout  float (optional)
+      the time in seconds that parsing one cif may take, see cif_io.refresh_cache
+
+    Returns
+    -------
+    dict of the PatternLibrary for each q-grid interval
+    '''
+    if q_steps is None:
+        q_steps = QGRID_INTERVALS
+    refresh_cache(cif_dir, jobs=jobs, timeout=timeout)
+    patterns, skipped = [], []
+    for ciffile in sorted(Path(cif_dir).glob("*.cif")):
+        pattern, reason = _read_pattern(ciffile)
+        if reason is None:
+            patterns.append(pattern)
+        else:
+            skipped.append((ciffile.name, reason))
+    sources = cache_signatures(cif_dir)
+    libraries = {}
+    for q_step in q_steps:
+        library = PatternLibrary.from_patterns(patterns, q_step)
+        library.skipped, library.sources = skipped, sources
+        library.save(library_cache_path(cif_dir, q_step))
+        libraries[q_step] = library
+    return libraries
+
+
+def _read_pattern(ciffile):
+    '''
+    returns the (name, iucrid, q, intensity) pattern of a cif and None, or None and the reason why
+    the cif cannot be put in a library
+    '''
+    try:
+        pcd = cif_read(ciffile)
+    except RuntimeError as e:
+        return None, str(e)
+    if len(pcd.q) == 0:
+        return None, "Reciprocal space axis missing"
+    return (ciffile.stem, ciffile.stem[0:6], pcd.q, pcd.intensity), None
+
+
+def update_library(library, cif_dir, sources=None):
+    '''
+    brings a library up to date with the cifs in cif_dir.  Only the cifs that were added, removed
+    or changed since the library was built are read, and only their rows are put in, replaced or
+    taken out.
+
+    Parameters
+    ----------
+    library  PatternLibrary
+      the library, which is updated in place
+    cif_dir  pathlib.Path object
+      the directory containing the cifs
+    sources  dict (optional)
+      the cache signatures of the cifs in cif_dir, see cif_io.cache_signatures
+
+    Returns
+    -------
+    the stems of the cifs that were added, removed or changed
+    '''
+    if sources is None:
+        sources = cache_signatures(cif_dir)
+    removed = (set(library.sources) | set(library.names)) - set(sources)
+    changed = [stem for stem in sources if library.sources.get(stem) != sources[stem]]
+    skipped = dict(library.skipped)
+    for stem in removed:
+        library.remove(stem)
+        skipped.pop(f"{stem}.cif", None)
+    for stem in changed:
+        ciffile = Path(cif_dir) / f"{stem}.cif"
+        pattern, reason = _read_pattern(ciffile)
+        skipped.pop(ciffile.name, None)
+        if reason is None:
+            library.upsert(*pattern)
+        else:
+            library.remove(stem)
+            skipped[ciffile.name] = reason
+    library.skipped, library.sources = sorted(skipped.items()), dict(sources)
+    return sorted(removed) + changed
+
+
+def load_library(cif_dir, q_step, jobs=None, timeout=None):
+    '''
+    returns the pre-gridded library for the cifs in cif_dir on the q-grid interval q_step.  Stale
+    cache entries are parsed again first.  The library is ingested when it is missing, and only the
+    cifs that have been added, removed or changed since it was saved are applied to it otherwise.
+
+    Parameters
+    ----------
+    cif_dir  pathlib.Path object
+      the directory containing the cifs
+    q_step  float (non-zero and positive)
+      the q-grid interval
+    jobs  int (optional)
+      the number of worker processes used to parse cifs, see cif_io.refresh_cache
+    timeout  float (optional)
+      the time in seconds that parsing one cif may take, see cif_io.refresh_cache
+
+    Returns
+    -------
+    the PatternLibrary
+    '''
+    refresh_cache(cif_dir, jobs=jobs, timeout=timeout)
+    path = library_cache_path(cif_dir, q_step)
+    if not path.exists():
+        # the other intervals are pre-gridded along with it, unless they are stored already
+        q_steps = [step for step in QGRID_INTERVALS if not library_cache_path(cif_dir, step).exists()]
+        q_steps = q_steps if q_step in q_steps else q_steps + [q_step]
+        return ingest_library(cif_dir, q_steps, jobs=jobs, timeout=timeout)[q_step]
+    library = PatternLibrary.load(path)
+    sources = cache_signatures(cif_dir)
+    if library.sources != sources:
+        update_library(library, cif_dir, sources)
+        library.save(path)
+    return library
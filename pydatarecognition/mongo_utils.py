@@ -1,11 +1,33 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
 
-from pydatarecognition.cif_io import cif_read
-from pymongo import MongoClient
+from pydatarecognition.cif_cache import open_cache
+from pydatarecognition.cif_io import cif_read, refresh_cache
+from pymongo import MongoClient, UpdateOne, IndexModel, ASCENDING
 
+# number of documents written to mongodb in one bulk write
+BATCH_SIZE = 500
+# number of cifs that are serialized, and so have their arrays uploaded, at the same time
+UPLOADS = 16
+# indexes of every cif collection, on the paper filter, the key of the upserts, the number of points and the
+# wavelength.  The key of the upserts is unique among the cifs that have one, so concurrent upserts of one cif cannot
+# insert it twice.  They are named, so creating them again is a no-op
+UNIQUE_INDEX = "cif_file_name_unique"
+INDEXES = [IndexModel([("iucrid", ASCENDING)], name="iucrid"),
+           IndexModel([("cif_file_name", ASCENDING)], name=UNIQUE_INDEX, unique=True,
+                      partialFilterExpression={"cif_file_name": {"$type": "string"}}),
+           IndexModel([("npoints", ASCENDING)], name="npoints"),
+           IndexModel([("wavelength", ASCENDING)], name="wavelength")]
+# indexes that cif collections were given before, which are dropped by migrate_indexes: the key of the upserts before
+# it was unique, and the q-range, which no query used as the app ranks from its in-memory library
+LEGACY_INDEXES = ["cif_file_name", "q_range"]
 
-def cifs_to_mongo(mongo_db_uri: str, mongo_db_name: str, mongo_collection_name: str, cif_filepath: str) -> MongoClient:
+
+def cifs_to_mongo(mongo_db_uri: str, mongo_db_name: str, mongo_collection_name: str, cif_filepath: str,
+                  jobs: int = None, timeout: float = None, batch_size: int = BATCH_SIZE,
+                  uploads: int = UPLOADS) -> MongoClient:
     """
     Adds all cifs found in the cif_filepath directory to the collection pointed to by the uri, db, and collection name
     @param mongo_db_uri: First arg to MongoClient of pymongo. Can be localhost or atlas server e.g.
@@ -13,22 +35,140 @@ def cifs_to_mongo(mongo_db_uri: str, mongo_db_name: str, mongo_collection_name:
     @param mongo_db_name: Database in mongodb to upload CIF data to
     @param mongo_collection_name: Collection in mongodb to upload CIF data to
     @param cif_filepath: Directory containing CIFs that will be uploaded in it's entirety
+    @param jobs: Number of processes used to parse the cifs, defaults to the number of processors
+    @param timeout: Time in seconds that parsing one cif may take before it is skipped, no limit if None
+    @param batch_size: Number of documents written in one bulk write
+    @param uploads: Number of cifs whose arrays are uploaded at the same time
     @return: Client at the level specified in the URI (e.g. database level if <databasename> provided)
     """
     client = MongoClient(mongo_db_uri, serverSelectionTimeoutMS=2000)
     client.server_info()
-    db = client[mongo_db_name]
-    col = db[mongo_collection_name]
-    ciffiles = Path(cif_filepath).glob("*.cif")
-    for ciffile in ciffiles:
-        print(ciffile.name)
-        ciffile_path = Path(ciffile)
-        pcd = cif_read(ciffile_path)
-        dict = json.loads(pcd.json(by_alias=True))
-        col.insert_one(dict)
+    col = client[mongo_db_name][mongo_collection_name]
+    checkpoint = _checkpoint_path(cif_filepath, mongo_db_uri, mongo_db_name, mongo_collection_name)
+    cifs_to_collection(col, cif_filepath, checkpoint, jobs=jobs, timeout=timeout, batch_size=batch_size,
+                       uploads=uploads)
     return client
 
 
+def cifs_to_collection(col, cif_filepath, checkpoint, jobs: int = None, timeout: float = None,
+                       batch_size: int = BATCH_SIZE, uploads: int = UPLOADS) -> int:
+    """
+    Upserts the documents of all cifs found in the cif_filepath directory into a mongodb collection, keyed by the
+    cif file name. The cifs are parsed in worker processes, the documents of the next batch are serialized on
+    uploads threads while the current batch is written, and every batch is written in one unordered bulk write.
+    The cifs of every batch that was written are recorded in the checkpoint file with the sha256 of their contents,
+    so an interrupted run picks up where it stopped, and writes again the cifs that were edited in between. The
+    checkpoint is removed once every cif has been written.
+    @param col: The pymongo collection
+    @param cif_filepath: Directory containing CIFs that will be uploaded in it's entirety
+    @param checkpoint: Path of the checkpoint file
+    @param jobs: Number of processes used to parse the cifs, defaults to the number of processors
+    @param timeout: Time in seconds that parsing one cif may take before it is skipped, no limit if None
+    @param batch_size: Number of documents written in one bulk write
+    @param uploads: Number of cifs whose arrays are uploaded at the same time
+    @return: The number of documents that were written
+    """
+    migrate_indexes(col)
+    refresh_cache(cif_filepath, jobs=jobs, timeout=timeout)
+    cif_cache = open_cache(Path(cif_filepath) / "_cache")
+    checkpoint = Path(checkpoint)
+    done = set()
+    if checkpoint.exists():
+        with open(checkpoint) as f:
+            done = {line.strip() for line in f if line.strip()}
+        print(f"Resuming from {checkpoint}, {len(done)} cifs were written before")
+    ciffiles = [ciffile for ciffile in sorted(Path(cif_filepath).glob("*.cif"))
+                if _checkpoint_line(cif_cache, ciffile) not in done]
+    batches = [ciffiles[i:i + batch_size] for i in range(0, len(ciffiles), batch_size)]
+    written = 0
+    with ThreadPoolExecutor(max_workers=uploads) as executor:
+        pending = None
+        for batch in batches + [None]:
+            # the next batch is serialized while the previous one is written
+            submitted = [executor.submit(_mongo_document, ciffile) for ciffile in batch] if batch else None
+            if pending:
+                written += _write_batch(col, [future.result() for future in pending], checkpoint, cif_cache)
+            pending = submitted
+    if checkpoint.exists():
+        checkpoint.unlink()
+    return written
+
+
+def ensure_indexes(col):
+    """
+    Creates the INDEXES of a cif collection that do not exist yet, leaving existing indexes of the same name alone.
+    On a collection created before the key of the upserts was unique, the unique index cannot be created while cifs
+    share a file name or the LEGACY_INDEXES exist, and OperationFailure is raised; see migrate_indexes. With motor,
+    the returned awaitable must be awaited
+    @param col: The pymongo or motor collection
+    @return: The names of the indexes
+    """
+    return col.create_indexes(INDEXES)
+
+
+def migrate_indexes(col) -> int:
+    """
+    Brings the indexes of a cif collection created before up to date, then creates the INDEXES. Until the unique index
+    exists, of the cifs that share a file name only the newest is kept, the one with the largest _id as the ids are
+    ObjectIds. The LEGACY_INDEXES that the collection has are dropped
+    @param col: The pymongo collection
+    @return: The number of cifs that were deleted
+    """
+    indexes = col.index_information()
+    deleted = 0
+    if UNIQUE_INDEX not in indexes:
+        duplicates = col.aggregate([{"$match": {"cif_file_name": {"$type": "string"}}},
+                                    {"$sort": {"_id": -1}},
+                                    {"$group": {"_id": "$cif_file_name", "ids": {"$push": "$_id"}}},
+                                    {"$match": {"ids.1": {"$exists": True}}}], allowDiskUse=True)
+        for duplicate in duplicates:
+            deleted += col.delete_many({"_id": {"$in": duplicate["ids"][1:]}}).deleted_count
+        if deleted:
+            print(f"Deleted {deleted} cifs that shared their file name with a newer one")
+    for name in LEGACY_INDEXES:
+        if name in indexes:
+            col.drop_index(name)
+    ensure_indexes(col)
+    return deleted
+
+
+def _mongo_document(ciffile):
+    try:
+        pcd = cif_read(Path(ciffile))
+    except RuntimeError as e:
+        print(e)
+        return ciffile, None
+    return ciffile, json.loads(pcd.json(by_alias=True))
+
+
+def _write_batch(col, documents, checkpoint, cif_cache):
+    requests = []
+    for ciffile, document in documents:
+        if document is None:
+            continue
+        _id = document.pop("_id")
+        requests.append(UpdateOne({"cif_file_name": document["cif_file_name"]},
+                                  {"$set": document, "$setOnInsert": {"_id": _id}}, upsert=True))
+    if requests:
+        col.bulk_write(requests, ordered=False)
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+    with open(checkpoint, "a") as o:
+        o.writelines(f"{_checkpoint_line(cif_cache, ciffile)}\n" for ciffile, document in documents)
+    print(f"{len(requests)} cifs written")
+    return len(requests)
+
+
+def _checkpoint_line(cif_cache, ciffile):
+    # the name of the cif with the sha256 its cache record was parsed from, so an edited cif no longer matches
+    record = cif_cache.index.get(Path(ciffile).stem, {})
+    return f"{Path(ciffile).name} {record.get('sha256')}"
+
+
+def _checkpoint_path(cif_filepath, mongo_db_uri, mongo_db_name, mongo_collection_name):
+    target = hashlib.sha256(f"{mongo_db_uri} {mongo_db_name} {mongo_collection_name}".encode()).hexdigest()[:16]
+    return Path(cif_filepath) / "_cache" / f"mongo_checkpoint_{target}.txt"
+
+
 if __name__ == "__main__":
     import os
     import yaml
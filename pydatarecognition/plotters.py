@@ -89,9 +89,9 @@ def all_plot(user_dict, cif_dict, output_dir):
                     i += 1
                 ax = plt.subplot(gs[i,j])
                 ax.set_xlim(qrange[0], qrange[1])
-                ax.set_ylim(plotting_min_max(cifdata["intensity_resampled"])[0],
-                                  plotting_min_max(cifdata["intensity_resampled"])[1])
-                ax.plot(cifdata["q_reg"], cifdata["intensity_resampled"],
+                ax.set_ylim(plotting_min_max(cifdata["intensity"])[0],
+                                  plotting_min_max(cifdata["intensity"])[1])
+                ax.plot(cifdata["q"], cifdata["intensity"],
                               label=f"{cifdata['cifname']}")
                 ax.legend()
                 i += 1
@@ -115,15 +115,13 @@ def rank_plot(user_dict, cif_dict, cif_rank_coeff, output_dir, ranktype, plot_al
     x_min_user, x_max_user = np.amin(x_user), np.amax(x_user)
     y_min_user, y_max_user = np.amin(y_user), np.amax(y_user)
     x_range_user, y_range_user = x_max_user - x_min_user, y_max_user - y_min_user
-    cifdata_q, cifdata_q_reg, cifdata_intensity, cifdata_intensity_resampled, cifdata_cifname = [], [], [], [], []
+    cifdata_q, cifdata_intensity, cifdata_cifname = [], [], []
     for i in range(0, 5):
         file = cif_rank_coeff[i][0]
         for key in cif_dict:
             if key == file:
                 cifdata_q.append(cif_dict[key]['q'])
-                cifdata_q_reg.append(cif_dict[key]['q_reg'])
                 cifdata_intensity.append(cif_dict[key]['intensity'])
-                cifdata_intensity_resampled.append(cif_dict[key]['intensity_resampled'])
                 cifdata_cifname.append(cif_dict[key]['cifname'])
     fontsize_labels, fontsize_ticks, fontsize_legend = 20, 16, 16
     legend_handle_lw, legend_frame_lw = 0, 2
@@ -145,7 +143,7 @@ def rank_plot(user_dict, cif_dict, cif_rank_coeff, output_dir, ranktype, plot_al
     axs[0].set_ylim(y_min_user - 0.1*y_range_user, y_max_user + 0.1*y_range_user)
     axs[0].set_yticks([])
     for i in range(1, 6):
-        x, y = cifdata_q_reg[i-1], cifdata_intensity_resampled[i-1]
+        x, y = cifdata_q[i-1], cifdata_intensity[i-1]
         y_min, y_max = np.amin(y), np.amax(y)
         y_range = y_max - y_min
         # axs[i].plot(x, y, c=colors[i], label=f"Rank {i}: {cifdata_cifname[i-1]}")
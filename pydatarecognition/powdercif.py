@@ -1,16 +1,16 @@
 import os
-from io import BytesIO
-import uuid
 from pathlib import Path
-from functools import lru_cache
 import re
 
 import numpy as np
 from skbeam.core.utils import twotheta_to_q, q_to_twotheta
-from pydantic import Field, validator
+from pydantic import Field, validator, root_validator
 from odmantic.bson import BSON_TYPES_ENCODERS, BaseBSONModel, ObjectId
 from bson.errors import InvalidId
-from google.cloud import storage
+
+from pydatarecognition.utils import parse_cif_numbers, q_range_summary
+from pydatarecognition.array_cache import array_cache_from_env
+from pydatarecognition.array_store import array_store_from_env, array_to_npy, is_inline, inline_to_array
 
 filepath = Path(os.path.abspath(__file__))
 if os.path.isfile(os.path.join(filepath.parent.absolute(), '../requirements/testing-cif-datarec-secret.json')):
@@ -73,16 +73,8 @@ class Array(np.ndarray, metaclass=_ArrayMeta):
             return np.array(val, dtype=dtype)
 
 
-def export_to_gcs(array: np.ndarray):
-    storage_client = storage.Client()
-    cif_bucket = storage_client.get_bucket(BUCKET_NAME)
-    file_id = uuid.uuid4().hex
-    blob = cif_bucket.blob(file_id)
-    out = BytesIO()
-    np.save(out, array)
-    out.seek(0)
-    blob.upload_from_file(out)
-    return file_id
+def export_array(array: np.ndarray):
+    return array_store.put(array_to_npy(array))
 
 
 class PydanticPowderCif(BaseBSONModel):
@@ -96,6 +88,9 @@ class PydanticPowderCif(BaseBSONModel):
     q: Optional[Array] = Field(default_factory=list, description='Scattering Vector in Inverse nm')
     ttheta: Optional[Array] = Field(default_factory=list, description='Scattering Angle in Radians')
     intensity: Optional[Array] = Field(default_factory=list, description='Scattering Intensity')
+    qmin: Optional[float] = Field(None, description='Smallest Scattering Vector in Inverse nm, set from q')
+    qmax: Optional[float] = Field(None, description='Largest Scattering Vector in Inverse nm, set from q')
+    npoints: Optional[int] = Field(0, description='Number of Points of the Pattern, set from q')
 
     def __init__(self, iucrid=None, x_units: str = None, x=None, y=None, **data):
         if "_id" not in data and "id" not in data:
@@ -109,22 +104,26 @@ class PydanticPowderCif(BaseBSONModel):
         # ensure that x and y values are ndarrays, handling case of string from pycifrw
         if x is not None and y is not None:
             # if x and y not None, take this CIF ingestion route
+            valid = None
             if isinstance(x[0], str):
-                split = np.char.split(x, '(')
-                x = np.array([float(e[0]) for e in split])
+                x, _, valid = parse_cif_numbers(x)
             elif isinstance(x[0], float):
                 if isinstance(x, np.ndarray):
                     x = x
                 else:
                     x = np.array(x)
             if isinstance(y[0], str):
-                split = np.char.split(y, '(')
-                data['intensity'] = np.array([float(e[0]) for e in split])
+                y, _, y_valid = parse_cif_numbers(y)
+                valid = y_valid if valid is None or len(valid) != len(y_valid) else valid & y_valid
+                data['intensity'] = y
             elif isinstance(y[0], float):
                 if isinstance(x, np.ndarray):
                     data['intensity'] = y
                 else:
                     data['intensity'] = np.array(y)
+            # drop the points that the cif leaves undetermined
+            if valid is not None and len(x) == len(data['intensity']) == len(valid):
+                x, data['intensity'] = x[valid], data['intensity'][valid]
             # set q and ttheta
             wavelength = data.get('wavelength', None)
             if wavelength:
@@ -158,29 +157,48 @@ class PydanticPowderCif(BaseBSONModel):
         underscore_attrs_are_private = False
         json_encoders = {
             **BSON_TYPES_ENCODERS,
-            np.ndarray: export_to_gcs,
+            np.ndarray: export_array,
         }
 
     @validator('q', 'ttheta', 'intensity', pre=True)
-    def resolve_gcs_token(cls, val):
+    def resolve_array_token(cls, val):
         if isinstance(val, str):
+            if is_inline(val):
+                return inline_to_array(val)
             uuid4hex = re.compile('[0-9a-f]{32}\Z', re.I)
             if uuid4hex.match(val):
                 val = retrieve_glob_as_np(val)
             return val
         return val
 
+    @root_validator(skip_on_failure=True)
+    def summarize_q_range(cls, values):
+        # stored with every document, so that patterns can be selected by range without their arrays.
+        # Documents that are read without their arrays keep the stored values
+        q = values.get('q')
+        if q is not None and len(q) > 0:
+            values.update(q_range_summary(q))
+        return values
+
+
+def set_array_store(store):
+    '''
+    makes store the store that arrays are written to and read from, see array_store.  Reads go through
+    a new array_cache.ArrayCache, with a disk tier only if the store is remote
+    '''
+    global array_store, array_cache
+    array_store = store
+    # each array is ~56KB, so the default budget of 512MB holds about 9000 of them.  See the counters in
+    # array_cache.stats
+    array_cache = array_cache_from_env(store.fetch, ttl=DAYS_CACHED * 24 * 60 * 60, disk=store.remote)
+
+
+# the store is selected by the PYDATAREC_ARRAY_STORE environment variable, Google Cloud Storage by default
+set_array_store(array_store_from_env(BUCKET_NAME))
+
 
-#each is ~56KB, 1000 of which are 0.56GB of RAM
-@lru_cache(maxsize=1000, typed=True)
 def retrieve_glob_as_np(uid: str) -> np.ndarray:
-    storage_client = storage.Client()
-    gcs_cif_bucket = storage_client.get_bucket(BUCKET_NAME)
-    blob = gcs_cif_bucket.blob(uid)
-    blob.cache_control = f"public, max-age={int(DAYS_CACHED*60*60*24)}"
-    buffer = BytesIO(blob.download_as_string())
-    buffer.seek(0)
-    return np.load(buffer)
+    return array_cache.get(uid)
 
 
 class PowderCif:
@@ -0,0 +1,78 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# environment variables that configure the pool of the web app
+RANK_WORKERS_ENV = "PYDATAREC_RANK_WORKERS"
+RANK_QUEUE_ENV = "PYDATAREC_RANK_QUEUE"
+
+
+class PoolSaturated(RuntimeError):
+    '''
+    raised when a job is submitted to a RankPool whose queue is full
+    '''
+
+
+class RankPool:
+    '''
+    Runs CPU-bound ranking jobs on a pool of worker threads, so that they do not block the asyncio
+    event loop.  Pearson scoring takes a whole slice of library rows per numpy call, so it spends
+    nearly all of its time in matrix products that release the GIL.  Such jobs run in parallel and
+    share the pattern library without copying it into every worker.  The rank coefficients are
+    computed row by row and hold the GIL for much of their time, so jobs that use them take turns
+    rather than run in parallel.  At most workers jobs run at once and at most queue jobs wait
+    behind them; further jobs are refused at once instead of piling up.
+
+    Attributes
+    ----------
+    workers : int
+        The number of jobs that run at the same time
+    queue : int
+        The number of jobs that may wait for a free worker
+    pending : int
+        The number of jobs that are running or waiting
+    '''
+
+    def __init__(self, workers=None, queue=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = 4 * self.workers if queue is None else queue
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rank")
+
+    @classmethod
+    def from_env(cls):
+        '''
+        returns a RankPool sized by the PYDATAREC_RANK_WORKERS and PYDATAREC_RANK_QUEUE environment
+        variables, with the defaults of RankPool for the ones that are not set
+        '''
+        workers, queue = os.environ.get(RANK_WORKERS_ENV), os.environ.get(RANK_QUEUE_ENV)
+        return cls(int(workers) if workers else None, int(queue) if queue else None)
+
+    def submit(self, function, *args):
+        '''
+        starts function(*args) on a worker and returns an asyncio future of its result.  Must be
+        called from the event loop
+
+        Raises
+        ------
+        PoolSaturated
+          if workers jobs are running and queue jobs are already waiting
+        '''
+        if self.pending >= self.workers + self.queue:
+            raise PoolSaturated(f"{self.pending} ranking jobs are pending")
+        self.pending += 1
+        future = asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self.pending -= 1
+
+    async def run(self, function, *args):
+        '''
+        runs function(*args) on a worker and returns its result, see submit
+        '''
+        return await self.submit(function, *args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
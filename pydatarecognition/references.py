@@ -0,0 +1,297 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+
+from pydatarecognition.utils import format_crossref_reference
+
+REFERENCE_STORE = "references.sqlite"
+DOI_MAPPING = "iucrid_doi_mapping.txt"
+IUCR_DOI_URL = "https://publbio.iucr.org/publcifx/cnor2doi.php?cnor={iucrid}"
+CROSSREF_URL = "https://api.crossref.org/works/{doi}"
+UNRESOLVED = "unresolved"
+READ_SIZE = 1 << 16
+RETRY_AFTER = 7 * 24 * 3600.
+
+
+class ReferenceStore:
+    '''
+    A persistent store of the DOI of each iucrid and the formatted reference of each DOI, kept in
+    an SQLite database so that they only have to be looked up online once.  Lookups that found
+    nothing are recorded with the time they were made, so that they are not repeated too often.
+    The store can be seeded from a mapping file with an iucrid and a DOI on every line, e.g.,
+    iucrid_doi_mapping.txt.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        The SQLite database file
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._connection = sqlite3.connect(self.path)
+        with self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS dois (iucrid TEXT PRIMARY KEY, doi TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS refs (doi TEXT PRIMARY KEY, ref TEXT NOT NULL, ref_date TEXT);
+                CREATE TABLE IF NOT EXISTS seeds (source TEXT PRIMARY KEY, signature TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS misses (kind TEXT NOT NULL, key TEXT NOT NULL, checked REAL NOT NULL,
+                                                   PRIMARY KEY (kind, key));
+            ''')
+
+    def close(self):
+        self._connection.close()
+
+    def get_doi(self, iucrid):
+        '''
+        returns the stored DOI of iucrid or None if it is not in the store
+        '''
+        row = self._connection.execute("SELECT doi FROM dois WHERE iucrid = ?", (iucrid,)).fetchone()
+        return None if row is None else row[0]
+
+    def put_doi(self, iucrid, doi):
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO dois VALUES (?, ?)", (iucrid, doi))
+
+    def get_reference(self, doi):
+        '''
+        returns the stored reference and reference date of doi, or None if it is not in the store
+        '''
+        row = self._connection.execute("SELECT ref, ref_date FROM refs WHERE doi = ?", (doi,)).fetchone()
+        if row is None:
+            return None
+        ref, ref_date = row
+        return ref, None if ref_date is None else date.fromisoformat(ref_date)
+
+    def put_reference(self, doi, ref, ref_date):
+        ref_date = None if ref_date is None else ref_date.isoformat()
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO refs VALUES (?, ?, ?)", (doi, ref, ref_date))
+
+    def missed(self, kind, key, ttl):
+        '''
+        returns True if the lookup of key found nothing less than ttl seconds ago.  kind is "doi"
+        for the DOI of an iucrid and "reference" for the reference of a DOI
+        '''
+        row = self._connection.execute("SELECT checked FROM misses WHERE kind = ? AND key = ?",
+                                       (kind, key)).fetchone()
+        return row is not None and time.time() - row[0] < ttl
+
+    def put_miss(self, kind, key):
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO misses VALUES (?, ?, ?)", (kind, key, time.time()))
+
+    def seed(self, mapping_path):
+        '''
+        loads the iucrid to DOI mapping in the file at mapping_path into the store.  The file is
+        only read again after it has changed, and its entries take precedence over DOIs that were
+        looked up online
+
+        Parameters
+        ----------
+        mapping_path  pathlib.Path object
+          the mapping file, with an iucrid and its DOI separated by whitespace on every line
+
+        Returns
+        -------
+        the number of entries loaded
+        '''
+        mapping_path = Path(mapping_path).resolve()
+        stat = mapping_path.stat()
+        signature = f"{stat.st_size} {stat.st_mtime_ns}"
+        row = self._connection.execute("SELECT signature FROM seeds WHERE source = ?",
+                                       (str(mapping_path),)).fetchone()
+        if row is not None and row[0] == signature:
+            return 0
+        with open(mapping_path) as f:
+            entries = [tuple(line.split()[:2]) for line in f if len(line.split()) >= 2]
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO dois VALUES (?, ?)", entries)
+            self._connection.execute("INSERT OR REPLACE INTO seeds VALUES (?, ?)", (str(mapping_path), signature))
+        return len(entries)
+
+
+def open_reference_store(cif_dir):
+    '''
+    returns the ReferenceStore in the _cache directory of cif_dir, seeded from the
+    iucrid_doi_mapping.txt file in cif_dir if there is one
+    '''
+    cache = Path(cif_dir) / "_cache"
+    cache.mkdir(exist_ok=True)
+    store = ReferenceStore(cache / REFERENCE_STORE)
+    mapping_path = Path(cif_dir) / DOI_MAPPING
+    if mapping_path.exists():
+        store.seed(mapping_path)
+    return store
+
+
+class ReferenceResolver:
+    '''
+    Resolves the DOIs and references of many iucrids at once.  Every iucrid and every DOI is looked
+    up only once, the lookups run concurrently on an asyncio event loop with a bounded number in
+    flight, and each request has a deadline and is retried with exponential backoff when it fails
+    or times out.  The deadline covers the whole response, so a server that trickles its body is
+    given up on as well, and requests that were given up on are abandoned rather than waited for.
+    Results are read from and written back to a ReferenceStore if one is given, including the
+    lookups that found nothing, which are only tried again once retry_after has passed.
+    Offline, only the store is consulted and no network client is ever imported.
+
+    Attributes
+    ----------
+    store : ReferenceStore or None
+        The store that is consulted before going online
+    doi_url : str
+        The url of the iucrid to DOI service, with an {iucrid} placeholder
+    crossref_url : str
+        The url of the Crossref works endpoint, with a {doi} placeholder
+    concurrency : int
+        The maximum number of requests in flight
+    timeout : float
+        The deadline of a single request in seconds
+    retries : int
+        The number of times a failed request is retried
+    backoff : float
+        The wait in seconds before the first retry, doubled for every further retry
+    retry_after : float
+        The time in seconds after which a lookup that found nothing is made again
+    offline : bool
+        If True, entries that are not in the store are left unresolved
+    '''
+
+    def __init__(self, store=None, doi_url=IUCR_DOI_URL, crossref_url=CROSSREF_URL, concurrency=8,
+                 timeout=10., retries=2, backoff=0.5, retry_after=RETRY_AFTER, offline=False):
+        self.store, self.offline = store, offline
+        self.doi_url, self.crossref_url = doi_url, crossref_url
+        self.concurrency, self.timeout = concurrency, timeout
+        self.retries, self.backoff = retries, backoff
+        self.retry_after = retry_after
+
+    def resolve(self, iucrids):
+        '''
+        returns the DOI, reference and reference date of each of the iucrids
+
+        Parameters
+        ----------
+        iucrids  iterable of str
+          the iucrids, duplicates are looked up once
+
+        Returns
+        -------
+        dict of (doi, ref, ref_date) keyed by iucrid.  Entries that could not be resolved are None
+        '''
+        return asyncio.run(self._start(self._resolve_all(list(dict.fromkeys(iucrids)))))
+
+    def doi(self, iucrid):
+        '''
+        returns the DOI of a single iucrid, or None if it cannot be found
+        '''
+        return asyncio.run(self._start(self._doi(iucrid)))
+
+    def reference(self, doi):
+        '''
+        returns the formatted reference and the reference date of a single doi, or None, None if
+        they cannot be found.  See utils.format_crossref_reference
+        '''
+        return asyncio.run(self._start(self._reference(doi)))
+
+    async def _start(self, coroutine):
+        # the state of the lookups lives on the event loop that runs them
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._references = {}
+        # not the default executor, which asyncio.run waits for on the way out
+        self._executor = ThreadPoolExecutor(self.concurrency)
+        try:
+            return await coroutine
+        finally:
+            # the threads of abandoned requests end by themselves at the deadline of _get
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _resolve_all(self, iucrids):
+        resolved = await asyncio.gather(*(self._resolve(iucrid) for iucrid in iucrids))
+        return dict(zip(iucrids, resolved))
+
+    async def _doi(self, iucrid):
+        doi = self.store.get_doi(iucrid) if self.store is not None else None
+        if doi is None and not self._missed("doi", iucrid):
+            doi = await self._fetch(self.doi_url, iucrid=iucrid)
+            doi = doi.strip() if doi else None
+            if not doi:
+                self._miss("doi", iucrid)
+            elif self.store is not None:
+                self.store.put_doi(iucrid, doi)
+        return doi
+
+    async def _resolve(self, iucrid):
+        doi = await self._doi(iucrid)
+        if not doi:
+            return None, None, None
+        # iucrids of the same paper share one reference lookup
+        if doi not in self._references:
+            self._references[doi] = asyncio.ensure_future(self._reference(doi))
+        ref, ref_date = await self._references[doi]
+        return doi, ref, ref_date
+
+    async def _reference(self, doi):
+        stored = self.store.get_reference(doi) if self.store is not None else None
+        if stored is not None:
+            return stored
+        if self._missed("reference", doi):
+            return None, None
+        article = await self._fetch(self.crossref_url, doi=doi)
+        if article is None:
+            self._miss("reference", doi)
+            return None, None
+        try:
+            ref, ref_date = format_crossref_reference(json.loads(article))
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+            self._miss("reference", doi)
+            return None, None
+        if self.store is not None:
+            self.store.put_reference(doi, ref, ref_date)
+        return ref, ref_date
+
+    def _missed(self, kind, key):
+        return self.store is not None and self.store.missed(kind, key, self.retry_after)
+
+    def _miss(self, kind, key):
+        # offline nothing was looked up, so nothing was missed
+        if self.store is not None and not self.offline:
+            self.store.put_miss(kind, key)
+
+    async def _fetch(self, url_template, **values):
+        '''
+        returns the body of the response to a GET request of url_template filled in with the url
+        quoted values, or None if it fails or if offline.  Client errors are not retried
+        '''
+        if self.offline:
+            return None
+        from urllib.parse import quote
+        url = url_template.format(**{key: quote(value, safe="/") for key, value in values.items()})
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    request = asyncio.get_running_loop().run_in_executor(self._executor, self._get, url)
+                    return await asyncio.wait_for(request, self.timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    # urllib errors and timeouts are OSErrors, only HTTP errors carry a status code
+                    if getattr(e, "code", 500) < 500:
+                        return None
+        return None
+
+    def _get(self, url):
+        from urllib.request import urlopen
+        deadline = time.monotonic() + self.timeout
+        body = []
+        with urlopen(url, timeout=self.timeout) as response:
+            # the socket timeout only bounds each read, the deadline bounds the whole body
+            while chunk := response.read1(READ_SIZE):
+                body.append(chunk)
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{url} took longer than {self.timeout} s")
+        return b"".join(body).decode("utf-8")
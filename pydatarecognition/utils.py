@@ -1,9 +1,6 @@
 import numpy as np
 import scipy.stats
 from scipy.interpolate import interp1d
-from urllib.request import urlopen
-from requests import HTTPError
-from habanero import Crossref
 from datetime import date
 from skbeam.core.utils import twotheta_to_q, d_to_q
 
@@ -14,6 +11,7 @@ TTUNITS = ["deg", "rad"]
 DUNITS = ["A", "nm"]
 XUNITS = QUNITS + TTUNITS + DUNITS
 SIMILARITY_METRICS = ['pearson', 'spearman', 'kendall']
+CIF_PLACEHOLDERS = ['?', '.', ',', '-']
 
 
 NumberTypes = (int, float, complex)
@@ -39,6 +37,66 @@ def user_diffraction_data_extract(user_input_lines):
     return twotheta_array, intensity_array
 
 
+def parse_cif_numbers(tokens):
+    '''
+    given cif numeric tokens such as '1.234(5)', returns their values and standard uncertainties as
+    float arrays.  All tokens are converted at once on a byte matrix of the tokens, so no python
+    object is created per token.  The placeholders '?', '.', ',' and '-' that cifs use for unknown
+    or inapplicable values are flagged in a validity mask.
+
+    Parameters
+    ----------
+    tokens  iterable of str
+      the cif tokens, e.g., a loop column as read from a cif
+
+    Returns
+    -------
+    values  numpy array
+      the values of the tokens, nan for placeholders
+    su  numpy array
+      the standard uncertainties of the tokens, nan for tokens that state none
+    valid  numpy array of bool
+      False for placeholders, True otherwise
+    '''
+    try:
+        tokens = np.asarray(tokens, dtype="S")
+    except UnicodeEncodeError:
+        raise ValueError("cif numbers must be ascii")
+    n = len(tokens)
+    width = tokens.dtype.itemsize
+    values, su, valid = np.full(n, np.nan), np.full(n, np.nan), np.zeros(n, dtype=bool)
+    if n == 0 or width == 0:
+        return values, su, valid
+    chars = np.ascontiguousarray(tokens).view(np.uint8).reshape(n, width)
+    column = np.arange(width)
+    is_open = chars == ord("(")
+    has_su = is_open.any(axis=1)
+    end = np.where(has_su, is_open.argmax(axis=1), np.count_nonzero(chars, axis=1))
+    # the value part of each token, with the uncertainty blanked out
+    head = chars.copy()
+    head[column >= end[:, None]] = 0
+    placeholder = (end == 1) & np.isin(head[:, 0], [ord(c) for c in CIF_PLACEHOLDERS])
+    valid[:] = ~placeholder
+    values[valid] = head[valid].view(f"S{width}").ravel().astype(float)
+    rows = np.flatnonzero(has_su & valid)
+    if len(rows):
+        # the su counts in units of the last digit of the value, e.g., 1.2e3(4) means 400
+        chars, head, end = chars[rows], head[rows], end[rows]
+        digit = (column > end[:, None]) & (chars >= ord("0")) & (chars <= ord("9"))
+        place = np.cumsum(digit[:, ::-1], axis=1)[:, ::-1] - 1
+        su_digits = np.where(digit, (chars - ord("0")) * 10. ** place, 0.).sum(axis=1)
+        is_exponent = (head == ord("e")) | (head == ord("E"))
+        has_exponent = is_exponent.any(axis=1)
+        mantissa_end = np.where(has_exponent, is_exponent.argmax(axis=1), end)
+        is_point = head == ord(".")
+        decimals = np.where(is_point.any(axis=1), mantissa_end - is_point.argmax(axis=1) - 1, 0)
+        exponent = np.zeros(len(rows))
+        for i in np.flatnonzero(has_exponent):
+            exponent[i] = float(head[i, mantissa_end[i] + 1:end[i]].tobytes())
+        su[rows] = su_digits * 10. ** (exponent - decimals)
+    return values, su, valid
+
+
 def q_calculate(twotheta_list, wavelength):
     '''
     given a list of twotheta values and wavelength, calculates and appends corresponding q values to a list
@@ -79,6 +137,27 @@ def q_extrema_round(q_list):
     return q_min_round_up, q_max_round_down
 
 
+def q_range_summary(q):
+    '''
+    given the q values of a pattern, returns the scalars that describe its range, so that patterns
+    can be selected by range without reading their arrays
+
+    Parameters
+    ----------
+    q  array_like
+      the q values of the pattern
+
+    Returns
+    -------
+    dict with the smallest and largest q value, qmin and qmax, which are None for an empty pattern,
+    and the number of points, npoints
+    '''
+    q = np.asarray(q, dtype=float)
+    if len(q) == 0:
+        return dict(qmin=None, qmax=None, npoints=0)
+    return dict(qmin=float(np.amin(q)), qmax=float(np.amax(q)), npoints=len(q))
+
+
 def data_sample(cif_data):
     tt = cif_data[0]
     q = cif_data[1]
@@ -168,10 +247,14 @@ def xy_resample(x1, y1, x2, y2, x_step=None):
 
 
 def get_iucr_doi(iucrid):
-    with urlopen(f"https://publbio.iucr.org/publcifx/cnor2doi.php?cnor={iucrid}") as url:
-        doi = url.read().decode("utf-8")
-
-    return doi
+    '''
+    given an iucrid, returns the DOI of its paper from the IUCr, or an empty string if there is none.
+    The lookup is made by a references.ReferenceResolver, which also resolves the references of a
+    whole ranking at once
+    '''
+    # imported here because the references module depends on this one
+    from pydatarecognition.references import ReferenceResolver
+    return ReferenceResolver().doi(iucrid) or ""
 
 
 def get_formatted_crossref_reference(doi):
@@ -192,13 +275,28 @@ def get_formatted_crossref_reference(doi):
     returns None None in the article cannot be found given the doi
 
     '''
+    from pydatarecognition.references import ReferenceResolver
+    return ReferenceResolver().reference(doi)
 
-    cr = Crossref()
-    try:
-        article = cr.works(ids=str(doi))
-    except HTTPError:
-        return None, None
 
+def format_crossref_reference(article):
+    '''
+    given a work as returned by the Crossref REST-API, return the full reference and the date of the
+    reference
+
+    parameters
+    ----------
+    article dict
+      the response of the Crossref works endpoint for one doi, with the work under 'message'
+
+    return
+    ------
+    ref str
+      the nicely formatted reference including title
+    ref_date datetime.date
+      the date of the reference
+
+    '''
     authorlist = [
         "{} {}".format(a['given'].strip(), a['family'].strip())
         for a in article.get('message').get('author')]
@@ -274,30 +372,110 @@ def correlate(y1, y2, correlator=None):
     return float(corr_coeff)
 
 
+def pearson_from_sums(n, sx, sy, sxx, syy, sxy):
+    '''
+    given the number of points and the sums, sums of squares and sum of products of two arrays over
+    a window, returns the Pearson correlation coefficient of the two arrays over that window.  All
+    arguments may be numpy arrays, in which case many windows are evaluated at once.
+
+    Parameters
+    ----------
+    n  int or array-like
+      the number of points in the window
+    sx, sy  float or array-like
+      the sums of the first and second array over the window
+    sxx, syy  float or array-like
+      the sums of squares of the first and second array over the window
+    sxy  float or array-like
+      the sum of the products of the two arrays over the window
+
+    Returns
+    -------
+    the correlation coefficient(s), nan wherever either array is constant over its window
+    '''
+    n = np.asarray(n, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        r = cov / np.sqrt(var_x * var_y)
+    r = np.where((var_x > 0) & (var_y > 0), r, np.nan)
+    return np.clip(r, -1., 1.)
+
+
+def top_k_indices(scores, k):
+    '''
+    given an array of scores, returns the indices of the k highest scores, highest first.  Only the
+    k winners are sorted, so the cost is O(n + k log k) rather than that of sorting all scores.
+
+    Parameters
+    ----------
+    scores  array-like
+      the scores.  nan scores are never selected
+    k  int
+      the number of indices to return
+
+    Returns
+    -------
+    the indices as a numpy array of at most k integers.  Equal scores are ranked in index order
+    '''
+    scores = np.asarray(scores, dtype=float)
+    candidates = np.flatnonzero(~np.isnan(scores))
+    k = min(k, len(candidates))
+    if k <= 0:
+        return np.array([], dtype=int)
+    values = scores[candidates]
+    kth = np.partition(values, len(values) - k)[len(values) - k]
+    above = candidates[values > kth]
+    tied = candidates[values == kth][:k - len(above)]
+    winners = np.concatenate([above, tied])
+    return winners[np.lexsort((winners, -scores[winners]))]
+
+
+def best_per_key(scores, keys):
+    '''
+    given an array of scores and the key of each score, e.g., the iucrid of the cif that was
+    scored, returns the index of the highest score for each key
+
+    Parameters
+    ----------
+    scores  array-like
+      the scores.  nan scores are ignored
+    keys  iterable
+      the key of each score
+
+    Returns
+    -------
+    dict of the index of the best score keyed by key.  Of equal scores, the first one wins
+    '''
+    scores = np.asarray(scores, dtype=float)
+    values, keys, best = scores.tolist(), list(keys), {}
+    for i in np.flatnonzero(~np.isnan(scores)).tolist():
+        j = best.get(keys[i])
+        if j is None or values[i] > values[j]:
+            best[keys[i]] = i
+    return best
+
+
 def rank_returns(rank_dict, returns_min, returns_max, similarity_threshold):
-    if rank_dict[0]['corr_coeff'] < similarity_threshold:
-        returns = returns_min
-    else:
-        for i in range(1, len(rank_dict.keys())):
-            if rank_dict[i - 1]['corr_coeff'] >= similarity_threshold > rank_dict[i]['corr_coeff']:
-                returns = i
-                if returns < returns_min:
-                    returns = returns_min
-                    break
-                elif returns > returns_max:
-                    returns = returns_max
-                    break
-                else:
-                    pass
-
-    return returns
+    '''
+    given the ranked results, highest score first, returns how many of them to report: the number
+    of results that reach the similarity threshold, but at least returns_min and at most returns_max
+    and never more than there are results
+    '''
+    reaching = 0
+    while reaching < len(rank_dict) and rank_dict[reaching]['corr_coeff'] >= similarity_threshold:
+        reaching += 1
+    returns = min(max(reaching, returns_min), returns_max)
+
+    return min(returns, len(rank_dict))
 
 def validate_args(args):
     if args['xquantity'] == 'twotheta' and not args['wavelength']:
         raise RuntimeError("--wavelength is required when --xquantity is twotheta. "
                            "Please rerun specifying wavelength."
                            )
-    for arg in ['wavelength', 'qgrid_interval', 'similarity_threshold']:
+    for arg in ['wavelength', 'qgrid_interval', 'similarity_threshold', 'cif_timeout']:
         if args.get(arg) and not isinstance(args.get(arg), NumberTypes):
             raise RuntimeError(f"Cannot read --{arg}. Please make sure it is a number")
     if args['xquantity'] not in XCHOICES:
@@ -313,12 +491,18 @@ def validate_args(args):
     return True
 
 def process_args(args):
-    for arg in ['wavelength', 'qgrid_interval', 'similarity_threshold']:
+    for arg in ['wavelength', 'qgrid_interval', 'similarity_threshold', 'cif_timeout']:
         try:
             if args.get(arg):
                 args[arg] = float(args[arg])
         except ValueError:
             raise ValueError(f"Cannot read --{arg.replace('_','-')}. Please make sure it is a number")
+    for arg in ['jobs']:
+        try:
+            if args.get(arg):
+                args[arg] = int(args[arg])
+        except ValueError:
+            raise ValueError(f"Cannot read --{arg.replace('_','-')}. Please make sure it is an integer")
     for arg in ['returns_min_max']:
         try:
             if args.get(arg):
@@ -8,7 +8,8 @@ from pymongo import MongoClient
 from pymongo import errors as mongo_errors
 from xonsh.lib import subprocess
 from xonsh.lib.os import rmtree
-from pydatarecognition.powdercif import storage, BUCKET_NAME
+from pydatarecognition.powdercif import BUCKET_NAME
+from google.cloud import storage
 from google.cloud.exceptions import Conflict
 
 
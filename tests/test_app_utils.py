@@ -0,0 +1,146 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from skbeam.core.utils import q_to_twotheta
+
+from pydatarecognition.app_utils import (RankedLibrary, page_query, rank_user_input, rank_user_inputs,
+                                         check_batch_size, stream_ranking, MAX_BATCH_SIZE)
+from pydatarecognition.powdercif import PydanticPowderCif
+from pydatarecognition.rank_pool import RankPool, PoolSaturated
+
+DOIS = {"aa0001": "10.1107/aa0001", "aa0002": "10.1107/aa0002", "bb0003": "10.1107/bb0003"}
+
+
+def _cifs():
+    q = np.linspace(5., 60., 800)
+    return [PydanticPowderCif(iucrid="aa0001", cif_file_name="aa0001sup1", q=q, intensity=np.sin(q) + 2.),
+            PydanticPowderCif(iucrid="aa0001", cif_file_name="aa0001sup2", q=q, intensity=np.sin(q) + np.cos(2 * q)),
+            PydanticPowderCif(iucrid="aa0002", cif_file_name="aa0002sup1", q=q, intensity=np.cos(q) + 2.),
+            PydanticPowderCif(iucrid="bb0003", cif_file_name="bb0003sup1", q=q, intensity=np.sin(3 * q)),
+            PydanticPowderCif(iucrid="bb0003", cif_file_name="bb0003empty")]
+
+
+def _user_input(q, intensity):
+    return "\n".join(f"{x} {y}" for x, y in zip(q, intensity)).encode("utf-8")
+
+
+def _ranked():
+    return RankedLibrary.from_cifs(_cifs(), DOIS, q_step=0.01)
+
+
+def test_ranked_library():
+    cifs = _cifs()
+    ranked = RankedLibrary.from_cifs(cifs, DOIS, q_step=0.01)
+    # the cif without a pattern is skipped
+    assert list(ranked.cif_file_names.values()) == ["aa0001sup1", "aa0001sup2", "aa0002sup1", "bb0003sup1"]
+    assert ranked.library.names == [str(cif.id) for cif in cifs[:4]]
+    changed = PydanticPowderCif(_id=cifs[0].id, iucrid="aa0001", cif_file_name="aa0001sup1b", q=cifs[3].q,
+                                intensity=cifs[3].intensity)
+    updated = ranked.updated(changed)
+    # the update is made to a new library, the old one is left as queries that are running see it
+    assert updated is not ranked and updated.library is not ranked.library
+    assert ranked.cif_file_names[str(cifs[0].id)] == "aa0001sup1" and len(ranked.library) == 4
+    assert updated.cif_file_names[str(cifs[0].id)] == "aa0001sup1b"
+    assert updated.library.names[-1] == str(cifs[0].id)
+    assert updated.dois is ranked.dois
+    removed = updated.removed(str(cifs[1].id))
+    assert len(removed.library) == 3 and str(cifs[1].id) not in removed.cif_file_names
+    assert len(updated.library) == 4
+    assert removed.removed("unknown") is removed
+    # a cif that loses its pattern cannot be ranked any more
+    emptied = removed.updated(PydanticPowderCif(_id=cifs[2].id, iucrid="aa0002", cif_file_name="aa0002sup1"))
+    assert len(emptied.library) == 2 and str(cifs[2].id) not in emptied.cif_file_names
+
+
+def test_page_query():
+    assert page_query() == ({}, {"q": 0, "ttheta": 0, "intensity": 0})
+    assert page_query("61a000000000000000000001", arrays=True) == ({"_id": {"$gt": "61a000000000000000000001"}},
+                                                                   None)
+
+
+def test_rank_user_input():
+    ranked = _ranked()
+    q = np.linspace(6., 55., 600)
+    user_input = _user_input(q, np.sin(q) + 2.)
+    actual = rank_user_input(ranked, user_input, "q", None, None)
+    assert [entry["IUCrCIF"] for entry in actual[:2]] == ["aa0001sup1", "aa0001sup2"]
+    assert actual[0] == {"IUCrCIF": "aa0001sup1", "score": pytest.approx(1.), "doi": "10.1107/aa0001"}
+    assert len(actual) == 4
+    scores = [entry["score"] for entry in actual]
+    assert scores == sorted(scores, reverse=True)
+    # the same pattern given in scattering angles
+    wavelength = 0.15
+    twotheta = np.degrees(q_to_twotheta(q, wavelength))
+    in_angles = rank_user_input(ranked, _user_input(twotheta, np.sin(q) + 2.), "twotheta", wavelength, None)
+    assert [entry["IUCrCIF"] for entry in in_angles] == [entry["IUCrCIF"] for entry in actual]
+    # top_k, min_score and the paper filter
+    assert [entry["IUCrCIF"] for entry in rank_user_input(ranked, user_input, "q", None, None, top_k=1)] == \
+           ["aa0001sup1"]
+    above = rank_user_input(ranked, user_input, "q", None, None, min_score=0.5)
+    assert 0 < len(above) < 4 and all(entry["score"] >= 0.5 for entry in above)
+    filtered = rank_user_input(ranked, user_input, "q", None, "bb0003")
+    assert [entry["IUCrCIF"] for entry in filtered] == ["bb0003sup1"]
+    ranks = rank_user_input(ranked, user_input, "q", None, None, top_k=2, metric="spearman")
+    assert ranks[0]["IUCrCIF"] == "aa0001sup1" and ranks[0]["score"] == pytest.approx(1., abs=1e-4)
+
+
+def test_rank_user_inputs():
+    ranked = _ranked()
+    q = np.linspace(6., 55., 600)
+    user_inputs = [_user_input(q, np.sin(q) + 2.), _user_input(q, np.cos(q)),
+                   _user_input(q[:300], np.sin(3 * q[:300]))]
+    actual = rank_user_inputs(ranked, user_inputs, "q", None, None, top_k=2, min_score=0.1)
+    for ranks, user_input in zip(actual, user_inputs):
+        expected = rank_user_input(ranked, user_input, "q", None, None, top_k=2, min_score=0.1)
+        assert [entry["IUCrCIF"] for entry in ranks] == [entry["IUCrCIF"] for entry in expected]
+        assert np.allclose([entry["score"] for entry in ranks], [entry["score"] for entry in expected])
+    assert [ranks[0]["IUCrCIF"] for ranks in actual] == ["aa0001sup1", "aa0002sup1", "bb0003sup1"]
+    # larger batches are refused before anything is read
+    check_batch_size(user_inputs * (MAX_BATCH_SIZE // 3))
+    with pytest.raises(HTTPException) as e:
+        check_batch_size([b""] * (MAX_BATCH_SIZE + 1))
+    assert e.value.status_code == 413
+
+
+@pytest.mark.parametrize("format", ["ndjson", "sse"])
+def test_stream_ranking(format):
+    ranked = _ranked()
+    q = np.linspace(6., 55., 600)
+    user_input = _user_input(q, np.sin(q) + 2.)
+    pool = RankPool(workers=1, queue=0)
+
+    async def collect():
+        stream = stream_ranking(pool, ranked, user_input, "q", None, None, 2, None, "pearson", 1, format)
+        # the pool is full while the ranking runs
+        with pytest.raises(PoolSaturated):
+            stream_ranking(pool, ranked, user_input, "q", None, None, 2, None, "pearson", 1, format)
+        return [event async for event in stream]
+
+    events = asyncio.run(collect())
+    pool.shutdown()
+    if format == "sse":
+        assert all(event.startswith("event: ") and event.endswith("\n\n") for event in events)
+        decoded = [dict(json.loads(event.split("\ndata: ")[1]), event=event.split("\n")[0][len("event: "):])
+                   for event in events]
+    else:
+        assert all(event.endswith("\n") and event.count("\n") == 1 for event in events)
+        decoded = [json.loads(event) for event in events]
+    assert [event["event"] for event in decoded] == ["snapshot"] * len(ranked.library.slices) + ["final"]
+    assert [event["scored"] for event in decoded][-1] == decoded[-1]["total"] == 4
+    assert decoded[-1]["ranks"] == rank_user_input(ranked, user_input, "q", None, None, top_k=2)
+
+
+def test_stream_ranking_error():
+    ranked = _ranked()
+    pool = RankPool(workers=1, queue=0)
+
+    async def collect():
+        return [event async for event in stream_ranking(pool, ranked, b"not a pattern", "q", None, None, 2, None,
+                                                        "pearson", 1, "ndjson")]
+
+    events = asyncio.run(collect())
+    pool.shutdown()
+    assert len(events) == 1 and json.loads(events[0])["event"] == "error"
@@ -0,0 +1,73 @@
+import os
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from pydatarecognition.array_cache import ArrayCache, array_cache_from_env
+
+
+def _npy(array):
+    out = BytesIO()
+    np.save(out, array)
+    return out.getvalue()
+
+
+def _store():
+    # a remote store of four arrays of 800 bytes each that records what is fetched
+    arrays = {f"{i:032x}": np.arange(100.) + i for i in range(4)}
+    fetched = []
+
+    def fetch(uid):
+        fetched.append(uid)
+        return _npy(arrays[uid])
+
+    return arrays, fetched, fetch
+
+
+def test_array_cache_memory():
+    arrays, fetched, fetch = _store()
+    uids = list(arrays)
+    cache = ArrayCache(fetch, max_bytes=2000)
+    for uid in uids[:2] + uids[:2]:
+        assert np.array_equal(cache.get(uid), arrays[uid])
+    assert fetched == uids[:2]
+    assert cache.stats == dict(memory_hits=2, disk_hits=0, misses=2, evictions=0)
+    # the third array does not fit, so the least recently used one goes
+    cache.get(uids[0])
+    cache.get(uids[2])
+    assert cache.stats["evictions"] == 1
+    assert len(cache) == 2 and cache.nbytes == 1600
+    cache.get(uids[1])
+    assert fetched == uids[:3] + [uids[1]]
+
+
+def test_array_cache_disk():
+    arrays, fetched, fetch = _store()
+    uids = list(arrays)
+    with TempDirectory() as d:
+        cache = ArrayCache(fetch, cache_dir=Path(d.path) / "arrays", ttl=60)
+        cache.get(uids[0])
+        # a new process starts with an empty memory tier but finds the array on disk
+        restarted = ArrayCache(fetch, cache_dir=Path(d.path) / "arrays", ttl=60)
+        assert np.array_equal(restarted.get(uids[0]), arrays[uids[0]])
+        assert restarted.stats["disk_hits"] == 1
+        assert fetched == uids[:1]
+        assert sorted(os.listdir(Path(d.path) / "arrays")) == [f"{uids[0]}.npy"]
+        # expired files are fetched again
+        path = Path(d.path) / "arrays" / f"{uids[0]}.npy"
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        restarted.clear()
+        restarted.get(uids[0])
+        assert restarted.stats["misses"] == 1
+        assert fetched == [uids[0], uids[0]]
+
+
+def test_array_cache_from_env(monkeypatch):
+    monkeypatch.setenv("PYDATAREC_ARRAY_CACHE", "")
+    monkeypatch.setenv("PYDATAREC_ARRAY_CACHE_BYTES", "1000")
+    cache = array_cache_from_env(None)
+    assert cache.cache_dir is None
+    assert cache.max_bytes == 1000
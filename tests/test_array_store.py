@@ -0,0 +1,105 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+from testfixtures import TempDirectory
+
+import pydatarecognition.powdercif as powdercif
+from pydatarecognition.array_store import (GCSArrayStore, InlineArrayStore, LocalArrayStore, array_store_from_env,
+                                           array_to_npy, inline_to_array, is_inline, npy_to_array)
+from pydatarecognition.powdercif import PydanticPowderCif
+
+
+def test_local_array_store():
+    array = np.linspace(1., 2., 50)
+    with TempDirectory() as d:
+        store = LocalArrayStore(Path(d.path) / "arrays")
+        uid = store.put(array_to_npy(array))
+        assert len(uid) == 32 and int(uid, 16) >= 0
+        assert np.array_equal(npy_to_array(store.fetch(uid)), array)
+        # the same contents are stored once
+        assert store.put(array_to_npy(array.copy())) == uid
+        assert len(list((Path(d.path) / "arrays").rglob("*.npy"))) == 1
+        assert store.put(array_to_npy(array + 1.)) != uid
+
+
+def test_inline_array_store():
+    array = np.arange(7.)
+    token = InlineArrayStore().put(array_to_npy(array))
+    assert is_inline(token)
+    assert not is_inline("0123456789abcdef0123456789abcdef")
+    assert np.array_equal(inline_to_array(token), array)
+    with pytest.raises(ValueError):
+        inline_to_array(token[:-3] + "!!!")
+
+
+def test_array_store_from_env(monkeypatch):
+    monkeypatch.delenv("PYDATAREC_ARRAY_STORE", raising=False)
+    assert isinstance(array_store_from_env("bucket"), GCSArrayStore)
+    monkeypatch.setenv("PYDATAREC_ARRAY_STORE", "local")
+    monkeypatch.setenv("PYDATAREC_ARRAY_STORE_DIR", "/tmp/arrays")
+    assert array_store_from_env("bucket").root == Path("/tmp/arrays")
+    monkeypatch.setenv("PYDATAREC_ARRAY_STORE", "inline")
+    assert isinstance(array_store_from_env("bucket"), InlineArrayStore)
+    monkeypatch.setenv("PYDATAREC_ARRAY_STORE", "ftp")
+    with pytest.raises(ValueError):
+        array_store_from_env("bucket")
+
+
+@pytest.mark.parametrize("inline", [True, False])
+def test_powdercif_round_trip(inline):
+    saved = powdercif.array_store
+    with TempDirectory() as d:
+        powdercif.set_array_store(InlineArrayStore() if inline else LocalArrayStore(d.path))
+        try:
+            pcd = PydanticPowderCif("aa0001", "invnm", [1., 2., 3.], [4., 5., 6.], wavelength=0.1,
+                                    wavel_units="nm")
+            document = json.loads(pcd.json(by_alias=True))
+            assert is_inline(document["q"]) == inline
+            actual = PydanticPowderCif(**document)
+        finally:
+            powdercif.set_array_store(saved)
+    assert np.array_equal(actual.q, pcd.q)
+    assert np.array_equal(actual.intensity, pcd.intensity)
+    assert np.allclose(actual.ttheta, pcd.ttheta)
+
+
+class _Bucket:
+    # stands in for a google.cloud.storage bucket in test_gcs_array_store
+    def __init__(self):
+        self.blobs, self.uploads = {}, 0
+
+    def blob(self, name):
+        return _Blob(self, name)
+
+
+class _Blob:
+    def __init__(self, bucket, name):
+        self.bucket, self.name = bucket, name
+
+    def exists(self):
+        return self.name in self.bucket.blobs
+
+    def upload_from_file(self, f):
+        self.bucket.uploads += 1
+        self.bucket.blobs[self.name] = f.read()
+
+    def download_as_bytes(self):
+        return self.bucket.blobs[self.name]
+
+
+def test_gcs_array_store():
+    store = GCSArrayStore("bucket")
+    store._bucket = _Bucket()
+    array = np.linspace(1., 2., 50)
+    uid = store.put(array_to_npy(array))
+    assert len(uid) == 32 and int(uid, 16) >= 0
+    # re-serializing the same array does not upload it again
+    assert store.put(array_to_npy(array.copy())) == uid
+    assert store._bucket.uploads == 1
+    assert np.array_equal(npy_to_array(store.fetch(uid)), array)
+    # a deleted blob is uploaded again
+    del store._bucket.blobs[uid]
+    assert store.put(array_to_npy(array)) == uid
+    assert store._bucket.uploads == 2
@@ -0,0 +1,122 @@
+from multiprocessing import get_context
+from pathlib import Path
+import hashlib
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from pydatarecognition.cif_cache import CifCache, PACK_DATA, PACK_INDEX, PACK_LOCK, open_cache, file_signature
+
+
+def test_cif_cache():
+    with TempDirectory() as d:
+        path = Path(d.path) / "_cache"
+        cache = CifCache(path)
+        assert len(cache) == 0
+        assert cache.get("aa0001") is None
+        cache.put("aa0001", [1., 2., 3.], [10., 20., 30.], iucrid="aa0001", wavelength=0.154)
+        cache.put("aa0002", [], [5., 6.], iucrid="aa0002", wavelength=None)
+        cache.put("aa0003", [], [], iucrid="aa0003", wavelength=None)
+        # one data file, one index file and one lock file for every cif
+        assert sorted(p.name for p in path.iterdir()) == sorted([PACK_DATA, PACK_INDEX, PACK_LOCK])
+
+        reopened = CifCache(path)
+        assert len(reopened) == 3
+        record, q, intensity = reopened.get("aa0001")
+        assert record["wavelength"] == 0.154
+        assert np.array_equal(q, [1., 2., 3.])
+        assert np.array_equal(intensity, [10., 20., 30.])
+        record, q, intensity = reopened.get("aa0002")
+        assert len(q) == 0
+        assert np.array_equal(intensity, [5., 6.])
+        record, q, intensity = reopened.get("aa0003")
+        assert len(q) == 0 and len(intensity) == 0
+
+        # a new entry for the same cif supersedes the old one, also in an open cache
+        reopened.put("aa0001", [4., 5.], [40., 50.], iucrid="aa0001", wavelength=0.154)
+        record, q, intensity = reopened.get("aa0001")
+        assert np.array_equal(q, [4., 5.])
+        record, q, intensity = CifCache(path).get("aa0001")
+        assert np.array_equal(intensity, [40., 50.])
+
+
+def test_open_cache():
+    with TempDirectory() as d:
+        path = Path(d.path) / "_cache"
+        cache = open_cache(path)
+        assert open_cache(path) is cache
+        # records appended by another writer are picked up on a miss
+        CifCache(path).put("aa0001", [1., 2.], [3., 4.], iucrid="aa0001")
+        record, q, intensity = cache.get("aa0001")
+        assert np.array_equal(intensity, [3., 4.])
+        # the shared cache sees its own writes
+        cache.put("aa0002", [1.], [2.])
+        assert "aa0002" in open_cache(path)
+        assert len(CifCache(path)) == 2
+
+
+def _put_many(path, writer):
+    cache = CifCache(path)
+    for i in range(300):
+        cache.put(f"w{writer}_{i}", np.full(i % 7 + 1, writer), np.full(i % 5 + 1, i))
+
+
+def test_concurrent_writers():
+    with TempDirectory() as d:
+        path = Path(d.path) / "_cache"
+        CifCache(path)
+        processes = [get_context("spawn").Process(target=_put_many, args=(path, writer)) for writer in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        cache = CifCache(path)
+        assert len(cache) == 1200
+        for writer in range(4):
+            for i in range(300):
+                record, q, intensity = cache.get(f"w{writer}_{i}")
+                assert np.array_equal(q, np.full(i % 7 + 1, writer))
+                assert np.array_equal(intensity, np.full(i % 5 + 1, i))
+
+
+def test_compact(monkeypatch):
+    with TempDirectory() as d:
+        path = Path(d.path) / "_cache"
+        cache = CifCache(path)
+        reader = CifCache(path)
+        cache.put("aa0001", np.arange(100.), np.arange(100.) + 1)
+        cache.put("aa0002", [1., 2.], [3., 4.])
+        assert reader.get("aa0001") is not None
+        cache.put("aa0001", np.arange(10.), np.arange(10.) + 1)
+        assert cache.dead_bytes() == 200 * 8
+        cache.compact()
+        assert cache.dead_bytes() == 0
+        assert PACK_DATA not in [p.name for p in path.iterdir()]
+        # a reader that mapped the old pack picks up the new index
+        record, q, intensity = reader.get("aa0002")
+        assert np.array_equal(intensity, [3., 4.])
+        reader.refresh()
+        record, q, intensity = reader.get("aa0001")
+        assert np.array_equal(q, np.arange(10.))
+        # writes after compaction go to the new pack
+        reader.put("aa0003", [5.], [6.])
+        record, q, intensity = CifCache(path).get("aa0003")
+        assert np.array_equal(intensity, [6.])
+        assert len(CifCache(path)) == 3
+
+        # the pack is compacted by put once most of it is dead
+        monkeypatch.setattr("pydatarecognition.cif_cache.COMPACT_MIN_BYTES", 0)
+        for i in range(5):
+            cache.put("aa0001", np.arange(100.), np.arange(100.) + i)
+        assert cache.dead_bytes() <= 0.5 * (cache.live * 8 + cache.dead_bytes())
+        record, q, intensity = CifCache(path).get("aa0001")
+        assert np.array_equal(intensity, np.arange(100.) + 4)
+
+
+def test_file_signature():
+    with TempDirectory() as d:
+        d.write("test.cif", b"data_test\n")
+        actual = file_signature(Path(d.path) / "test.cif")
+    assert actual["size"] == 10
+    assert actual["sha256"] == hashlib.sha256(b"data_test\n").hexdigest()
+    assert isinstance(actual["mtime"], int)
@@ -1,12 +1,18 @@
+import os
+import multiprocessing
+import time
 from pathlib import Path
 
 import numpy
 import pytest
 from testfixtures import TempDirectory
-from pydatarecognition.cif_io import cif_read, user_input_read, _xy_write, rank_write
+import pydatarecognition.cif_io
+from pydatarecognition.cif_io import (cif_read, user_input_read, _xy_write, rank_write, refresh_cache,
+                                      _fast_cif_read, CIF_READ_TAGS)
 from pydatarecognition.powdercif import PowderCif
 from tests.inputs.test_cifs import testciffiles_contents_expecteds
 from habanero import Crossref
+import CifFile
 
 @pytest.mark.parametrize("cm", testciffiles_contents_expecteds)
 def test_cif_read(cm):
@@ -68,6 +74,109 @@ def test_cif_read(cm):
         assert actual.wavel_units is None
 
 
+def test_cif_read_stale_cache(monkeypatch):
+    cif_contents = testciffiles_contents_expecteds[0][0]
+    with TempDirectory() as d:
+        d.write("cifs/test_cif.cif", bytearray(cif_contents, 'utf8'))
+        test_cif_path = Path(d.path) / "cifs" / "test_cif.cif"
+        assert cif_read(test_cif_path).wavelength == 0.15482
+        # an edited cif is parsed again
+        d.write("cifs/test_cif.cif", bytearray(cif_contents.replace("1.5482", "1.5406"), 'utf8'))
+        mtime = os.stat(test_cif_path).st_mtime_ns
+        os.utime(test_cif_path, ns=(mtime + 10**9, mtime + 10**9))
+        assert cif_read(test_cif_path).wavelength == 0.15406
+        # as is every cif after a parser upgrade
+        monkeypatch.setattr(pydatarecognition.cif_io, "PARSER_VERSION", -1)
+        actual = cif_read(test_cif_path, verbose=True)
+        assert actual.wavel_units == "ang"
+        actual = cif_read(test_cif_path)
+        assert actual.wavel_units is None
+
+
+def test_refresh_cache():
+    with TempDirectory() as d:
+        for i, (contents, expected) in enumerate(testciffiles_contents_expecteds):
+            d.write(f"cifs/test_cif_{i}.cif", bytearray(contents, 'utf8'))
+        cif_dir = Path(d.path) / "cifs"
+        actual, failed = refresh_cache(cif_dir, jobs=2)
+        assert [p.name for p in actual] == ["test_cif_0.cif", "test_cif_1.cif"]
+        assert failed == []
+        assert refresh_cache(cif_dir, jobs=2) == ([], [])
+        actual = cif_read(cif_dir / "test_cif_0.cif")
+        assert actual.wavel_units is None
+        assert numpy.allclose(actual.q, testciffiles_contents_expecteds[0][1]["q"])
+        with open(Path(d.path) / "_output" / "no_wavelength.txt") as f:
+            assert f.read() == "test_cif_1.cif\n"
+
+
+def _pathological_parse(cif_file_path, parse=pydatarecognition.cif_io._parse_for_cache):
+    if cif_file_path.stem == "hang":
+        time.sleep(60)
+    if cif_file_path.stem == "crash":
+        os._exit(1)
+    return parse(cif_file_path)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork",
+                    reason="workers only see the patched parser when they are forked")
+def test_refresh_cache_failures(monkeypatch):
+    monkeypatch.setattr(pydatarecognition.cif_io, "_parse_for_cache", _pathological_parse)
+    with TempDirectory() as d:
+        for name in ["crash", "good", "hang"]:
+            d.write(f"cifs/{name}.cif", bytearray(testciffiles_contents_expecteds[0][0], 'utf8'))
+        d.write("cifs/broken.cif", b"data_broken\n_pd_meas_counts_total\n")
+        cif_dir = Path(d.path) / "cifs"
+        parsed, failed = refresh_cache(cif_dir, jobs=2, timeout=1)
+        assert [p.name for p in parsed] == ["broken.cif", "crash.cif", "good.cif", "hang.cif"]
+        assert [(p.name, error.split(":")[0]) for p, error in failed] == [
+            ("broken.cif", "StarError"),
+            ("crash.cif", "worker process died with exit code 1"),
+            ("hang.cif", "timed out after 1 s"),
+        ]
+        with open(Path(d.path) / "_output" / "failed.txt") as f:
+            assert f.read() == "broken.cif\ncrash.cif\nhang.cif\n"
+        assert cif_read(cif_dir / "good.cif").iucrid == "good"
+        with pytest.raises(RuntimeError, match="crash.cif could not be parsed"):
+            cif_read(cif_dir / "crash.cif")
+        # failures are not retried, except for timeouts when given more time
+        assert refresh_cache(cif_dir, jobs=2, timeout=1) == ([], [])
+        parsed, failed = refresh_cache(cif_dir, jobs=2, timeout=1.5)
+        assert [p.name for p in parsed] == ["hang.cif"]
+
+
+@pytest.mark.parametrize("cm", testciffiles_contents_expecteds)
+def test__fast_cif_read(cm):
+    with TempDirectory() as d:
+        d.write("test.cif", bytearray(cm[0], 'utf8'))
+        test_cif_path = Path(d.path) / "test.cif"
+        actual = _fast_cif_read(test_cif_path, CIF_READ_TAGS)
+        with open(test_cif_path) as fs:
+            expected = CifFile.ReadCif(fs)
+    assert list(actual.keys()) == list(expected.keys())
+    for block in actual:
+        assert set(actual[block]) == {tag for tag in CIF_READ_TAGS if tag in expected[block]}
+        for tag, value in actual[block].items():
+            assert value == expected[block][tag]
+
+
+fallback_cifs = [
+    "data_a\nsave_frame\n_pd_meas_counts_total 1\nsave_\n",
+    "global_\n_pd_meas_counts_total 1\ndata_a\n",
+    "data_a\nloop_\n_pd_meas_2theta_scan\n_pd_meas_counts_total\n1 2 3\n",
+    "data_a\n_pd_meas_counts_total\n",
+    "data_a\n_pd_meas_counts_total 1\n_pd_meas_counts_total 2\n",
+    "data_a\ndata_A\n",
+    "#\\#CIF_2.0\ndata_a\n",
+]
+
+
+@pytest.mark.parametrize("contents", fallback_cifs)
+def test__fast_cif_read_fallback(contents):
+    with TempDirectory() as d:
+        d.write("test.cif", bytearray(contents, 'utf8'))
+        assert _fast_cif_read(Path(d.path) / "test.cif", CIF_READ_TAGS) is None
+
+
 testuserdata_contents_expecteds = [
     ("\
 10.0413\t2037.0\n\
@@ -0,0 +1,286 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from scipy.stats import kendalltau, pearsonr, spearmanr
+from testfixtures import TempDirectory
+
+from pydatarecognition.cif_io import refresh_cache
+from pydatarecognition.library import (PatternLibrary, canonical_qgrid, grid_pattern, load_library,
+                                       update_library, library_cache_path, QGRID_INTERVALS, MIN_QRANGE_OVERLAP,
+                                       _Slice, _prefix_sums)
+from pydatarecognition.utils import pearson_from_sums
+from tests.inputs.test_cifs import testciffiles_contents_expecteds
+
+
+def test_canonical_qgrid():
+    actual = canonical_qgrid(1.23, 1.51, 0.1)
+    expected = np.array([1.2, 1.3, 1.4, 1.5, 1.6])
+    assert np.allclose(actual, expected)
+
+
+def test_grid_pattern():
+    q_grid = np.arange(0, 11) * 1.
+    actual, lo, hi = grid_pattern([2.5, 4., 7.], [1., 4., 10.], q_grid)
+    assert (lo, hi) == (3, 8)
+    expected = np.array([0, 0, 0, 2., 4., 6., 8., 10., 0, 0, 0])
+    assert np.allclose(actual, expected)
+    # unsorted input is handled
+    actual, lo, hi = grid_pattern([7., 2.5, 4.], [10., 1., 4.], q_grid)
+    assert np.allclose(actual, expected)
+
+
+def _patterns():
+    rng = np.random.default_rng(42)
+    q = np.linspace(5., 60., 800)
+    patterns = [
+        ("full", "aa0001", q, np.sin(q) + 2.),
+        ("shifted", "aa0002", q + 3.3, np.cos(q) + rng.random(800)),
+        ("noisy", "aa0003", q[:500], rng.random(500)),
+        ("narrow", "aa0004", np.linspace(40., 50., 50), rng.random(50)),
+        ("flat", "aa0005", q, np.ones(800)),
+    ]
+    return patterns
+
+
+def test_correlate():
+    step = 0.01
+    patterns = _patterns()
+    library = PatternLibrary.from_patterns(patterns, step)
+    assert len(library) == 5
+    user_q = np.linspace(4., 55., 600)
+    user_int = np.sin(user_q) + 0.1 * np.cos(3 * user_q)
+    actual = library.correlate(user_q, user_int)
+    for i, (name, iucrid, q, intensity) in enumerate(patterns):
+        win = (library.q_grid >= max(q[0], user_q[0])) & (library.q_grid <= min(q[-1], user_q[-1]))
+        x = library.q_grid[win]
+        if name in ["narrow", "flat"]:
+            assert np.isnan(actual[i])
+            continue
+        expected = pearsonr(np.interp(x, user_q, user_int), np.interp(x, q, intensity))[0]
+        assert actual[i] == pytest.approx(expected, abs=1e-9)
+
+
+def test_correlate_matrix_vector(monkeypatch):
+    # scoring a library in slices gives what one masked matrix-vector product over a full-width
+    # matrix of the whole library gives, without reading any row on its own
+    monkeypatch.setattr("pydatarecognition.library.BLOCK_SIZE", 12000)
+    library = PatternLibrary.from_patterns(_patterns(), 0.01)
+    assert len(library.slices) > 1
+    dense = np.zeros((len(library), len(library.q_grid)))
+    for i in range(len(library)):
+        dense[i, library.lo[i]:library.hi[i]] = library.row(i)
+    user_q = np.linspace(4., 55., 600)
+    user_int = np.sin(user_q) + 0.1 * np.cos(3 * user_q)
+    u, user_lo, user_hi = library.grid_user(user_q, user_int)
+    mask = np.zeros(len(library.q_grid))
+    mask[user_lo:user_hi] = 1.
+    sxy, sy = (dense @ np.column_stack((u, mask))).T
+    syy = (dense * dense) @ mask
+    win_lo, win_hi = library.overlap(user_lo, user_hi)
+    sx = np.array([u[a:b].sum() for a, b in zip(win_lo, win_hi)])
+    sxx = np.array([(u[a:b] ** 2).sum() for a, b in zip(win_lo, win_hi)])
+    expected = pearson_from_sums(win_hi - win_lo, sx, sy, sxx, syy, sxy)
+    expected[(win_hi - win_lo - 1) * library.q_step < MIN_QRANGE_OVERLAP] = np.nan
+    monkeypatch.setattr(PatternLibrary, "window", None)
+    assert np.allclose(library.correlate(user_q, user_int), expected, equal_nan=True)
+
+
+@pytest.mark.parametrize("metric, coefficient", [("spearman", spearmanr), ("kendall", kendalltau)])
+def test_correlate_rank_metric(metric, coefficient):
+    patterns = _patterns()
+    library = PatternLibrary.from_patterns(patterns, 0.01)
+    user_q = np.linspace(4., 55., 600)
+    user_int = np.sin(user_q) + 0.1 * np.cos(3 * user_q)
+    actual = library.correlate(user_q, user_int, metric=metric)
+    for i, (name, iucrid, q, intensity) in enumerate(patterns):
+        win = (library.q_grid >= max(q[0], user_q[0])) & (library.q_grid <= min(q[-1], user_q[-1]))
+        x = library.q_grid[win]
+        if name in ["narrow", "flat"]:
+            assert np.isnan(actual[i])
+            continue
+        expected = coefficient(np.interp(x, user_q, user_int), np.interp(x, q, intensity))[0]
+        assert actual[i] == pytest.approx(expected, abs=1e-6)
+    with pytest.raises(ValueError):
+        library.correlate(user_q, user_int, metric="cosine")
+
+
+def test_correlate_ruled_out():
+    # rows far from the user range are ruled out before their values are read
+    patterns = _patterns()
+    far = [(f"far{i}", "bb0001", np.linspace(200., 260., 100), np.random.default_rng(i).random(100))
+           for i in range(10)]
+    user_q = np.linspace(4., 55., 600)
+    user_int = np.sin(user_q) + 0.1 * np.cos(3 * user_q)
+    expected = PatternLibrary.from_patterns(patterns, 0.01).correlate(user_q, user_int)
+    actual = PatternLibrary.from_patterns(patterns + far, 0.01).correlate(user_q, user_int)
+    assert np.allclose(actual[:5], expected, equal_nan=True)
+    assert np.isnan(actual[5:]).all()
+
+
+def test_correlate_chunks(monkeypatch):
+    # chunks are made of whole slices, here [full, shifted], [noisy] and [narrow, flat]
+    monkeypatch.setattr("pydatarecognition.library.BLOCK_SIZE", 12000)
+    patterns = _patterns()
+    library = PatternLibrary.from_patterns(patterns, 0.01)
+    assert [len(piece) for piece in library.slices] == [2, 1, 2]
+    user_q = np.linspace(4., 55., 600)
+    user_int = np.sin(user_q) + 0.1 * np.cos(3 * user_q)
+    assert [start for start, scores in library.correlate_chunks(user_q, user_int, 2)] == [0, 2]
+    chunks = list(library.correlate_chunks(user_q, user_int, 1))
+    assert [start for start, scores in chunks] == [0, 2, 3]
+    actual = np.concatenate([scores for start, scores in chunks])
+    assert np.array_equal(actual, library.correlate(user_q, user_int), equal_nan=True)
+
+
+def test_correlate_many():
+    library = PatternLibrary.from_patterns(_patterns(), 0.01)
+    user_patterns = [(np.linspace(4., 55., 600), np.sin(np.linspace(4., 55., 600))),
+                     (np.linspace(30., 70., 300), np.random.default_rng(1).random(300)),
+                     (np.linspace(100., 150., 300), np.random.default_rng(2).random(300)),
+                     (np.linspace(4., 55., 600)[::-1], np.cos(np.linspace(4., 55., 600)))]
+    expected = np.array([library.correlate(q, intensity) for q, intensity in user_patterns])
+    actual = library.correlate_many(user_patterns)
+    assert actual.shape == (4, 5)
+    assert np.allclose(actual, expected, equal_nan=True)
+    assert library.correlate_many([]).shape == (0, 5)
+
+
+def test_correlate_many_slices(monkeypatch):
+    # slices of rows are split by the number of grid points they span
+    monkeypatch.setattr("pydatarecognition.library.BLOCK_SIZE", 5000)
+    test_correlate_many()
+
+
+def test_correlate_many_groups(monkeypatch):
+    # user patterns are scored in groups by the number of grid points they span
+    monkeypatch.setattr("pydatarecognition.library.USER_BLOCK_SIZE", 12000)
+    library = PatternLibrary.from_patterns(_patterns(), 0.01)
+    gridded = [(None, 300, 5400), (None, 10000, 15000), (None, 400, 5500), (None, 2900, 7000)]
+    assert list(library._user_groups(gridded)) == [[0, 2], [3], [1]]
+    test_correlate_many()
+
+
+def test_copy():
+    patterns = _patterns()
+    library = PatternLibrary.from_patterns(patterns, 0.01)
+    user_q = np.linspace(4., 55., 600)
+    user_int = np.sin(user_q) + 0.1 * np.cos(3 * user_q)
+    expected = library.correlate(user_q, user_int)
+    changed = library.copy()
+    assert changed.slices[0] is library.slices[0]
+    changed.upsert("full", "aa0001", patterns[1][2], patterns[1][3])
+    changed.upsert("wide", "aa0006", np.linspace(1., 90., 300), np.arange(300.))
+    changed.remove("noisy")
+    # the original is untouched
+    assert library.names == [p[0] for p in patterns]
+    assert np.array_equal(library.correlate(user_q, user_int), expected, equal_nan=True)
+    # a replaced pattern moves to the end
+    assert changed.names == ["shifted", "narrow", "flat", "full", "wide"]
+
+
+def test_stored_sums():
+    library = PatternLibrary.from_patterns(_patterns(), 0.01)
+    for piece in library.slices:
+        assert np.allclose(piece.cumsum, _prefix_sums(piece.values))
+        assert np.allclose(piece.cumsum_sq, _prefix_sums(piece.values ** 2))
+    user_q = np.linspace(4., 55., 600)
+    user_int = np.sin(user_q) + 0.1 * np.cos(3 * user_q)
+    # sy and syy are read from the stored prefix sums rather than summed per query, so with zero
+    # sums of squares every row looks constant over its window
+    piece = library.slices[0]
+    library.slices[0] = _Slice(piece.column, piece.values, piece.cumsum, np.zeros_like(piece.cumsum_sq))
+    assert np.isnan(library.correlate(user_q, user_int)).all()
+    # and they are saved with the library rather than summed again when it is read
+    with TempDirectory() as d:
+        path = Path(d.path) / "library.npz"
+        library.save(path)
+        actual = PatternLibrary.load(path)
+    assert not actual.slices[0].cumsum_sq.any()
+    assert np.array_equal(actual.slices[0].cumsum, piece.cumsum)
+
+
+def test_correlate_empty():
+    library = PatternLibrary.from_patterns([], 0.01)
+    assert len(library.correlate([1., 2.], [1., 2.])) == 0
+
+
+def test_save_load():
+    library = PatternLibrary.from_patterns(_patterns(), 0.01)
+    library.skipped = [("bad.cif", "Reciprocal space axis missing")]
+    with TempDirectory() as d:
+        path = Path(d.path) / "library.npz"
+        library.save(path)
+        actual = PatternLibrary.load(path)
+    assert actual.q_step == library.q_step
+    assert np.allclose(actual.q_grid, library.q_grid)
+    assert all(np.array_equal(actual.row(i), library.row(i)) for i in range(len(library)))
+    assert [len(piece) for piece in actual.slices] == [len(piece) for piece in library.slices]
+    assert np.array_equal(actual.lo, library.lo)
+    assert np.array_equal(actual.hi, library.hi)
+    assert actual.names == library.names
+    assert actual.iucrids == library.iucrids
+    assert actual.skipped == library.skipped
+    # the values and prefix sums of the slices take less than a full-width matrix of each
+    assert actual.nbytes == library.nbytes < 3 * 8 * len(library) * len(library.q_grid)
+
+
+def test_load_library():
+    with TempDirectory() as d:
+        cif_dir = Path(d.path) / "cifs"
+        cif_dir.mkdir()
+        d.write("cifs/test_cif.cif", bytearray(testciffiles_contents_expecteds[0][0], "utf8"))
+        actual = load_library(cif_dir, 0.001)
+        assert actual.names == ["test_cif"]
+        for q_step in QGRID_INTERVALS:
+            assert library_cache_path(cif_dir, q_step).exists()
+        # a new cif is applied to the stored library
+        d.write("cifs/test_cif_no_wavelength.cif", bytearray(testciffiles_contents_expecteds[1][0], "utf8"))
+        actual = load_library(cif_dir, 0.001)
+        assert actual.names == ["test_cif"]
+        assert actual.skipped == [("test_cif_no_wavelength.cif", "Reciprocal space axis missing")]
+        assert set(actual.sources) == {"test_cif", "test_cif_no_wavelength"}
+        # so is an edited cif, and only the edited cif is read again
+        edited = testciffiles_contents_expecteds[0][0].replace("1.5482", "1.2")
+        d.write("cifs/test_cif.cif", bytearray(edited, "utf8"))
+        refresh_cache(cif_dir)
+        stored = PatternLibrary.load(library_cache_path(cif_dir, 0.001))
+        assert update_library(stored, cif_dir) == ["test_cif"]
+        assert update_library(stored, cif_dir) == []
+        assert load_library(cif_dir, 0.001).sources != actual.sources
+        # and a removed cif
+        (cif_dir / "test_cif_no_wavelength.cif").unlink()
+        actual = load_library(cif_dir, 0.001)
+        assert actual.skipped == []
+        assert list(actual.sources) == ["test_cif"]
+        # intervals that are not pre-gridded are ingested on request
+        actual = load_library(cif_dir, 0.003)
+        assert actual.q_step == 0.003
+        assert library_cache_path(cif_dir, 0.003).exists()
+
+
+def test_upsert_remove():
+    patterns = _patterns()
+    expected = PatternLibrary.from_patterns(patterns, 0.01)
+    actual = PatternLibrary.from_patterns([], 0.01)
+    for pattern in reversed(patterns):
+        actual.upsert(*pattern)
+    # a pattern that widens the grid on both sides, then is replaced and removed again
+    actual.upsert("wide", "aa0006", np.linspace(1., 90., 300), np.arange(300.))
+    actual.upsert("wide", "aa0007", np.linspace(2., 70., 300), np.arange(300.))
+    assert actual.iucrids[actual.names.index("wide")] == "aa0007"
+    assert actual.remove("wide")
+    assert not actual.remove("wide")
+    assert sorted(actual.names) == sorted(expected.names)
+    user_q = np.linspace(4., 55., 600)
+    user_int = np.sin(user_q) + 0.1 * np.cos(3 * user_q)
+    order = [actual.names.index(name) for name in expected.names]
+    assert np.allclose(actual.correlate(user_q, user_int)[order], expected.correlate(user_q, user_int),
+                       equal_nan=True)
+    # rows only hold their own q-range, and slices only the columns of their rows
+    assert [len(actual.row(i)) for i in range(len(actual))] == (actual.hi - actual.lo).tolist()
+    assert sum(len(piece) for piece in actual.slices) == len(actual)
+    for piece, start in zip(actual.slices, np.cumsum([0] + [len(piece) for piece in actual.slices])):
+        rows = slice(start, start + len(piece))
+        assert piece.column - actual.q_grid[0] / actual.q_step == pytest.approx(actual.lo[rows].min())
+        assert piece.column + piece.width - actual.q_grid[0] / actual.q_step == pytest.approx(actual.hi[rows].max())
@@ -1,11 +1,17 @@
 from pathlib import Path
+import hashlib
 
 import numpy as np
 import pytest
+from testfixtures import TempDirectory
+
+import pydatarecognition.powdercif as powdercif
+from pydatarecognition.array_store import InlineArrayStore
 from pydatarecognition.cif_io import cif_read
 from pydatarecognition.powdercif import PydanticPowderCif
-from pydatarecognition.mongo_utils import cifs_to_mongo
+from pydatarecognition.mongo_utils import cifs_to_mongo, cifs_to_collection, migrate_indexes
 from tests.conftest import MONGODB_DATABASE_NAME, CIF_DIR, CIFJSON_COLLECTION_NAME
+from tests.inputs.test_cifs import testciffiles_contents_expecteds
 
 
 def test_cifs_to_mongo(cif_mongodb_client_unpopulated):
@@ -64,3 +70,94 @@ def test_pydantic_export_import(cif_mongodb_client_populated):
                 assert file_doc.dict().get(key) == value
     else:
         pytest.skip('Could not initialize DB')
+
+
+class _Collection:
+    # records the bulk writes of cifs_to_collection, failing the one at index fail.  Holds documents and
+    # indexes for migrate_indexes, whose aggregation it answers from the documents
+    def __init__(self, fail=None, documents=(), indexes=()):
+        self.writes, self.fail, self.indexes = [], fail, [{"name": name} for name in indexes]
+        self.documents = list(documents)
+
+    def create_indexes(self, indexes):
+        self.indexes.extend(index.document for index in indexes)
+
+    def index_information(self):
+        return {index["name"]: index for index in self.indexes}
+
+    def drop_index(self, name):
+        self.indexes = [index for index in self.indexes if index["name"] != name]
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        groups = {}
+        for document in sorted(self.documents, key=lambda document: document["_id"], reverse=True):
+            if isinstance(document.get("cif_file_name"), str):
+                groups.setdefault(document["cif_file_name"], []).append(document["_id"])
+        return [{"_id": name, "ids": ids} for name, ids in groups.items() if len(ids) > 1]
+
+    def delete_many(self, query):
+        ids = set(query["_id"]["$in"])
+        kept = [document for document in self.documents if document["_id"] not in ids]
+        deleted, self.documents = len(self.documents) - len(kept), kept
+        return type("DeleteResult", (), {"deleted_count": deleted})
+
+    def bulk_write(self, requests, ordered=True):
+        if len(self.writes) == self.fail:
+            self.fail = None
+            raise ConnectionError("lost the connection")
+        assert not ordered
+        self.writes.append(requests)
+
+
+def test_cifs_to_collection():
+    saved = powdercif.array_store
+    powdercif.set_array_store(InlineArrayStore())
+    try:
+        with TempDirectory() as d:
+            cif_dir = Path(d.path) / "cifs"
+            for name in ["aa0001", "aa0002", "aa0003", "bb0001", "bb0002"]:
+                d.write(f"cifs/{name}.cif", bytearray(testciffiles_contents_expecteds[0][0], "utf8"))
+            d.write("cifs/cc0001.cif", bytearray(testciffiles_contents_expecteds[1][0], "utf8"))
+            checkpoint = cif_dir / "_cache" / "checkpoint.txt"
+            col = _Collection(fail=1)
+            with pytest.raises(ConnectionError):
+                cifs_to_collection(col, cif_dir, checkpoint, jobs=1, batch_size=2)
+            sha256 = hashlib.sha256(testciffiles_contents_expecteds[0][0].encode("utf8")).hexdigest()
+            assert checkpoint.read_text() == f"aa0001.cif {sha256}\naa0002.cif {sha256}\n"
+            # the interrupted run is resumed after the last batch that was written, writing again the cif that
+            # was edited in between
+            d.write("cifs/aa0002.cif", bytearray(testciffiles_contents_expecteds[0][0] + "\n", "utf8"))
+            assert cifs_to_collection(col, cif_dir, checkpoint, jobs=1, batch_size=2) == 5
+            assert not checkpoint.exists()
+    finally:
+        powdercif.set_array_store(saved)
+    names = [request._filter["cif_file_name"] for requests in col.writes for request in requests]
+    assert names == ["aa0001", "aa0002", "aa0002", "aa0003", "bb0001", "bb0002", "cc0001"]
+    update = col.writes[0][0]._doc
+    assert update["$set"]["iucrid"] == "aa0001"
+    assert update["$set"]["npoints"] > 0 and update["$set"]["qmin"] < update["$set"]["qmax"]
+    assert [index["name"] for index in col.indexes[:4]] == ["iucrid", "cif_file_name_unique", "npoints", "wavelength"]
+    assert col.indexes[1]["unique"]
+    assert "_id" not in update["$set"] and update["$setOnInsert"]["_id"]
+
+
+def test_migrate_indexes():
+    # a collection written before cif_file_name was unique, with duplicates of every re-run
+    documents = [{"_id": "61a000000000000000000001", "cif_file_name": "aa0001"},
+                 {"_id": "61a000000000000000000002", "cif_file_name": "aa0002"},
+                 {"_id": "61a000000000000000000003", "cif_file_name": "aa0001"},
+                 {"_id": "61a000000000000000000004", "cif_file_name": "aa0001"},
+                 {"_id": "61a000000000000000000005", "cif_file_name": None},
+                 {"_id": "61a000000000000000000006", "cif_file_name": None}]
+    col = _Collection(documents=documents, indexes=["_id_", "cif_file_name", "q_range"])
+    assert migrate_indexes(col) == 2
+    # the newest of each file name is kept, and cifs without one are left alone
+    assert [document["_id"][-1] for document in col.documents] == ["2", "4", "5", "6"]
+    names = [index["name"] for index in col.indexes]
+    assert "cif_file_name" not in names and "q_range" not in names and "cif_file_name_unique" in names
+    # once the unique index exists no cifs are deleted, but retired indexes still are
+    col.documents.append({"_id": "61a000000000000000000007", "cif_file_name": "aa0002"})
+    col.indexes.append({"name": "q_range"})
+    assert migrate_indexes(col) == 0
+    assert len(col.documents) == 5
+    assert "q_range" not in [index["name"] for index in col.indexes]
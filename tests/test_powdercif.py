@@ -1,7 +1,7 @@
 import numpy
 import pytest
 
-from pydatarecognition.powdercif import PowderCif, LENGTHS, INVS
+from pydatarecognition.powdercif import PowderCif, PydanticPowderCif, LENGTHS, INVS
 
 
 rw = [
@@ -56,3 +56,18 @@ def test_powdercif_constructor(rw):
         pc = PowderCif("aa4589", "invang", [1., 2., 3.], [23, 24., 25.],
                        wavelength=0.154)
         assert f"ERROR: Wavelength supplied without units. Wavelength units are required from {*LENGTHS,}." == erc.value
+
+
+def test_pydantic_powdercif_cif_strings():
+    pc = PydanticPowderCif("aa4589", "invnm", ["1.0(1)", "2.0", "3.0(2)", "4.0"], ["23(2)", "?", "25", "."])
+    assert numpy.allclose(pc.q, [1., 3.])
+    assert numpy.allclose(pc.intensity, [23., 25.])
+
+
+def test_pydantic_powdercif_q_range():
+    pc = PydanticPowderCif("aa4589", "invnm", [3., 1., 2.], [1., 2., 3.])
+    assert (pc.qmin, pc.qmax, pc.npoints) == (1., 3., 3)
+    assert (PydanticPowderCif("aa4589").qmin, PydanticPowderCif("aa4589").npoints) == (None, 0)
+    # documents read without their arrays keep their stored range
+    pc = PydanticPowderCif(iucrid="aa4589", qmin=1., qmax=3., npoints=3)
+    assert (pc.qmin, pc.qmax, pc.npoints) == (1., 3., 3)
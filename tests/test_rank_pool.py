@@ -0,0 +1,39 @@
+import asyncio
+import threading
+
+import pytest
+
+from pydatarecognition.rank_pool import RankPool, PoolSaturated
+
+
+def test_rank_pool():
+    pool = RankPool(workers=2, queue=1)
+    release = threading.Event()
+
+    def job(i):
+        release.wait(5)
+        return i, threading.current_thread().name
+
+    async def flood():
+        jobs = [asyncio.ensure_future(pool.run(job, i)) for i in range(4)]
+        await asyncio.sleep(0.1)
+        assert pool.pending == 3
+        # the event loop is not blocked while the jobs run
+        with pytest.raises(PoolSaturated):
+            await jobs[3]
+        release.set()
+        return await asyncio.gather(*jobs[:3])
+
+    actual = asyncio.run(flood())
+    pool.shutdown()
+    assert [result[0] for result in actual] == [0, 1, 2]
+    assert all(result[1].startswith("rank") for result in actual)
+    assert pool.pending == 0
+
+
+def test_rank_pool_from_env(monkeypatch):
+    monkeypatch.setenv("PYDATAREC_RANK_WORKERS", "3")
+    monkeypatch.delenv("PYDATAREC_RANK_QUEUE", raising=False)
+    pool = RankPool.from_env()
+    assert (pool.workers, pool.queue) == (3, 12)
+    pool.shutdown()
@@ -0,0 +1,172 @@
+import json
+import subprocess
+import sys
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+
+from testfixtures import TempDirectory
+
+from pydatarecognition.references import ReferenceStore, ReferenceResolver, open_reference_store
+
+
+def test_reference_store():
+    with TempDirectory() as d:
+        path = Path(d.path) / "references.sqlite"
+        store = ReferenceStore(path)
+        assert store.get_doi("aa0001") is None
+        assert store.get_reference("10.1107/aa0001") is None
+        store.put_doi("aa0001", "10.1107/aa0001")
+        store.put_reference("10.1107/aa0001", "A title, A. Author, Acta Cryst., pp.1, (2001).", date(2001, 6, 6))
+        store.put_reference("10.1107/aa0002", "Another title", None)
+        store.close()
+        reopened = ReferenceStore(path)
+        assert reopened.get_doi("aa0001") == "10.1107/aa0001"
+        assert reopened.get_reference("10.1107/aa0001") == ("A title, A. Author, Acta Cryst., pp.1, (2001).",
+                                                            date(2001, 6, 6))
+        assert reopened.get_reference("10.1107/aa0002") == ("Another title", None)
+        # lookups that found nothing are remembered for ttl seconds
+        assert not reopened.missed("doi", "poorid", 60)
+        reopened.put_miss("doi", "poorid")
+        assert reopened.missed("doi", "poorid", 60)
+        assert not reopened.missed("doi", "poorid", 0)
+        assert not reopened.missed("reference", "poorid", 60)
+        reopened.close()
+
+
+def test_open_reference_store():
+    with TempDirectory() as d:
+        d.write("cifs/iucrid_doi_mapping.txt", b"aa0001 10.1107/aa0001\nbb0002\t10.1107/bb0002\n\n")
+        cif_dir = Path(d.path) / "cifs"
+        store = open_reference_store(cif_dir)
+        assert store.get_doi("bb0002") == "10.1107/bb0002"
+        # an unchanged mapping is not read again
+        assert store.seed(cif_dir / "iucrid_doi_mapping.txt") == 0
+        store.close()
+        assert (cif_dir / "_cache" / "references.sqlite").exists()
+
+
+class _StandIn(BaseHTTPRequestHandler):
+    # serves the iucrid to DOI service and the Crossref works endpoint for test_reference_resolver
+    requests = []
+    flaky = set()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.requests.append(self.path)
+        if url.path == "/cnor2doi.php":
+            iucrid = parse_qs(url.query)["cnor"][0]
+            if iucrid == "slow0001":
+                time.sleep(2)
+            if iucrid == "flaky001" and iucrid not in self.flaky:
+                self.flaky.add(iucrid)
+                return self.send_error(503)
+            if iucrid == "trickle1":
+                return self._trickle(f"10.1107/{iucrid[:6]}".encode("utf-8") * 8)
+            body = "" if iucrid == "poorid" else f"10.1107/{iucrid[:6]}"
+        elif url.path.startswith("/works/"):
+            doi = unquote(url.path[len("/works/"):])
+            body = json.dumps({"message": {"author": [{"given": "SJL", "family": "Billinge"}],
+                                           "short-container-title": ["J. Great Results"],
+                                           "volume": 10,
+                                           "title": [f"Paper {doi}"],
+                                           "page": "231-233",
+                                           "issued": {"date-parts": [[1971, 8, 20]]}}})
+        else:
+            return self.send_error(404)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def _trickle(self, body):
+        # sends the headers at once and then a byte of the body every 0.1 s, each within the socket timeout
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            for i in range(len(body)):
+                self.wfile.write(body[i:i + 1])
+                self.wfile.flush()
+                time.sleep(0.1)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def test_reference_resolver():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with TempDirectory() as d:
+            store = ReferenceStore(Path(d.path) / "references.sqlite")
+            resolver = ReferenceResolver(store, doi_url=base + "/cnor2doi.php?cnor={iucrid}",
+                                         crossref_url=base + "/works/{doi}", concurrency=4, timeout=0.5,
+                                         retries=1, backoff=0.01)
+            iucrids = ["aa0001", "bb0002", "aa0001", "aa0001b", "flaky001", "slow0001", "trickle1", "poorid"]
+            started = time.monotonic()
+            actual = resolver.resolve(iucrids)
+            # two attempts of the slow and the trickling lookups, which are not waited for once timed out
+            assert time.monotonic() - started < 3
+            assert list(actual) == ["aa0001", "bb0002", "aa0001b", "flaky001", "slow0001", "trickle1", "poorid"]
+            assert actual["aa0001"] == ("10.1107/aa0001",
+                                        "Paper 10.1107/aa0001, SJL Billinge, J. Great Results, v. 10, pp. "
+                                        "231-233, (1971).",
+                                        date(1971, 8, 20))
+            assert actual["flaky001"][0] == "10.1107/flaky0"
+            assert actual["slow0001"] == (None, None, None)
+            assert actual["trickle1"] == (None, None, None)
+            assert actual["poorid"] == (None, None, None)
+            # duplicate iucrids and iucrids of the same paper are looked up once
+            requests = _StandIn.requests
+            assert requests.count("/cnor2doi.php?cnor=aa0001") == 1
+            assert requests.count("/works/10.1107/aa0001") == 1
+            # resolved entries are served from the store afterwards
+            del requests[:]
+            assert resolver.resolve(["aa0001", "bb0002"])["bb0002"][0] == "10.1107/bb0002"
+            assert requests == []
+            # single lookups share the store
+            assert resolver.doi("aa0001") == "10.1107/aa0001"
+            assert resolver.reference("10.1107/cc0003")[0].startswith("Paper 10.1107/cc0003")
+            # lookups that found nothing are not made again until retry_after has passed
+            assert resolver.doi("poorid") is None
+            assert resolver.resolve(["slow0001"])["slow0001"] == (None, None, None)
+            assert requests == ["/works/10.1107/cc0003"]
+            resolver.retry_after = 0
+            assert resolver.doi("poorid") is None
+            assert requests == ["/works/10.1107/cc0003", "/cnor2doi.php?cnor=poorid"]
+            store.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_reference_resolver_offline(monkeypatch):
+    def no_network(self, url):
+        raise AssertionError(f"went online for {url}")
+
+    monkeypatch.setattr(ReferenceResolver, "_get", no_network)
+    with TempDirectory() as d:
+        store = ReferenceStore(Path(d.path) / "references.sqlite")
+        store.put_doi("aa0001", "10.1107/aa0001")
+        store.put_reference("10.1107/aa0001", "A title", date(2001, 6, 6))
+        store.put_doi("bb0002", "10.1107/bb0002")
+        actual = ReferenceResolver(store, offline=True).resolve(["aa0001", "bb0002", "cc0003"])
+        store.close()
+    assert actual == {"aa0001": ("10.1107/aa0001", "A title", date(2001, 6, 6)),
+                      "bb0002": ("10.1107/bb0002", None, None),
+                      "cc0003": (None, None, None)}
+
+
+def test_offline_imports():
+    # the cli must not load the Crossref client unless it goes online
+    code = ("import sys, pydatarecognition.main, pydatarecognition.references; "
+            "pydatarecognition.references.ReferenceResolver(offline=True).resolve(['aa0001']); "
+            "assert 'habanero' not in sys.modules, 'habanero imported'")
+    subprocess.run([sys.executable, "-c", code], check=True)
@@ -1,10 +1,10 @@
 import argparse
+import json
 import re
 
 import numpy as np
 import pytest
 from datetime import date
-from habanero import Crossref
 from scipy.stats import pearsonr, spearmanr, kendalltau
 from pydatarecognition.utils import (data_sample, pearson_correlate,
                                      xy_resample,
@@ -13,8 +13,10 @@ from pydatarecognition.utils import (data_sample, pearson_correlate,
                                      validate_args, XCHOICES, XUNITS, DUNITS,
                                      TTUNITS, QUNITS, process_args,
                                      create_q_int_arrays,
-                                     plotting_min_max)
+                                     plotting_min_max, pearson_from_sums,
+                                     parse_cif_numbers, top_k_indices, best_per_key)
 from pydatarecognition.main import create_parser
+from pydatarecognition.references import ReferenceResolver
 from tests.inputs.xy1_reg import xy1_reg
 from tests.inputs.xy2_reg import xy2_reg
 from tests.inputs.xy3_reg import xy3_reg
@@ -93,7 +95,7 @@ def test_get_formatted_crossref_reference(monkeypatch):
                         }
         return mock_article
 
-    monkeypatch.setattr(Crossref, "works", mockreturn)
+    monkeypatch.setattr(ReferenceResolver, "_get", lambda self, url: json.dumps(mockreturn()))
     expected = ("Whamo, SJL Billinge, J. Great Results, v. 10, pp. 231-233, (1971).",
                 date(1971, 8, 20))
     actual = get_formatted_crossref_reference("test")
@@ -126,6 +128,30 @@ def test_correlate_bad():
     with pytest.raises(ValueError, match="similarity metric returned 'nan'"):
         correlate(y1, y2)
 
+def test_pearson_from_sums():
+    y1, y2 = np.linspace(0, 10, 11), np.array([0.1, 0.9, 2, 3.2, 4.3, 4.8, 5.9, 7, 7.9, 9, 9.8])
+    actual = pearson_from_sums(len(y1), y1.sum(), y2.sum(), (y1 * y1).sum(), (y2 * y2).sum(), (y1 * y2).sum())
+    expected = pearsonr(y1, y2)[0]
+    assert actual == pytest.approx(expected)
+    y2 = np.ones(11)
+    actual = pearson_from_sums(len(y1), y1.sum(), y2.sum(), (y1 * y1).sum(), (y2 * y2).sum(), (y1 * y2).sum())
+    assert np.isnan(actual)
+
+
+def test_parse_cif_numbers():
+    tokens = ["1.234(5)", "12(3)", "?", ".", "-", "-1.5", "1.2e3(4)", "3.40E-2(12)", ",", "7.", "-.5(1)"]
+    values, su, valid = parse_cif_numbers(tokens)
+    expected_values = [1.234, 12., np.nan, np.nan, np.nan, -1.5, 1200., 0.034, np.nan, 7., -0.5]
+    expected_su = [0.005, 3., np.nan, np.nan, np.nan, np.nan, 400., 0.0012, np.nan, np.nan, 0.1]
+    assert np.allclose(values, expected_values, equal_nan=True)
+    assert np.allclose(su, expected_su, equal_nan=True)
+    assert list(valid) == [True, True, False, False, False, True, True, True, False, True, True]
+    values, su, valid = parse_cif_numbers([])
+    assert len(values) == len(su) == len(valid) == 0
+    with pytest.raises(ValueError):
+        parse_cif_numbers(["1.2", "abc"])
+
+
 def test_rank_returns():
     rank_dict = {}
     for i in range(20):
@@ -146,6 +172,27 @@ def test_rank_returns():
     actual = rank_returns(rank_dict, returns_min, returns_max, similarity_threshold)
     expected = 9
     assert actual == expected
+    # all results reach the threshold
+    rank_dict = {i: {'corr_coeff': 0.99} for i in range(8)}
+    assert rank_returns(rank_dict, returns_min, returns_max, similarity_threshold) == 8
+
+
+def test_top_k_indices():
+    scores = np.array([0.5, np.nan, 0.9, 0.7, 0.9, 0.1, 0.7])
+    assert list(top_k_indices(scores, 3)) == [2, 4, 3]
+    assert list(top_k_indices(scores, 4)) == [2, 4, 3, 6]
+    assert list(top_k_indices(scores, 10)) == [2, 4, 3, 6, 0, 5]
+    assert list(top_k_indices(scores, 0)) == []
+    rng = np.random.default_rng(1)
+    scores = rng.random(1000).round(2)
+    expected = sorted(range(1000), key=lambda i: scores[i], reverse=True)[:20]
+    assert list(top_k_indices(scores, 20)) == expected
+
+
+def test_best_per_key():
+    scores = np.array([0.5, np.nan, 0.9, 0.7, 0.9, 0.1])
+    keys = ["a", "b", "a", "c", "c", "c"]
+    assert best_per_key(scores, keys) == {"a": 2, "c": 4}
 
 
 pa = [
@@ -159,6 +206,7 @@ pa = [
     {'wavelength': None, 'qgrid_interval': None, 'similarity_threshold': None},
     {'wavelength': None, 'qgrid_interval': None, 'similarity_threshold': None}),
     ({'returns_min_max': ["10", "20"]}, {'returns_min_max': [10, 20]}),
+    ({'jobs': "4", 'cif_timeout': "30"}, {'jobs': 4, 'cif_timeout': 30.}),
 ]
 @pytest.mark.parametrize("pa", pa)
 def test_process_args(pa):
@@ -173,7 +221,9 @@ pabad=[
     ({'wavelength': None, 'qgrid_interval': "sthg", 'similarity_threshold': None},
     "Cannot read --qgrid-interval. Please make sure it is a number"),
     ({'returns_min_max': ["bad", "worse"]},
-    "Cannot read --returns-min-max. Please make sure it is a list of numbers")
+    "Cannot read --returns-min-max. Please make sure it is a list of numbers"),
+    ({'jobs': "many"},
+    "Cannot read --jobs. Please make sure it is an integer"),
     ]
 @pytest.mark.parametrize("pabad", pabad)
 def test_process_args_bad(pabad):